@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarks of the lib.
+
+    Usage:
+        python -m example_based_entity_search.benchmark lsh ./pp_data
+        python -m example_based_entity_search.benchmark types ./pp_data
+        python -m example_based_entity_search.benchmark cascade ./pp_data --top_n 10,20,50
+        python -m example_based_entity_search.benchmark startup
+
+    Author: Paweł Płatek
+"""
+
+
+import argparse
+import subprocess
+import sys
+from random import Random
+from time import monotonic
+from decimal import Decimal as D
+from typing import Dict, List, Optional, Tuple
+
+from rdflib import URIRef
+
+from example_based_entity_search.config import (CASCADE_TOP_N, LSH_BANDS,
+                                                LSH_ROWS, STARTUP_BUDGET, L)
+from example_based_entity_search.entity_search_lib import (
+    Query, Ranking, _cached_triples_set_representation, rank_cascade,
+    rank_combined, rank_examples_based, rank_text_based)
+from example_based_entity_search.evaluate import (_samples_entities,
+                                                  load_graph, samples_files)
+from example_based_entity_search.lsh import MinHashLSH, graph_entities
+from example_based_entity_search.posting_lists import TypeIndex
+from example_based_entity_search.utils import (data_from_sample_file,
+                                               statistical_stats)
+
+
+def benchmark_lsh(evaluation_data: str, bands: int, rows: int, min_collisions: List[int],
+                  limit: Optional[int] = None):
+    """Compares exact and approximate (LSH) example-based ranking of all entities in the graph."""
+    print('Loading graphs...')
+    graph = load_graph(evaluation_data)
+    samples = samples_files(evaluation_data)
+
+    entities = graph_entities(graph)
+    if limit is not None and limit < len(entities):
+        entities = Random(1).sample(entities, limit)
+        # make sure entities from samples are included
+        for sample_file in samples:
+            _, examples, entities_to_rank, _ = data_from_sample_file(
+                sample_file)
+            entities = sorted(set(entities).union(
+                examples, entities_to_rank))
+
+    start = monotonic()
+    index = MinHashLSH(bands, rows)
+    index.add_entities(graph, entities)
+    print(f'Indexed {len(entities)} entities in {monotonic() - start:.2f}s '
+          f'({bands} bands x {rows} rows)')
+
+    for sample_file in samples:
+        topic, examples, _, relevant = data_from_sample_file(sample_file)
+        input_data = (topic, examples)
+        entities_wo_examples = [
+            entity for entity in entities if entity not in examples]
+        top_amount = max(1, len(relevant))
+
+        print(f'Sample `{sample_file}`, top {top_amount}:')
+        start = monotonic()
+        _, exact_ranking = rank_examples_based(
+            graph, input_data, entities_wo_examples)
+        exact_time = monotonic() - start
+        exact_top = set([entity for _, entity in exact_ranking[:top_amount]])
+        print(f'    exact: {exact_time:.2f}s, {len(entities_wo_examples)} scored')
+
+        for collisions in min_collisions:
+            start = monotonic()
+            candidates = index.candidates(
+                graph, examples, entities_wo_examples, collisions)
+            _, approximate_ranking = rank_examples_based(
+                graph, input_data, candidates)
+            approximate_time = monotonic() - start
+
+            approximate_top = set(
+                [entity for _, entity in approximate_ranking[:top_amount]])
+            recall = len(exact_top.intersection(approximate_top)) / top_amount
+            relevant_recall = len(set(relevant).intersection(
+                candidates)) / max(1, len(relevant))
+            print(f'    min_collisions={collisions}: {approximate_time:.2f}s, {len(candidates)} scored, '
+                  f'recall@{top_amount} {recall:.3f}, relevant in candidates {relevant_recall:.3f}, '
+                  f'speedup {exact_time / max(approximate_time, 1e-9):.1f}x')
+
+
+def benchmark_types(evaluation_data: str, min_shared_types: List[int]):
+    """Measures pruning of samples candidates with types posting lists."""
+    print('Loading graphs...')
+    graph = load_graph(evaluation_data)
+
+    start = monotonic()
+    index = TypeIndex.from_graph(graph)
+    print(f'Indexed {len(index.entities)} entities, {len(index.postings)} types '
+          f'in {monotonic() - start:.2f}s')
+
+    for sample_file in samples_files(evaluation_data):
+        topic, examples, entities_to_rank, relevant = data_from_sample_file(
+            sample_file)
+        input_data = (topic, examples)
+
+        print(f'Sample `{sample_file}`, {len(entities_to_rank)} candidates:')
+        start = monotonic()
+        _, exact_ranking = rank_examples_based(
+            graph, input_data, entities_to_rank)
+        exact_time = monotonic() - start
+        print(f'    scoring: {exact_time * 1000 / max(1, len(entities_to_rank)):.3f}ms per entity')
+
+        for shared in min_shared_types:
+            start = monotonic()
+            candidates = index.candidates(
+                graph, examples, entities_to_rank, shared)
+            pruning_time = monotonic() - start
+            relevant_recall = len(set(relevant).intersection(
+                candidates)) / max(1, len(relevant))
+            print(f'    min_shared_types={shared}: pruning {pruning_time * 1000:.3f}ms, '
+                  f'{len(candidates)} left, relevant left {relevant_recall:.3f}')
+
+
+def _avg_prec(ranking: List[Tuple[D, URIRef]], relevant: List[URIRef]) -> D:
+    return statistical_stats([entity in relevant for _, entity in ranking[:len(relevant)]])['AvgPrec']
+
+
+def benchmark_cascade(evaluation_data: str, top_ns: List[int], seed: int = 0):
+    """Compares combined ranking with the cascade (text-based scoring of top N example-based entities).
+
+    Like in evaluate.py, every sample ranks candidates of all samples.
+    """
+    print('Loading graphs...')
+    graph = load_graph(evaluation_data)
+    samples = samples_files(evaluation_data)
+    all_entities = _samples_entities(samples)
+
+    def full_ranking(input_data: Query, entities_to_rank: List[URIRef]) -> Ranking:
+        return rank_combined((rank_text_based(graph, input_data, entities_to_rank),
+                              rank_examples_based(graph, input_data, entities_to_rank)))
+
+    recalls: Dict[int, List[float]] = {top_n: [] for top_n in top_ns}
+    for sample_file in samples:
+        topic, examples, _, relevant = data_from_sample_file(
+            sample_file, Random(seed))
+        input_data = (topic, examples)
+        entities_to_rank = [entity for entity in all_entities if entity not in examples]
+        full_ranking(input_data, entities_to_rank)  # warm up rdflib indexes
+
+        print(f'Sample `{sample_file}`, {len(entities_to_rank)} candidates, {len(relevant)} relevant:')
+        _cached_triples_set_representation.cache_clear()
+        start = monotonic()
+        ranking_combined = full_ranking(input_data, entities_to_rank)
+        full_time = monotonic() - start
+        print(f'    full: {full_time:.2f}s, AvgPrec {_avg_prec(ranking_combined[1], relevant):.3f}')
+
+        for top_n in top_ns:
+            _cached_triples_set_representation.cache_clear()
+            start = monotonic()
+            _, ranking_example, ranking_cascade = rank_cascade(
+                graph, input_data, entities_to_rank, top_n)
+            cascade_time = monotonic() - start
+
+            shortlist = set([entity for _, entity in ranking_example[1][:top_n]])
+            recall = len(shortlist.intersection(relevant)) / max(1, len(relevant))
+            recalls[top_n].append(recall)
+            print(f'    top_n={top_n}: {cascade_time:.2f}s, recall@{top_n} {recall:.3f}, '
+                  f'AvgPrec {_avg_prec(ranking_cascade[1], relevant):.3f}, '
+                  f'speedup {full_time / max(cascade_time, 1e-9):.1f}x')
+
+    print('Mean recall of the first stage:')
+    for top_n, top_n_recalls in recalls.items():
+        print(f'    recall@{top_n} {sum(top_n_recalls) / max(1, len(top_n_recalls)):.3f}')
+
+
+# commands started from scripts, they must start fast
+STARTUP_COMMANDS = {
+    'ebes-rank': 'example_based_entity_search.entity_search_tool',
+    'ebes-serve': 'example_based_entity_search.entity_search_server',
+    'ebes-shard': 'example_based_entity_search.sharding'
+}
+# imported only when arguments are parsed and something is ranked
+LAZY_MODULES = ['rdflib', 'yaml', 'requests', 'example_based_entity_search.entity_search_lib',
+                'example_based_entity_search.utils']
+
+
+def _median_time(command: List[str], repeats: int) -> float:
+    times = []
+    for _ in range(repeats):
+        start = monotonic()
+        subprocess.run(command, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, check=True)
+        times.append(monotonic() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def benchmark_startup(repeats: int, budget: float) -> bool:
+    """Measures CLI startup (`--help`) time of the console scripts.
+
+    Commands are started like the console scripts start them (import of the module,
+    then main), arguments are parsed before rdflib and the lib are imported.
+    Interpreter and rdflib import times are reported for reference.
+
+    Returns:
+        True if all commands are within the budget and import no lazy modules
+    """
+    interpreter_time = _median_time([sys.executable, '-c', 'pass'], repeats)
+    rdflib_time = _median_time(
+        [sys.executable, '-c', 'import rdflib'], repeats)
+    print(f'python: {interpreter_time * 1000:.1f}ms, '
+          f'python + rdflib: {rdflib_time * 1000:.1f}ms, budget: {budget * 1000:.1f}ms')
+
+    within_budget = True
+    for script, module in STARTUP_COMMANDS.items():
+        command_time = _median_time(
+            [sys.executable, '-c', f'import sys; from {module} import main; sys.exit(main())', '--help'], repeats)
+        status = 'ok' if command_time <= budget else 'OVER BUDGET'
+        within_budget = within_budget and command_time <= budget
+        print(f'{script} --help: {command_time * 1000:.1f}ms ({status})')
+
+        # modules that should be imported only when needed
+        loaded = subprocess.run([sys.executable, '-c', f'import sys, {module}; print(\' \'.join(sys.modules))'],
+                                stdout=subprocess.PIPE, check=True).stdout.decode('utf8').split()
+        for lazy_module in LAZY_MODULES:
+            if lazy_module in loaded:
+                print(f'`{lazy_module}` is imported by {module}')
+                within_budget = False
+    return within_budget
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ebes library.')
+    parser.add_argument("-v", "--verbose", help="debug output",
+                        action="store_true")
+    subparsers = parser.add_subparsers(dest='command')
+
+    parser_lsh = subparsers.add_parser(
+        'lsh', help='Approximate (LSH) vs exact example-based ranking')
+    parser_lsh.add_argument(
+        'evaluation_data',
+        help='Path to directory with triple files (.nq) and sample files (.yml)')
+    parser_lsh.add_argument('--bands', type=int, default=LSH_BANDS)
+    parser_lsh.add_argument('--rows', type=int, default=LSH_ROWS)
+    parser_lsh.add_argument('--min_collisions', default='1,2',
+                            help='Comma separated values to test')
+    parser_lsh.add_argument('--limit', type=int,
+                            help='Use only that many random entities from the graph')
+
+    parser_types = subparsers.add_parser(
+        'types', help='Candidates pruning with types posting lists')
+    parser_types.add_argument(
+        'evaluation_data',
+        help='Path to directory with triple files (.nq) and sample files (.yml)')
+    parser_types.add_argument('--min_shared_types', default='1,2,3',
+                              help='Comma separated values to test')
+
+    parser_cascade = subparsers.add_parser(
+        'cascade', help='Cascade (example-based filter, then text-based scoring) vs combined ranking')
+    parser_cascade.add_argument(
+        'evaluation_data',
+        help='Path to directory with triple files (.nq) and sample files (.yml)')
+    parser_cascade.add_argument('--top_n', default=f'10,20,50,{CASCADE_TOP_N}',
+                                help='Comma separated values to test')
+    parser_cascade.add_argument('--seed', type=int, default=0,
+                                help='Seed of examples draws')
+
+    parser_startup = subparsers.add_parser(
+        'startup', help='CLI startup (import) time')
+    parser_startup.add_argument('--repeats', type=int, default=10)
+    parser_startup.add_argument('--budget', type=float, default=STARTUP_BUDGET,
+                                help='Allowed startup (`--help`) time, in seconds')
+
+    args = parser.parse_args()
+
+    L.setLevel('WARNING')
+    if args.verbose:
+        L.setLevel('DEBUG')
+
+    if args.command == 'lsh':
+        benchmark_lsh(args.evaluation_data, args.bands, args.rows,
+                      list(map(int, args.min_collisions.split(','))), args.limit)
+    elif args.command == 'types':
+        benchmark_types(args.evaluation_data, list(
+            map(int, args.min_shared_types.split(','))))
+    elif args.command == 'cascade':
+        benchmark_cascade(args.evaluation_data, list(
+            map(int, args.top_n.split(','))), args.seed)
+    elif args.command == 'startup':
+        if not benchmark_startup(args.repeats, args.budget):
+            return 1
+    else:
+        parser.print_help()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cache for rankings results.
+
+    Author: Paweł Płatek
+"""
+
+
+from collections import OrderedDict
+from decimal import Decimal as D
+from hashlib import sha1
+from threading import Lock
+from time import monotonic
+from typing import (AbstractSet, Any, Callable, Dict, Hashable, List,
+                    Optional, Tuple)
+
+from rdflib import URIRef
+
+from example_based_entity_search.config import (CACHE_MAX_SIZE, CACHE_TTL,
+                                                L)
+from example_based_entity_search.deadline import Deadline
+from example_based_entity_search.utils import PPGraph
+
+# copy of entity_search_lib types, lib imports this module
+Query = Tuple[str, List[URIRef]]
+Ranking = Tuple[D, List[Tuple[D, URIRef]]]
+
+
+class LRUCache:
+    """Least recently used dictionary with time to live.
+
+    Not thread-safe, callers must synchronize.
+    """
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: 'OrderedDict[Hashable, Tuple[float, Any]]' = OrderedDict()
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Any:
+        if key not in self._data:
+            return None
+
+        expires, value = self._data[key]
+        if self.ttl is not None and expires < monotonic():
+            del self._data[key]
+            self.expirations += 1
+            return None
+
+        self._data.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value: Any):
+        expires = monotonic() + self.ttl if self.ttl is not None else 0.0
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def remove(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def items(self) -> List[Tuple[Any, Any]]:
+        """Copy of not expired entries, least recently used first."""
+        now = monotonic()
+        return [(key, value) for key, (expires, value) in self._data.items()
+                if self.ttl is None or expires >= now]
+
+    def clear(self):
+        self._data.clear()
+
+
+class ResultCache:
+    """Caches rankings and not normalized per-entity scores.
+
+    Whole rankings are keyed by (model, normalized topic, sorted examples with repeats,
+    hash of entities to rank, graph uid and version). Scores are keyed the same way,
+    but without entities to rank, so queries with the same topic and examples
+    reuse scores of entities ranked before and compute only the missing ones.
+    """
+
+    def __init__(self, max_size: int = CACHE_MAX_SIZE, ttl: Optional[float] = CACHE_TTL):
+        self._lock = Lock()
+        self._rankings = LRUCache(max_size, ttl)
+        self._scores = LRUCache(max_size, ttl)
+        self.hits = 0  # whole ranking found
+        self.scores_hits = 0  # all scores found, only normalization was done
+        self.partial_hits = 0  # some scores found
+        self.misses = 0
+
+    @staticmethod
+    def _query_key(model_name: str, graph: PPGraph, input_data: Query) -> Tuple:
+        relation, examples = input_data
+        topic = ' '.join(str(relation).lower().split())
+        return (model_name, topic, tuple(sorted(examples)), graph.uid, graph.version)
+
+    @staticmethod
+    def _candidates_hash(entities_to_rank: List[URIRef]) -> str:
+        candidates = '\n'.join(sorted(entities_to_rank))
+        return sha1(candidates.encode('utf8')).hexdigest()
+
+    def rank(self, model_name: str, graph: PPGraph, input_data: Query, entities_to_rank: List[URIRef],
+             ranking_function: Callable[[Dict[URIRef, D]], Ranking], deadline: Optional[Deadline] = None) -> Ranking:
+        """Returns cached ranking or computes it, reusing known scores.
+
+        Args:
+            model_name: retrieval model identifier
+            graph: RDF triples to use
+            input_data: relation (topic) and examples
+            entities_to_rank: list of entities that should be rated
+            ranking_function: computes the ranking given dict of known
+                        (not normalized) scores, that it should update
+            deadline: deadline of ranking_function, partial rankings are not cached
+                        (scores computed in time are)
+
+        Returns:
+            Ranking
+        """
+        query_key = self._query_key(model_name, graph, input_data)
+        ranking_key = query_key + (self._candidates_hash(entities_to_rank),)
+
+        with self._lock:
+            ranking = self._rankings.get(ranking_key)
+            if ranking is not None:
+                self.hits += 1
+                L.info('Ranking found in cache')
+                return ranking
+
+            known_scores = dict(self._scores.get(query_key) or {})
+
+        required = set(entities_to_rank).union(input_data[1])
+        found = len(required.intersection(known_scores))
+        L.info('Found %d / %d scores in cache', found, len(required))
+
+        unscored = len(deadline.unscored) if deadline is not None else 0
+        ranking = ranking_function(known_scores)
+        partial = deadline is not None and len(deadline.unscored) > unscored
+
+        with self._lock:
+            if found == len(required):
+                self.scores_hits += 1
+            elif found > 0:
+                self.partial_hits += 1
+            else:
+                self.misses += 1
+
+            # merge with scores computed concurrently
+            cached_scores = self._scores.get(query_key)
+            if cached_scores is not None:
+                known_scores.update(cached_scores)
+            self._scores.put(query_key, known_scores)
+            if not partial:
+                self._rankings.put(ranking_key, ranking)
+
+        return ranking
+
+    def apply_changeset(self, graph: PPGraph, old_version: int, affected: AbstractSet[URIRef],
+                        local_models: AbstractSet[str]) -> int:
+        """Drops results invalidated by a changeset of the graph.
+
+        Rankings and scores of old_version are dropped, except scores of local models
+        (see RetrievalModel.local_scores) for queries with not affected examples:
+        these are moved to the current version without affected entities.
+
+        Returns:
+            amount of kept scores dicts
+        """
+        kept = 0
+        with self._lock:
+            for key, _ in self._rankings.items():
+                if key[3:5] == (graph.uid, old_version):
+                    self._rankings.remove(key)
+
+            for key, scores in self._scores.items():
+                model_name, _, examples, graph_uid, version = key
+                if (graph_uid, version) != (graph.uid, old_version):
+                    continue
+                self._scores.remove(key)
+                if model_name in local_models and affected.isdisjoint(examples):
+                    self._scores.put(key[:4] + (graph.version,),
+                                     {entity: score for entity, score in scores.items() if entity not in affected})
+                    kept += 1
+
+        L.info('Kept %d cached scores after the changeset', kept)
+        return kept
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'scores_hits': self.scores_hits,
+                'partial_hits': self.partial_hits,
+                'misses': self.misses,
+                'rankings': len(self._rankings),
+                'scores': len(self._scores),
+                'evictions': self._rankings.evictions + self._scores.evictions,
+                'expirations': self._rankings.expirations + self._scores.expirations
+            }
+
+    def clear(self):
+        with self._lock:
+            self._rankings.clear()
+            self._scores.clear()
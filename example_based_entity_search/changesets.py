@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Incremental updates of the graph from changesets.
+
+    Live feeds (like DBpedia Live) publish changesets: files with added and removed
+    triples (N-Triples or N-Quads, optionally gzipped). Applying them updates the graph
+    in place, together with its statistics, indexes and caches. Only entities touched
+    by the changeset (and entities linking to ones with changed labels) are invalidated.
+
+    Usage:
+        python -m example_based_entity_search.changesets pp_data/all.snapshot \
+            --added 000001.added.nt.gz --removed 000001.removed.nt.gz --save_snapshot pp_data/all.snapshot
+
+    Author: Paweł Płatek
+"""
+
+
+import argparse
+import gzip
+import io
+from sys import exit
+from typing import List, Optional, Set, cast
+
+from rdflib import ConjunctiveGraph, URIRef
+from rdflib.util import guess_format
+
+from example_based_entity_search.cache import ResultCache
+from example_based_entity_search.config import L
+from example_based_entity_search.entity_search_lib import MODELS, Triple
+from example_based_entity_search.lsh import MinHashLSH
+from example_based_entity_search.posting_lists import TypeIndex
+from example_based_entity_search.utils import (PPGraph, load_data,
+                                               save_snapshot)
+
+
+def read_triples(path: str) -> List[Triple]:
+    """Triples from N-Triples or N-Quads file (contexts are dropped)."""
+    gzipped = path.endswith('.gz')
+    data_format = guess_format(path[:-len('.gz')] if gzipped else path) or 'nt'
+    store = ConjunctiveGraph()
+    with (io.BufferedReader(gzip.open(path, 'rb')) if gzipped else open(path, 'rb')) as f:
+        store.parse(f, format=data_format)
+    # subjects and predicates of parsed triples are never literals
+    return cast(List[Triple], list(store.triples((None, None, None))))
+
+
+def apply_changeset(graph: PPGraph, added: List[Triple], removed: List[Triple],
+                    cache: Optional[ResultCache] = None, type_index: Optional[TypeIndex] = None,
+                    lsh_index: Optional[MinHashLSH] = None) -> Set[URIRef]:
+    """Applies the changeset to the graph and everything computed from it.
+
+    Args:
+        graph: in-memory graph to update
+        added: triples to add
+        removed: triples to remove (before adding)
+        cache: results cache, only scores of not affected entities are kept
+        type_index: types posting lists to update
+        lsh_index: LSH index, affected entities are indexed again
+
+    Returns:
+        affected entities
+    """
+    old_version = graph.version
+    affected = graph.apply_changeset(added, removed)
+
+    if graph.features is not None:
+        graph.features.invalidate(affected)
+    if cache is not None:
+        cache.apply_changeset(graph, old_version, affected,
+                              {name for name, model in MODELS.items() if model.local_scores})
+    if type_index is not None:
+        type_index.apply_changeset(added, removed)
+    if lsh_index is not None:
+        lsh_index.update(graph, affected)
+    return affected
+
+
+def main():
+    """Applies changesets to the graph and saves it with its indexes"""
+    parser = argparse.ArgumentParser(
+        description='Apply changesets (added and removed triples) to the graph')
+    parser.add_argument(
+        'triples_data',
+        help='Path to directory with triple files or path to triple file or snapshot')
+    parser.add_argument('--added', action='append', default=[],
+                        help='File with added triples (may be repeated)')
+    parser.add_argument('--removed', action='append', default=[],
+                        help='File with removed triples (may be repeated)')
+    parser.add_argument('--save_snapshot', required=True,
+                        help='Save updated graph as a snapshot to this file')
+    parser.add_argument('--type_index',
+                        help='Types index (see posting_lists.py) to update in place')
+    parser.add_argument('--lsh',
+                        help='LSH index (see lsh.py) to update in place')
+    parser.add_argument("-v", "--verbose", help="debug output",
+                        action="store_true")
+
+    # args parsing and sanity checks
+    args = parser.parse_args()
+
+    L.setLevel('INFO')
+    if args.verbose:
+        L.setLevel('DEBUG')
+
+    try:
+        graph = load_data(args.triples_data)
+        type_index = TypeIndex.load(args.type_index) if args.type_index else None
+        lsh_index = MinHashLSH.load(args.lsh) if args.lsh else None
+    except Exception as e:
+        L.error('Error when loading data from `%s`: %s', args.triples_data, e)
+        return 1
+
+    try:
+        added = [tr for path in args.added for tr in read_triples(path)]
+        removed = [tr for path in args.removed for tr in read_triples(path)]
+    except Exception as e:
+        L.error('Error when reading changeset: %s', e)
+        return 1
+
+    try:
+        apply_changeset(graph, added, removed,
+                        type_index=type_index, lsh_index=lsh_index)
+    except ValueError as e:
+        L.error('Error when applying changeset: %s', e)
+        return 1
+
+    save_snapshot(graph, args.save_snapshot)
+    if type_index is not None:
+        type_index.save(args.type_index)
+    if lsh_index is not None:
+        lsh_index.save(args.lsh)
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compact, column oriented rankings.
+
+    Ranking data is usually a list of (Decimal score, URIRef) tuples, three Python objects
+    per entity. ColumnarRanking keeps ids of entities (uint32, indexes into a table
+    of entities) and normalized scores (float64) in two arrays, best entities first.
+    Slices are views of the arrays, nothing is copied until the data is read.
+
+    Columns are saved as `.npy` files (readable with numpy.load) straight from the arrays:
+        <path>.ids.npy     - ids of entities, best first
+        <path>.scores.npy  - their scores
+        <path>.entities    - table of entities, one URI per line (line number is the id)
+
+    Author: Paweł Płatek
+"""
+
+
+import ast
+import struct
+import sys
+from array import array
+from typing import (AbstractSet, Iterable, Iterator, List, Sequence,
+                    SupportsFloat, Tuple, Union, overload)
+
+from rdflib import URIRef
+
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+NPY_HEADER_LENGTH = struct.Struct('<H')
+NPY_ALIGNMENT = 64
+
+_BYTE_ORDER = '<' if sys.byteorder == 'little' else '>'
+_ID_TYPE = 'I' if array('I').itemsize == 4 else 'L'
+
+
+def _write_npy(path: str, column: memoryview, descr: str):
+    """Writes one dimensional array (without copying it, if contiguous) as .npy file."""
+    header = repr({'descr': descr, 'fortran_order': False, 'shape': (len(column),)})
+    # magic, header length and the header are padded with spaces (and \n) to the alignment
+    padding = -(len(NPY_MAGIC) + NPY_HEADER_LENGTH.size + len(header) + 1) % NPY_ALIGNMENT
+    header += ' ' * padding + '\n'
+    with open(path, 'wb') as f:
+        f.write(NPY_MAGIC)
+        f.write(NPY_HEADER_LENGTH.pack(len(header)))
+        f.write(header.encode('latin1'))
+        f.write(column if column.contiguous else column.tobytes())
+
+
+def _read_npy(path: str, typecode: str, descr: str) -> array:
+    """Reads .npy file written by _write_npy."""
+    with open(path, 'rb') as f:
+        if f.read(len(NPY_MAGIC)) != NPY_MAGIC:
+            raise ValueError(f'`{path}` is not .npy file (version 1.0)')
+        header_length, = NPY_HEADER_LENGTH.unpack(
+            f.read(NPY_HEADER_LENGTH.size))
+        header = ast.literal_eval(f.read(header_length).decode('latin1'))
+        if header.get('descr') != descr or header.get('fortran_order') or len(header.get('shape', ())) != 1:
+            raise ValueError(
+                f'`{path}` is not one dimensional array of `{descr}`')
+        column = array(typecode)
+        column.frombytes(f.read())
+    if len(column) != header['shape'][0]:
+        raise ValueError(f'`{path}` is truncated')
+    return column
+
+
+class ColumnarRanking:
+    """Ranking data as arrays of entity ids and float scores, best entities first.
+
+    Iterating it gives (score, entity) tuples, like ranking data lists.
+    """
+
+    def __init__(self, entities: List[URIRef], ids: Union[array, memoryview], scores: Union[array, memoryview]):
+        assert len(ids) == len(scores), 'ids and scores must have the same length'
+        self.entities = entities  # table of entities, shared by slices
+        self.ids = memoryview(ids)
+        self.scores = memoryview(scores)
+
+    @classmethod
+    def from_scores(cls, entities: List[URIRef], scores: Sequence[float]) -> 'ColumnarRanking':
+        """Sorts entities by scores (ties broken like in sorted ranking data lists)."""
+        order = sorted(range(len(entities)), key=lambda i: (
+            scores[i], entities[i]), reverse=True)
+        return cls(entities, array(_ID_TYPE, order), array('d', [scores[i] for i in order]))
+
+    @classmethod
+    def from_ranking(cls, ranking_data: Iterable[Tuple[SupportsFloat, URIRef]]) -> 'ColumnarRanking':
+        """Converts sorted ranking data, like [(Decimal score, entity)]."""
+        entities = []
+        scores = array('d')
+        for ranking_score, entity in ranking_data:
+            entities.append(entity)
+            scores.append(float(ranking_score))
+        return cls(entities, array(_ID_TYPE, range(len(entities))), scores)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self) -> Iterator[Tuple[float, URIRef]]:
+        return zip(self.scores, map(self.entities.__getitem__, self.ids))
+
+    @overload
+    def __getitem__(self, index: int) -> Tuple[float, URIRef]:
+        ...
+
+    @overload
+    def __getitem__(self, index: slice) -> 'ColumnarRanking':
+        ...
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ColumnarRanking(self.entities, self.ids[index], self.scores[index])
+        return self.scores[index], self.entities[self.ids[index]]
+
+    def top_entities(self) -> List[URIRef]:
+        return list(map(self.entities.__getitem__, self.ids))
+
+    def relevance(self, relevant: AbstractSet[URIRef]) -> bytes:
+        """Relevance mask of ranked entities (1 for relevant ones), best first.
+
+        The mask works with statistical_stats, like lists of bools.
+        """
+        relevant_ids = bytes([entity in relevant for entity in self.entities])
+        return bytes(map(relevant_ids.__getitem__, self.ids))
+
+    def save(self, path: str):
+        _write_npy(f'{path}.ids.npy', self.ids, f'{_BYTE_ORDER}u{self.ids.itemsize}')
+        _write_npy(f'{path}.scores.npy', self.scores, f'{_BYTE_ORDER}f8')
+        with open(f'{path}.entities', 'w', encoding='utf8') as f:
+            for entity in self.entities:
+                f.write(f'{entity}\n')
+
+    @staticmethod
+    def load(path: str) -> 'ColumnarRanking':
+        ids = _read_npy(f'{path}.ids.npy', _ID_TYPE,
+                        f'{_BYTE_ORDER}u{array(_ID_TYPE).itemsize}')
+        scores = _read_npy(f'{path}.scores.npy', 'd', f'{_BYTE_ORDER}f8')
+        with open(f'{path}.entities', 'r', encoding='utf8') as f:
+            entities = [URIRef(line.rstrip('\n')) for line in f]
+        if len(ids) != len(scores) or any(entity_id >= len(entities) for entity_id in ids):
+            raise ValueError(f'`{path}` columns do not match')
+        return ColumnarRanking(entities, ids, scores)
+
+
+def relevance(ranking_data: Union[ColumnarRanking, Iterable[Tuple[object, URIRef]]],
+              relevant: Iterable[URIRef]) -> bytes:
+    """Relevance mask of any ranking data, best entities first."""
+    relevant = set(relevant)
+    if isinstance(ranking_data, ColumnarRanking):
+        return ranking_data.relevance(relevant)
+    return bytes([entity in relevant for _, entity in ranking_data])
+
+
+def combine_columnar(ranking_text_data: ColumnarRanking, ranking_example_data: ColumnarRanking,
+                     lambda_param: float) -> ColumnarRanking:
+    """Weighted sum of normalized scores (entities missing in one ranking get 0 there), sorted."""
+    entities = list(dict.fromkeys(
+        ranking_example_data.top_entities() + ranking_text_data.top_entities()))
+    positions = {entity: i for i, entity in enumerate(entities)}
+    combined = array('d', bytes(8 * len(entities)))
+    for ranking_data, weight in [(ranking_example_data, lambda_param), (ranking_text_data, 1 - lambda_param)]:
+        for ranking_score, entity in ranking_data:
+            combined[positions[entity]] += ranking_score * weight
+    return ColumnarRanking.from_scores(entities, combined)
@@ -28,5 +28,71 @@ LANGS = ['en', 'pl', None, '']  # languages for text representation of triples
 D_PREC = D('0.00000')  # precision of floats in logging
 EXAMPLES_AMOUNT = 4  # default amount of relevant entities use as examples
 
+# combined ranking, tuned to the paper's data (tune for yours with `evaluate.py --sweep`)
+COMBINED_LAMBDA = D('0.5')  # weight of example-based scores
+COMBINED_DELTA = D('0.1')  # min examples AP overlap of both rankings to combine them
+CASCADE_TOP_N = 100  # cascade mode: best example-based entities scored by text-based model
+
+# Monte Carlo evaluation (evaluate.py --trials)
+EVALUATION_TRIALS = 20  # suggested amount of random draws of examples per sample
+CONFIDENCE_Z = D('1.96')  # 95% confidence intervals
+
+# triples backends (load_data)
+SNAPSHOT_EXTENSION = 'snapshot'  # pickled graphs, loaded much faster than parsing
+SORTED_STORE_EXTENSION = 'sorted'  # index of out-of-core store (sorted_store.py)
+SORTED_CHUNK_SIZE = 1000000  # lines sorted in memory at once when building the sorted store
+MANIFEST_EXTENSION = 'manifest'  # entity to files ranges map, for lazy loading (manifest.py)
+TIERED_SEPARATOR = '::'  # `<local data>::<endpoint url>` is local graph filled from the endpoint (tiered.py)
+TIERED_WRITE_BACK = 'remote.nq'  # triples fetched from the endpoint are appended to this file
+TIERED_BATCH_SIZE = 50  # entities fetched from the endpoint with one query
+TIERED_ROWS_LIMIT = 10000  # rows asked with one query, endpoints cap results too (DBpedia at 10000)
+
+# command line tools (benchmark.py startup)
+STARTUP_BUDGET = 0.1  # max CLI startup (`--help`) time, in seconds
+
+# hubs (entities with more than HUB_DEGREE inlinks or outlinks) in representations:
+#   'cap' - at most HUB_PREDICATE_CAP links per predicate (bounded time with degree statistics)
+#   'sample' - HUB_DEGREE links with the smallest hashes (deterministic, bounded memory)
+#   'none' - all links
+HUB_POLICY = 'cap'
+HUB_DEGREE = 10000
+HUB_PREDICATE_CAP = 5000
+TEXT_TERMS_THRESHOLD = 999  # stop reading outlinks when all text representations have that many terms
+RANK_BATCH_SIZE = 16  # amount of entities passed to retrieval models at once
+
+TERMS_BLOCK_SIZE = 16  # front coding block size in terms dictionary
+
+# MinHash LSH index for approximate example-based ranking
+# triples sets of entities overlap little (most triples contain the entity itself),
+# so bands must be short to find any collisions
+LSH_BANDS = 64
+LSH_ROWS = 1
+LSH_MIN_COLLISIONS = 1  # bands colliding with an example, more = faster but worse recall
+
+# k-nearest-neighbours graph of entities (knn.py)
+KNN_K = 50  # neighbours kept for every entity
+KNN_BLOCK_SIZE = 1000  # entities per worker task
+KNN_MAX_POSTING = 1000  # triples shared by more entities are skipped
+
+# rankings cache
+CACHE_MAX_SIZE = 256  # amount of rankings (and scores dicts) to keep
+CACHE_TTL = 3600  # seconds
+FEATURES_MEMO_SIZE = 10000  # decoded records of the feature store kept in memory
+
+# sharded ranking (ebes-shard)
+SHARD_PORT = 8200  # local workers listen on consecutive ports
+SHARD_AUTHKEY_ENV = 'EBES_SHARD_AUTHKEY'  # variable with secret shared by coordinator and workers
+SHARD_CONNECT_TIMEOUT = 60  # seconds to wait for workers to start
+
+# ranking server (ebes-serve)
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8080
+SERVER_WORKERS = 4  # amount of rankings computed concurrently
+SERVER_TIMEOUT = 60  # seconds, per request
+SERVER_DEADLINE = None  # seconds, return partial rankings after that (None = score all entities)
+
+# batch mode (ebes-rank --batch)
+BATCH_WORKERS = 4  # amount of queries ranked concurrently
+
 logging.basicConfig(format='%(message)s')
 L = logging.getLogger('ebes')
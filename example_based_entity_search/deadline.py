@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Latency budget of rankings.
+
+    Rankings given a deadline score entities in priority order (cached and cheap ones first)
+    and stop when it passes, returning the best ranking so far. Entities left unscored
+    are recorded in the deadline, so the caller knows the ranking is partial.
+    One slow entity can't be interrupted, the deadline is checked between entities.
+
+    Author: Paweł Płatek
+"""
+
+
+from time import monotonic
+from typing import List, Optional, Set
+
+from rdflib import URIRef
+
+
+class Deadline:
+    """Point in time after which no more entities are scored."""
+
+    def __init__(self, timeout: float, unscored: Optional[Set[URIRef]] = None):
+        self.end = monotonic() + timeout
+        self.unscored: Set[URIRef] = set() if unscored is None else unscored
+
+    def expired(self) -> bool:
+        return monotonic() >= self.end
+
+    def remaining(self) -> float:
+        return max(0.0, self.end - monotonic())
+
+    def part(self, fraction: float) -> 'Deadline':
+        """Deadline after the fraction of remaining time, sharing unscored entities.
+
+        Useful to leave time for the next model in combined rankings.
+        """
+        return Deadline(self.remaining() * fraction, self.unscored)
+
+    @property
+    def partial(self) -> bool:
+        """Whether some entities were not scored in time."""
+        return len(self.unscored) > 0
+
+    def unscored_list(self) -> List[URIRef]:
+        return sorted(self.unscored)
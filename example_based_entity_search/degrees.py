@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Degree statistics of graph nodes.
+
+    Hubs (entities like countries or cities) are linked from hundreds of thousands
+    of other entities. Their degrees and per predicate links counts are computed
+    once, when the graph is loaded, so representations of hubs can be limited
+    (see HUB_POLICY in config) without scanning all their links first.
+
+    Usage:
+        python -m example_based_entity_search.degrees ./pp_data/ --top 20
+
+    Author: Paweł Płatek
+"""
+
+
+import argparse
+from collections import Counter
+from sys import exit
+from typing import Counter as CounterType
+from typing import Any, Dict, List, Set, Tuple
+
+from rdflib import URIRef
+
+from example_based_entity_search.config import HUB_DEGREE, L
+from example_based_entity_search.utils import PPGraph, load_data
+
+
+def _links_predicates(graph: PPGraph, node: URIRef, inlinks: bool) -> CounterType[URIRef]:
+    if inlinks:
+        return Counter([triple_predicate for _, triple_predicate in graph.subject_predicates(node)])
+    return Counter([triple_predicate for triple_predicate, _ in graph.predicate_objects(node)])
+
+
+class DegreeStats:
+    """In and out degrees of all nodes, links per predicate of hubs."""
+
+    def __init__(self, hub_degree: int = HUB_DEGREE):
+        self.hub_degree = hub_degree
+        self.in_degrees: CounterType[URIRef] = Counter()
+        self.out_degrees: CounterType[URIRef] = Counter()
+        # only for hubs, other entities are cheap to read anyway
+        self.in_predicates: Dict[URIRef, CounterType[URIRef]] = dict()
+        self.out_predicates: Dict[URIRef, CounterType[URIRef]] = dict()
+
+    @classmethod
+    def from_graph(cls, graph: PPGraph, hub_degree: int = HUB_DEGREE) -> 'DegreeStats':
+        stats = cls(hub_degree)
+        for triple_subject, _, triple_object in graph.triples((None, None, None)):
+            stats.out_degrees[triple_subject] += 1
+            if isinstance(triple_object, URIRef):  # degrees of literals are never read
+                stats.in_degrees[triple_object] += 1
+
+        for node, degree in stats.in_degrees.items():
+            if degree > hub_degree:
+                stats.in_predicates[node] = _links_predicates(graph, node, True)
+        for node, degree in stats.out_degrees.items():
+            if degree > hub_degree:
+                stats.out_predicates[node] = _links_predicates(graph, node, False)
+
+        L.info('Degrees of %d nodes, %d hubs (more than %d links)', len(set(stats.in_degrees).union(stats.out_degrees)),
+               len(set(stats.in_predicates).union(stats.out_predicates)), hub_degree)
+        return stats
+
+    def update(self, graph: PPGraph, added: List[Tuple[Any, Any, Any]], removed: List[Tuple[Any, Any, Any]]):
+        """Updates statistics after the triples were added to and removed from the graph."""
+        changed: Set[Tuple[URIRef, bool]] = set()
+        for triples, change in [(added, 1), (removed, -1)]:
+            for triple_subject, triple_predicate, triple_object in triples:
+                for node, inlinks in [(triple_subject, False), (triple_object, True)]:
+                    if not isinstance(node, URIRef):
+                        continue
+                    degrees = self.in_degrees if inlinks else self.out_degrees
+                    degrees[node] += change
+                    if degrees[node] <= 0:
+                        del degrees[node]
+                    predicates = self.in_predicates if inlinks else self.out_predicates
+                    if node in predicates:
+                        predicates[node][triple_predicate] += change
+                        if predicates[node][triple_predicate] <= 0:
+                            del predicates[node][triple_predicate]
+                    changed.add((node, inlinks))
+
+        # nodes that became or stopped being hubs
+        for node, inlinks in changed:
+            predicates = self.in_predicates if inlinks else self.out_predicates
+            if self.is_hub(node, inlinks) and node not in predicates:
+                predicates[node] = _links_predicates(graph, node, inlinks)
+            elif not self.is_hub(node, inlinks) and node in predicates:
+                del predicates[node]
+
+    def degree(self, entity: URIRef, inlinks: bool) -> int:
+        return self.in_degrees[entity] if inlinks else self.out_degrees[entity]
+
+    def is_hub(self, entity: URIRef, inlinks: bool) -> bool:
+        return self.degree(entity, inlinks) > self.hub_degree
+
+    def predicates(self, entity: URIRef, inlinks: bool) -> CounterType[URIRef]:
+        """Amount of links of the hub per predicate, empty for other entities."""
+        predicates = self.in_predicates if inlinks else self.out_predicates
+        return predicates.get(entity, Counter())
+
+    def top(self, amount: int, inlinks: bool) -> List[Tuple[URIRef, int]]:
+        degrees = self.in_degrees if inlinks else self.out_degrees
+        return degrees.most_common(amount)
+
+
+def main():
+    """Prints nodes with the highest degrees"""
+    parser = argparse.ArgumentParser(
+        description='Show degree statistics of the graph')
+    parser.add_argument(
+        'triples_data',
+        help='Path to directory with triple files or path to triple file')
+    parser.add_argument('--top', type=int, default=10,
+                        help='Amount of nodes to show')
+    parser.add_argument("-v", "--verbose", help="debug output",
+                        action="store_true")
+
+    # args parsing and sanity checks
+    args = parser.parse_args()
+
+    L.setLevel('INFO')
+    if args.verbose:
+        L.setLevel('DEBUG')
+
+    try:
+        graph = load_data(args.triples_data)
+    except Exception as e:
+        L.error('Error when loading data from `%s`: %s', args.triples_data, e)
+        return 1
+
+    stats = graph.degrees
+    if stats is None:
+        stats = DegreeStats.from_graph(graph)
+
+    for inlinks, name in [(True, 'inlinks'), (False, 'outlinks')]:
+        print(f'Most {name}:')
+        for node, degree in stats.top(args.top, inlinks):
+            hub = ' (hub)' if stats.is_hub(node, inlinks) else ''
+            print(f'    {degree:8d} {node}{hub}')
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
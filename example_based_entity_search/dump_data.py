@@ -8,21 +8,30 @@
 import argparse
 from os.path import isfile
 from sys import exit
-from typing import List, Union
+from typing import List
 
 from rdflib import RDFS, BNode, Literal, URIRef
+from rdflib.term import Node
 from yaml import YAMLError, safe_load
 
 from example_based_entity_search.config import SPARQL_ENDPOINT, L
 from example_based_entity_search.utils import load_data
 
 
-def n3_format(node: Union[URIRef, Literal, BNode]):
-    """Formats node (URIRef/Literal) to string in n3 format.
+def n3_format(node: Node) -> str:
+    """Formats node (URIRef/Literal) to string in N-Triples format.
 
-    Converts multiline strings to a single line.
+    Literals are escaped, so multiline strings (and ones with quotes) take a single line.
     """
-    return node.n3().replace('\n', '\\n').replace('"""', '"')
+    if not isinstance(node, Literal):
+        return node.n3()
+    value = (str(node).replace('\\', '\\\\').replace('"', '\\"')
+             .replace('\n', '\\n').replace('\r', '\\r'))
+    if node.language:
+        return f'"{value}"@{node.language}'
+    if node.datatype:
+        return f'"{value}"^^{node.datatype.n3()}'
+    return f'"{value}"'
 
 
 def get_and_store_data(sparql_endpoint: str, out_filename: str, entities: List[URIRef]):
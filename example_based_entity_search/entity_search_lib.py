@@ -6,32 +6,103 @@
 """
 
 
-import bisect
-from collections import defaultdict
+import heapq
+from collections import Counter, defaultdict
 from decimal import Decimal as D
 from functools import lru_cache
-from typing import Any, Callable, DefaultDict, Dict, List, Set, Tuple, Union
+from hashlib import blake2b
+from importlib import import_module
+from itertools import chain, islice
+from typing import AbstractSet, Any, Callable
+from typing import Counter as CounterType
+from typing import (TYPE_CHECKING, DefaultDict, Dict, Iterable, Iterator,
+                    List, Optional, Set, Tuple, Union)
 
 from rdflib import RDF, Literal, URIRef
 
-from example_based_entity_search.config import D_PREC, L
+from example_based_entity_search.cache import ResultCache
+from example_based_entity_search.columnar import (ColumnarRanking,
+                                                  combine_columnar)
+from example_based_entity_search.config import (CASCADE_TOP_N,
+                                                COMBINED_DELTA,
+                                                COMBINED_LAMBDA, D_PREC,
+                                                HUB_DEGREE,
+                                                HUB_POLICY, HUB_PREDICATE_CAP,
+                                                LSH_MIN_COLLISIONS,
+                                                RANK_BATCH_SIZE,
+                                                TEXT_TERMS_THRESHOLD, L)
+from example_based_entity_search.deadline import Deadline
 from example_based_entity_search.utils import PPGraph, statistical_stats
 
+if TYPE_CHECKING:
+    from example_based_entity_search.lsh import MinHashLSH
+
 Triple = Tuple[Union[None, URIRef], URIRef,
                Union[URIRef, Literal]]  # RDF triple
 Query = Tuple[str, List[URIRef]]  # (relation, examples)
 PreparsedData = Any
-RetrievalModel = Callable[[PreparsedData, PPGraph, URIRef], D]
+ScoringFunc = Callable[[PreparsedData, PPGraph, URIRef], D]
 PreparsingFunc = Callable[[PPGraph, Query], PreparsedData]
 # (mean_examples_ranking, [(0.23, "smthing"), ...])
 Ranking = Tuple[D, List[Tuple[D, URIRef]]]
+# (mean_examples_ranking, ColumnarRanking of float scores), see columnar.py
+RankingColumns = Tuple[D, ColumnarRanking]
 
 
 def normalize_relation(text: str) -> str:
     return str(text).lower()
 
 
-def _text_representation(graph: PPGraph, entity: URIRef) -> Dict[str, DefaultDict[str, int]]:
+def _link_hash(link: Tuple[URIRef, Union[URIRef, Literal]]) -> bytes:
+    """Stable (across processes) hash of the link, for deterministic sampling."""
+    return blake2b(' '.join([node.n3() for node in link]).encode('utf8'), digest_size=8).digest()
+
+
+def _capped_links(links: Iterator[Tuple[URIRef, Any]]) -> Iterator[Tuple[URIRef, Any]]:
+    """At most HUB_PREDICATE_CAP links per predicate, when the degrees are unknown."""
+    predicates_counts: CounterType[URIRef] = Counter()
+    for triple_predicate, node in links:
+        predicates_counts[triple_predicate] += 1
+        if predicates_counts[triple_predicate] <= HUB_PREDICATE_CAP:
+            yield triple_predicate, node
+
+
+def _entity_links(graph: PPGraph, entity: URIRef, inlinks: bool) -> Iterator[Tuple[URIRef, Any]]:
+    """Outlinks (predicate, object) or inlinks (predicate, subject) of the entity.
+
+    Links of hubs are limited according to HUB_POLICY. With degree statistics of the graph
+    other entities are read as they are and capped hubs read only HUB_PREDICATE_CAP links
+    of every predicate; without them all links are read, but only the limited ones kept.
+    """
+    def links(triple_predicate=None) -> Iterator[Tuple[URIRef, Any]]:
+        if inlinks:
+            for triple_subject, triple_predicate, _ in graph.triples((None, triple_predicate, entity)):
+                yield triple_predicate, triple_subject
+        else:
+            for _, triple_predicate, triple_object in graph.triples((entity, triple_predicate, None)):
+                yield triple_predicate, triple_object
+
+    degrees = graph.degrees
+    if HUB_POLICY == 'none' or (degrees is not None and not degrees.is_hub(entity, inlinks)):
+        return links()
+
+    if degrees is not None:
+        L.debug('%s is a hub (%d %s), limiting with `%s` policy', entity, degrees.degree(entity, inlinks),
+                'inlinks' if inlinks else 'outlinks', HUB_POLICY)
+
+    if HUB_POLICY == 'sample':
+        return iter(heapq.nsmallest(HUB_DEGREE, links(), key=_link_hash))
+
+    if degrees is not None:
+        return chain.from_iterable([islice(links(triple_predicate), HUB_PREDICATE_CAP)
+                                    for triple_predicate in sorted(degrees.predicates(entity, inlinks))])
+    return _capped_links(links())
+
+
+Links = Iterable[Tuple[URIRef, Any]]
+
+
+def _text_representation(graph: PPGraph, entity: URIRef, outlinks: Optional[Links] = None) -> Dict[str, DefaultDict[str, int]]:
     """Creates text representation of the entity.
 
     Entity is represented with triples that have the entity as a subject. Such triples
@@ -40,10 +111,12 @@ def _text_representation(graph: PPGraph, entity: URIRef) -> Dict[str, DefaultDic
         - types: with 'type' predicates like /subject or /22-rdf-syntax-ns#type
         - links: all other
     Finally all URIs are expanded to text with /rdfs:label predicate.
+    Outlinks of hubs are limited (see _entity_links).
 
     Args:
         graph(PPGraph)
         entity(URIRef)
+        outlinks: (predicate, object) links of the entity, if already read
 
     Returns:
         dict with keys: attributes, types, links
@@ -66,15 +139,20 @@ def _text_representation(graph: PPGraph, entity: URIRef) -> Dict[str, DefaultDic
     entities_without_label = 0
 
     # require only `threshold` objects of all type
-    threshold = 999
+    threshold = TEXT_TERMS_THRESHOLD
+    terms_amounts = {'attributes': 0, 'types': 0, 'links': 0}  # running sums of counters
+
+    if outlinks is None:
+        outlinks = _entity_links(graph, entity, inlinks=False)
 
     # iterate over all triples with the entity as the subject
-    for triple_predicate, triple_object in graph.predicate_objects(entity):
+    for triple_predicate, triple_object in outlinks:
         cs_to_use = None
+        cs_name = None
         value_to_use = None
 
         if isinstance(triple_object, Literal):
-            cs_to_use = attributes
+            cs_to_use, cs_name = attributes, 'attributes'
             value_to_use = triple_object
 
         elif isinstance(triple_object, URIRef):
@@ -84,17 +162,19 @@ def _text_representation(graph: PPGraph, entity: URIRef) -> Dict[str, DefaultDic
                 continue
 
             if triple_predicate in type_uris:
-                cs_to_use = types
+                cs_to_use, cs_name = types, 'types'
             else:
-                cs_to_use = links
+                cs_to_use, cs_name = links, 'links'
 
         else:
             continue
 
-        for o in normalize_relation(value_to_use).split():
+        terms = normalize_relation(value_to_use).split()
+        for o in terms:
             cs_to_use[o] += 1
+        terms_amounts[cs_name] += len(terms)
 
-        if all([sum(cs.values()) >= threshold for cs in [attributes, types, links]]):
+        if all([amount >= threshold for amount in terms_amounts.values()]):
             break
 
     result = {
@@ -109,6 +189,13 @@ def _text_representation(graph: PPGraph, entity: URIRef) -> Dict[str, DefaultDic
     return result
 
 
+def _entity_text_representation(graph: PPGraph, entity: URIRef) -> Dict[str, DefaultDict[str, int]]:
+    """Text representation from the graph's feature store, if it has one."""
+    if graph.features is not None:
+        return graph.features.text_representation(graph, entity)
+    return _text_representation(graph, entity)
+
+
 def _text_preparsing(graph: PPGraph, input_data: Query) -> Tuple[List[str], int]:
     """Normalize relation and compute dirichlet model parameters 
     """
@@ -124,6 +211,68 @@ def _text_preparsing(graph: PPGraph, input_data: Query) -> Tuple[List[str], int]
     return relation_normalized, ni
 
 
+def _text_term_probability(representations: Dict[str, DefaultDict[str, int]], representations_lengths: Dict[str, int],
+                           ni: int, t: str) -> D:
+    """Computes P(t | theta_w_e), probability of the term given text representation of the entity.
+
+    Args:
+        representations: text representation of the entity
+        representations_lengths: precomputed number of terms in representations
+        ni: dirichlet parameter
+        t: term from relation
+
+    Returns:
+        Probability
+    """
+    # P(t|theta_c), it should depends on term t
+    # but assume it is 1/ni, according to (4), page 182
+    probability_collection = D(1) / D(ni)
+
+    # this are experimental
+    representation_weights = {
+        'attributes': D('0.4'),
+        'types': D('0.4'),
+        'links': D('0.2')
+    }
+
+    L.debug('%s-> processing term %s', ' ' * 4, repr(t))
+
+    # P(t | theta_w_e) == sum(cs in representations) P(t | theta_cs_e) * P(cs)
+    term_probability = D('0.0')
+    for cs_name, cs in representations.items():
+        # tf(t,e) is the term frequency of t in the representation document of e
+        # http://mlwiki.org/index.php/TF-IDF#Term_Frequency
+        tf = cs[t]
+
+        # "Dirichlet smoothed model of the entire collection of triples"
+        # P(t|theta_c) == sum(D in theta_c)tf(t,D) / sum(D in theta_c)|D|
+        # we do not compute that, too time consuming
+        #
+        # probability_collection_nominator = D(0)
+        # for node in graph.all_nodes():
+        #     if isinstance(node, Literal):
+        #         triple_object_text = node
+        #     else:
+        #         triple_object_text = graph.label(node)
+        #     probability_collection_nominator += normalize_relation(triple_object_text).count(t)
+        # probability_collection = probability_collection_nominator / probability_collection_denominator
+
+        # P(t | theta_cs_e) == [tf(t,e) + ni*P(t|theta_c)] / [|e| + ni]
+        representation_probability = D(tf + ni * probability_collection)
+        representation_probability /= representations_lengths[cs_name] + ni
+        L.debug('%s-> probability for %s: %s (tf=%d, |e|=%d)', ' ' * 8,
+                cs_name, representation_probability.quantize(D_PREC), tf, representations_lengths[cs_name])
+
+        # do the addition
+        term_probability += representation_probability * \
+            representation_weights[cs_name]
+
+    L.debug('%s-> term probability: %s', ' ' * 8,
+            term_probability.quantize(D_PREC))
+
+    return term_probability
+
+
 def _text_retrieval_model(preparsed_data: Tuple[List[str], int], graph: PPGraph, entity: URIRef) -> D:
     """Rates entity represented as text.
 
@@ -154,7 +303,7 @@ def _text_retrieval_model(preparsed_data: Tuple[List[str], int], graph: PPGraph,
     relation, ni = preparsed_data
 
     # get text representations of the entity, theta_e
-    representations = _text_representation(graph, entity)
+    representations = _entity_text_representation(graph, entity)
 
     # precompute number of terms
     representations_lengths = {cs_name: sum(cs.values()) for
@@ -174,72 +323,33 @@ def _text_retrieval_model(preparsed_data: Tuple[List[str], int], graph: PPGraph,
     #         triple_object_text = graph.label(node)
     #     probability_collection_denominator += len(normalize_relation(triple_object_text))
 
-    # P(t|theta_c), it should depends on term t
-    # but assume it is 1/ni, according to (4), page 182
-    probability_collection = D(1) / D(ni)
-
-    # this are experimental
-    representation_weights = {
-        'attributes': D('0.4'),
-        'types': D('0.4'),
-        'links': D('0.2')
-    }
-
     # P(R | theta_e) == product(t in R) P(t | theta_w_e)
     final_probability = D('1.0')
     for t in relation:
-        L.debug('%s-> processing term %s', ' ' * 4, repr(t))
-
-        # P(t | theta_w_e) == sum(cs in representations) P(t | theta_cs_e) * P(cs)
-        term_probability = D('0.0')
-        for cs_name, cs in representations.items():
-            # tf(t,e) is the term frequency of t in the representation document of e
-            # http://mlwiki.org/index.php/TF-IDF#Term_Frequency
-            tf = cs[t]
-
-            # "Dirichlet smoothed model of the entire collection of triples"
-            # P(t|theta_c) == sum(D in theta_c)tf(t,D) / sum(D in theta_c)|D|
-            # we do not compute that, too time consuming
-            #
-            # probability_collection_nominator = D(0)
-            # for node in graph.all_nodes():
-            #     if isinstance(node, Literal):
-            #         triple_object_text = node
-            #     else:
-            #         triple_object_text = graph.label(node)
-            #     probability_collection_nominator += normalize_relation(triple_object_text).count(t)
-            # probability_collection = probability_collection_nominator / probability_collection_denominator
-
-            # P(t | theta_cs_e) == [tf(t,e) + ni*P(t|theta_c)] / [|e| + ni]
-            representation_probability = D(tf + ni * probability_collection)
-            representation_probability /= representations_lengths[cs_name] + ni
-            L.debug('%s-> probability for %s: %s (tf=%d, |e|=%d)', ' ' * 8,
-                    cs_name, representation_probability.quantize(D_PREC), tf, representations_lengths[cs_name])
-
-            # do the addition
-            term_probability += representation_probability * \
-                representation_weights[cs_name]
-
-        L.debug('%s-> term probability: %s', ' ' * 8,
-                term_probability.quantize(D_PREC))
-
         # do the multiplication
-        final_probability *= term_probability
+        final_probability *= _text_term_probability(
+            representations, representations_lengths, ni, t)
 
     L.debug('Probability: %s', final_probability)
     return final_probability
 
 
-@lru_cache(1024)
 def _triples_set_representation(graph: PPGraph, entity: URIRef) -> Set[Triple]:
+    """Cached set representation of the entity, recomputed when its triples change."""
+    return _cached_triples_set_representation(graph, entity, graph.entity_version(entity))
+
+
+@lru_cache(1024)
+def _cached_triples_set_representation(graph: PPGraph, entity: URIRef, version: int) -> Set[Triple]:
     """Creates set representation of the entity.
 
     Set contains all triples that have the entity as a subject (outlinks)
-    or an object (inlinks).
+    or an object (inlinks). Links of hubs are limited (see _entity_links).
 
     Args:
         graph: RDF triples to use (graph represents whole word we know about)
         entity: RDF entity to rank
+        version: version of the entity in the graph, only a part of the cache key
 
     Returns:
         set of RDF triples
@@ -250,25 +360,62 @@ def _triples_set_representation(graph: PPGraph, entity: URIRef) -> Set[Triple]:
     assert isinstance(graph, PPGraph), ['graph is not PPGraph', graph]
     assert isinstance(entity, URIRef), ['entity is not URIRef', entity]
 
+    return _triples_set_from_links(entity, _entity_links(graph, entity, inlinks=False),
+                                   _entity_links(graph, entity, inlinks=True))
+
+
+def _triples_set_from_links(entity: URIRef, outlinks: Links, inlinks: Links) -> Set[Triple]:
+    """Set representation from (predicate, object) outlinks and (predicate, subject) inlinks."""
     result = set()
 
     # outlinks
-    for triple_predicate, triple_object in graph.predicate_objects(subject=entity):
+    for triple_predicate, triple_object in outlinks:
         if isinstance(triple_object, Literal):
             result.add((None, triple_predicate, triple_object))
         elif isinstance(triple_object, URIRef):
             result.add((entity, triple_predicate, triple_object))
-    outlinks = len(result)
-    L.debug('%s-> outlinks: %s', ' ' * 4, outlinks)
+    outlinks_amount = len(result)
+    L.debug('%s-> outlinks: %s', ' ' * 4, outlinks_amount)
 
     # inlinks
-    for triple_subject, triple_predicate in graph.subject_predicates(object=entity):
+    for triple_predicate, triple_subject in inlinks:
         result.add((triple_subject, triple_predicate, entity))
-    L.debug('%s-> inlinks: %s', ' ' * 4, len(result) - outlinks)
+    L.debug('%s-> inlinks: %s', ' ' * 4, len(result) - outlinks_amount)
 
     return result
 
 
+def _entity_representations(graph: PPGraph, entity: URIRef) -> Tuple[Dict[str, DefaultDict[str, int]], Set[Triple]]:
+    """Text and triples set representations of the entity, reading its outlinks once.
+
+    Models ranked together (like in combined ranking) need both, computing them
+    separately reads outlinks twice (two queries with SPARQL endpoints).
+    """
+    L.debug('Computing representations of %s', entity)
+    outlinks = list(_entity_links(graph, entity, inlinks=False))
+    return (_text_representation(graph, entity, outlinks),
+            _triples_set_from_links(entity, outlinks, _entity_links(graph, entity, inlinks=True)))
+
+
+def _entity_triples_features(graph: PPGraph, entity: URIRef) -> AbstractSet[Any]:
+    """Set representation of the entity.
+
+    With the graph's feature store triples are replaced by their hashes,
+    the example-based model only compares them, so scores are the same.
+    """
+    if graph.features is not None:
+        return graph.features.triples_features(graph, entity)
+    return _triples_set_representation(graph, entity)
+
+
+def _triples_counts(representations: List[AbstractSet[Triple]]) -> CounterType[Triple]:
+    """Counts in how many representations every triple occurs."""
+    counts: CounterType[Triple] = Counter()
+    for representation in representations:
+        counts.update(representation)
+    return counts
+
+
 def _examples_preparsing(graph: PPGraph, input_data: Query) -> Dict[Triple, D]:
     """Convert example entities to frequency (number of occurences).
 
@@ -284,29 +431,27 @@ def _examples_preparsing(graph: PPGraph, input_data: Query) -> Dict[Triple, D]:
     examples_representations = []
     for example in examples:
         examples_representations.append(
-            _triples_set_representation(graph, example))
+            _entity_triples_features(graph, example))
+
+    return _examples_preparsing_from_representations(examples_representations)
+
+
+def _examples_preparsing_from_representations(examples_representations: List[AbstractSet[Triple]]) -> Dict[Triple, D]:
+    """Does the _examples_preparsing given set representations of examples."""
+    # n(tr, X) = sum(x in X) n(tr, x), n(tr, x) = 1 if tr in x else 0
+    triples_counts = _triples_counts(examples_representations)
 
-    # n(tr, x) = 1 if tr in x else 0
     # denominator of P(tr|theta_X) = denominator = sum(tr in all(x in X)) sum(x in X) n(tr, x)
-    denominator = D(0)
-    for example_representation in examples_representations:
-        for tr in example_representation:
-            for x in examples_representations:
-                if tr in x:
-                    denominator += 1
+    # every triple is counted once per example it occurs in
+    denominator = D(sum([count * count for count in triples_counts.values()]))
     L.debug('Denominator: %s', denominator)
 
     # P(e_l | theta_X) = sum(tr in X) P(e_l|tr) * P(tr|theta_X)
     # P(tr|theta_X) = sum(x in X) n(tr, x) / dem
     # we can precompute P(tr|theta_X)
     preparsed_examples = dict()
-    for example_representation in examples_representations:
-        for tr in example_representation:
-            nominator = D(0)
-            for x in examples_representations:
-                if tr in x:
-                    nominator += 1
-            preparsed_examples[tr] = nominator / denominator
+    for tr, count in triples_counts.items():
+        preparsed_examples[tr] = D(count) / denominator
 
     L.debug('-' * 20)
     return preparsed_examples
@@ -332,7 +477,7 @@ def _example_retrieval_model(preparsed_data: Dict[Triple, D], graph: PPGraph, en
     assert isinstance(entity, URIRef), ['entity is not URIRef', entity]
 
     # get set representations of the entity, e_l
-    representation = _triples_set_representation(graph, entity)
+    representation = _entity_triples_features(graph, entity)
 
     # P(e_l | theta_X) = sum(tr in X) P(e_l|tr) * P(tr|theta_X)
     # P(e_l|tr) = 1 if tr in e_l else 0
@@ -346,130 +491,560 @@ def _example_retrieval_model(preparsed_data: Dict[Triple, D], graph: PPGraph, en
     return final_probability
 
 
-def rank(input_data: Query, preparsing_function: PreparsingFunc, retrieval_model: RetrievalModel, graph: PPGraph, entities_to_rank: List[URIRef]) \
-        -> Ranking:
+class RetrievalModel:
+    """Model scoring entities for a query.
+
+    Subclasses implement preparse and either score (one entity) or score_many.
+    Rankings call score_many with batches of entities, so models can read
+    features of many entities at once, prefetch them or vectorize scoring.
+    """
+    name = ''
+    # score of an entity depends only on representations of the entity and examples,
+    # so cached scores of other entities stay valid when the graph changes
+    local_scores = False
+
+    def preparse(self, graph: PPGraph, input_data: Query) -> PreparsedData:
+        """Data computed once per query, passed to every score call."""
+        return None
+
+    def score(self, preparsed_data: PreparsedData, graph: PPGraph, entity: URIRef) -> D:
+        """Not normalized score of the entity."""
+        if type(self).score_many is RetrievalModel.score_many:
+            raise NotImplementedError(f'`{self.name}` model implements neither score nor score_many')
+        return self.score_many(preparsed_data, graph, [entity])[0]
+
+    def score_many(self, preparsed_data: PreparsedData, graph: PPGraph, entities: List[URIRef]) -> List[D]:
+        """Not normalized scores of the entities, in the same order."""
+        if type(self).score is RetrievalModel.score:
+            raise NotImplementedError(f'`{self.name}` model implements neither score nor score_many')
+        return [self.score(preparsed_data, graph, entity) for entity in entities]
+
+
+class FunctionModel(RetrievalModel):
+    """Model made of preparsing and (one entity) scoring functions."""
+
+    def __init__(self, name: str, preparsing_function: PreparsingFunc, scoring_function: ScoringFunc,
+                 local_scores: bool = False):
+        self.name = name
+        self.local_scores = local_scores
+        self._preparsing_function = preparsing_function
+        self._scoring_function = scoring_function
+
+    def preparse(self, graph: PPGraph, input_data: Query) -> PreparsedData:
+        return self._preparsing_function(graph, input_data)
+
+    def score(self, preparsed_data: PreparsedData, graph: PPGraph, entity: URIRef) -> D:
+        score = self._scoring_function(preparsed_data, graph, entity)
+        L.debug('-'*20)
+        return score
+
+
+MODELS: Dict[str, RetrievalModel] = {
+    # text scores depend on size of the graph
+    'text': FunctionModel('text', _text_preparsing, _text_retrieval_model),
+    'examples': FunctionModel('examples', _examples_preparsing, _example_retrieval_model, local_scores=True)
+}
+
+
+def register_model(model: RetrievalModel):
+    """Makes the model available by its name (in rank_model, the tool, the server and evaluation)."""
+    MODELS[model.name] = model
+
+
+def load_plugins(modules: Iterable[str]):
+    """Imports modules by name, so they can register models (or PPGraph backends)."""
+    for module in modules:
+        L.debug('Loading plugin `%s`', module)
+        import_module(module)
+
+
+def get_model(model: Union[str, RetrievalModel]) -> RetrievalModel:
+    if isinstance(model, RetrievalModel):
+        return model
+    if model not in MODELS:
+        raise ValueError(
+            f'Unknown retrieval model `{model}`, available: {", ".join(MODELS)}')
+    return MODELS[model]
+
+
+def _scoring_order(graph: PPGraph, entities: List[URIRef], known_scores: Dict[URIRef, D]) -> List[URIRef]:
+    """Entities cheapest to score first: with known scores, with stored features, with less links."""
+    features = graph.features
+    degrees = graph.degrees
+
+    def priority(entity: URIRef) -> Tuple[bool, bool, int]:
+        degree = 0
+        if degrees is not None:
+            degree = degrees.degree(entity, True) + degrees.degree(entity, False)
+        return (entity not in known_scores, features is None or entity not in features, degree)
+
+    return sorted(entities, key=priority)
+
+
+def rank(input_data: Query, model: Union[str, RetrievalModel], graph: PPGraph, entities_to_rank: List[URIRef],
+         known_scores: Optional[Dict[URIRef, D]] = None, deadline: Optional[Deadline] = None,
+         batch_size: int = RANK_BATCH_SIZE) -> Ranking:
     """Rates entities based on provided model and input query.
 
     Args:
-        input_data: query, it is passed to preparsing_function
-        preparsing_function: function that takes input_data and returns stuff for retrieval_model
-        retrieval_model: function implementing rating
+        input_data: relation (topic) and examples
+        model: retrieval model or name of a registered one
         graph: RDF triples to use
         entities_to_rank: list of entities that should be rated
+        known_scores: not normalized scores computed before for the same query and model,
+                    entities found there are not scored again; newly computed scores are added to it
+        deadline: stop scoring when it passes, entities are scored cheapest first
+                    and the ones left are added to deadline.unscored
+        batch_size: amount of entities passed to the model at once,
+                    the deadline is checked between batches
 
     Returns:
         Ordered/sorted list containing tuples: (rate, entity),
         best matching entities comes first
     """
+    ranking, examples_ranking = _scores(input_data, model, graph, entities_to_rank,
+                                        known_scores, deadline, batch_size)
+    return _finish_ranking(ranking, examples_ranking, input_data[1])
+
+
+def rank_columnar(input_data: Query, model: Union[str, RetrievalModel], graph: PPGraph,
+                  entities_to_rank: List[URIRef], known_scores: Optional[Dict[URIRef, D]] = None,
+                  deadline: Optional[Deadline] = None, batch_size: int = RANK_BATCH_SIZE) -> RankingColumns:
+    """Like rank, but normalized (float) scores are stored in ColumnarRanking, instead of a new list."""
+    ranking, examples_ranking = _scores(input_data, model, graph, entities_to_rank,
+                                        known_scores, deadline, batch_size)
+    ap, ranking_data = _normalized(ranking, examples_ranking, input_data[1])
+    return ap, ColumnarRanking.from_ranking(ranking_data)
+
+
+def _scores(input_data: Query, model: Union[str, RetrievalModel], graph: PPGraph, entities_to_rank: List[URIRef],
+            known_scores: Optional[Dict[URIRef, D]], deadline: Optional[Deadline],
+            batch_size: int) -> Tuple[List[Tuple[D, URIRef]], List[Tuple[D, URIRef]]]:
+    """Not normalized scores of ranked entities and of examples, see rank."""
+    model = get_model(model)
+    _, examples = input_data
+    L.info('Ranking %d entities with `%s` model',
+           len(entities_to_rank), model.name)
+
+    if known_scores is None:
+        known_scores = dict()
+
+    # lazily loaded graphs read triples of the query's entities now
+    graph.require(list(examples) + list(entities_to_rank))
+
+    # tiers of the graph may add triples in other threads (ebes-serve), wait for them
+    with graph.lock.read():
+        return _score_entities(input_data, model, graph, entities_to_rank, known_scores, deadline, batch_size)
+
+
+def _score_entities(input_data: Query, model: RetrievalModel, graph: PPGraph, entities_to_rank: List[URIRef],
+                    known_scores: Dict[URIRef, D], deadline: Optional[Deadline],
+                    batch_size: int) -> Tuple[List[Tuple[D, URIRef]], List[Tuple[D, URIRef]]]:
+    """Scores of the entities and examples in the graph with all required triples, see _scores."""
     _, examples = input_data
     entities_to_rank_amount = len(entities_to_rank)
     entities_to_rank_progress = max(1, entities_to_rank_amount//10)
-    L.info('Ranking %d entities', entities_to_rank_amount)
 
-    # preparse before the loop for efficiency
-    preparsed_data = preparsing_function(graph, input_data)
-    ranking_score: D
+    # preparse only if needed, it may be expensive
+    preparsed_data = None
+
+    def score_batch(entities: List[URIRef]):
+        nonlocal preparsed_data
+        missing = list(dict.fromkeys(
+            [entity for entity in entities if entity not in known_scores]))
+        if not missing:
+            return
+        if preparsed_data is None:
+            preparsed_data = model.preparse(graph, input_data)
+        known_scores.update(
+            zip(missing, model.score_many(preparsed_data, graph, missing)))
+
+    if deadline is not None:
+        # examples are needed to compute average precision, score them first
+        score_batch(examples)
+        entities_to_rank = _scoring_order(
+            graph, entities_to_rank, known_scores)
 
     # do the ranking
-    ranking: List[Tuple[D, URIRef]] = []
-    for i, entity in enumerate(entities_to_rank):
-        if i % entities_to_rank_progress == 0:
-            L.info(' ~> ranking entity no %d / %d', i, entities_to_rank_amount)
+    scored = entities_to_rank_amount
+    for start in range(0, entities_to_rank_amount, batch_size):
+        batch = entities_to_rank[start:start + batch_size]
+        # batch contains a multiple of progress step
+        if (start + len(batch) - 1) // entities_to_rank_progress > (start - 1) // entities_to_rank_progress:
+            L.info(' ~> ranking entity no %d / %d',
+                   start, entities_to_rank_amount)
+
+        if deadline is not None and deadline.expired():
+            scored = start
+            deadline.unscored.update(entities_to_rank[start:])
+            L.warning('Deadline passed, %d / %d entities not scored',
+                      entities_to_rank_amount - start, entities_to_rank_amount)
+            break
 
-        # score entity
-        ranking_score = retrieval_model(preparsed_data, graph, entity)
+        # score entities
+        score_batch(batch)
 
-        # insert and sort
-        bisect.insort_right(ranking, (ranking_score, entity))
-        L.debug('-'*20)
+    ranking = [(known_scores[entity], entity)
+               for entity in entities_to_rank[:scored]]
+
+    # rank examples themselves, for future use in combined approach
+    score_batch(examples)
+    examples_ranking = [(known_scores[entity], entity) for entity in examples]
+    return ranking, examples_ranking
+
+
+def _examples_average_precision(examples_positions: List[int], ranking_length: int) -> D:
+    """Computes average precision of examples ranked together with other entities.
+
+    Args:
+        examples_positions: positions (starting from 1) of examples in the ranking
+        ranking_length: amount of all entities in the ranking
+
+    Returns:
+        Average precision
+    """
+    examples_positions = sorted(examples_positions)
+
+    # assumed amount of relevant entities
+    if len(examples_positions) >= 10:
+        ranking_length = examples_positions[9]
+
+    found = set(examples_positions)
+    retrived_with_examples = [i in found for i in range(1, ranking_length + 1)]
+    return statistical_stats(retrived_with_examples)['AvgPrec']
+
+
+def _finish_ranking(ranking: List[Tuple[D, URIRef]], examples_ranking: List[Tuple[D, URIRef]],
+                    examples: List[URIRef]) -> Ranking:
+    """Sorts and normalizes scores, computes average precision of the examples.
+
+    Args:
+        ranking: not normalized scores of ranked entities
+        examples_ranking: not normalized scores of examples
+        examples: example entities
+
+    Returns:
+        Ranking, best matching entities comes first
+    """
+    ap, ranking_data = _normalized(ranking, examples_ranking, examples)
+    return ap, list(ranking_data)
+
+
+def _normalized(ranking: List[Tuple[D, URIRef]], examples_ranking: List[Tuple[D, URIRef]],
+                examples: List[URIRef]) -> Tuple[D, Iterator[Tuple[D, URIRef]]]:
+    """Like _finish_ranking, but normalized scores are generated, not stored.
+
+    Args:
+        ranking: not normalized scores of ranked entities
+        examples_ranking: not normalized scores of examples
+        examples: example entities
+
+    Returns:
+        average precision and generator of normalized scores, best matching entities comes first
+    """
+    ranking = sorted(ranking)
 
     # min/max normalization + best scored first
-    max_val = ranking[-1][0]
-    min_val = ranking[0][0]
+    max_val = ranking[-1][0] if ranking else D(0)
+    min_val = ranking[0][0] if ranking else D(0)
     norm_denominator = max_val - min_val
+    if norm_denominator == 0:
+        norm_denominator = D(1)
 
     # rank examples themselves, for future use in combined approach
-    ranking_with_examples = ranking[:]
-    for i, entity in enumerate(examples):
-        example_ranking = retrieval_model(preparsed_data, graph, entity)
-        bisect.insort_right(ranking_with_examples, (example_ranking, entity))
-    ranking_with_examples = ranking_with_examples[::-1]
-
-    retrived_with_examples: List[bool] = []
-    count_found_examples = 0
-    for _, entity in ranking_with_examples:
-        # assumed amount of relevant entities
-        if count_found_examples == 10:
-            break
-
-        if entity in examples:
-            count_found_examples += 1
-            retrived_with_examples.append(True)
-        else:
-            retrived_with_examples.append(False)
+    ranking_with_examples = sorted(ranking + examples_ranking)[::-1]
+    examples_positions = [i for i, (_, entity) in enumerate(ranking_with_examples, 1)
+                          if entity in examples]
 
     # average precision
-    ap = statistical_stats(retrived_with_examples)['AvgPrec']
+    ap = _examples_average_precision(
+        examples_positions, len(ranking_with_examples))
 
     L.info(" ~> normalization min = %s, max = %s", min_val, max_val)
     L.info(" ~> AP = %s", ap)
-    return ap, [((v - min_val) / norm_denominator, entity) for v, entity in ranking[::-1]]
+    return ap, (((v - min_val) / norm_denominator, entity) for v, entity in reversed(ranking))
 
 
-def rank_text_based(graph: PPGraph, input_data: Query, entities_to_rank: List[URIRef]) -> Ranking:
+def rank_model(model_name: str, graph: PPGraph, input_data: Query, entities_to_rank: List[URIRef],
+               cache: Optional[ResultCache] = None, deadline: Optional[Deadline] = None) -> Ranking:
+    """Rates entities with registered model and input query.
+
+    Args:
+        model_name: name of the model in MODELS
+        graph: RDF triples to use
+        input_data: relation (topic) and examples
+        entities_to_rank: list of entities that should be rated
+        cache: reuse rankings and scores computed before
+        deadline: return partial ranking if it passes, see rank
+
+    Returns:
+        Ordered/sorted list containing tuples: (rate, entity),
+        best matching entities comes first
+    """
+    model = get_model(model_name)
+    if cache is None:
+        return rank(input_data, model, graph, entities_to_rank, deadline=deadline)
+
+    # cached rankings are keyed by the graph version, which loading the entities changes
+    graph.require(list(input_data[1]) + list(entities_to_rank))
+    return cache.rank(model_name, graph, input_data, entities_to_rank, lambda known_scores: rank(
+        input_data, model, graph, entities_to_rank, known_scores, deadline), deadline)
+
+
+def rank_model_columnar(model_name: str, graph: PPGraph, input_data: Query, entities_to_rank: List[URIRef],
+                        cache: Optional[ResultCache] = None, deadline: Optional[Deadline] = None) -> RankingColumns:
+    """Like rank_model, but ranking data is ColumnarRanking (cached rankings are converted)."""
+    if cache is None:
+        return rank_columnar(input_data, model_name, graph, entities_to_rank, deadline=deadline)
+
+    ap, ranking_data = rank_model(model_name, graph, input_data, entities_to_rank, cache, deadline)
+    return ap, ColumnarRanking.from_ranking(ranking_data)
+
+
+def rank_text_based(graph: PPGraph, input_data: Query, entities_to_rank: List[URIRef],
+                    cache: Optional[ResultCache] = None, deadline: Optional[Deadline] = None) -> Ranking:
     """Rates entities based on text-based model and input query.
 
     Args:
         graph: RDF triples to use
         input_data: relation (topic) and examples
         entities_to_rank: list of entities that should be rated
+        cache: reuse rankings and scores computed before
+        deadline: return partial ranking if it passes, see rank
 
     Returns:
         Ordered/sorted list containing tuples: (rate, entity),
         best matching entities comes first
     """
-    return rank(input_data, _text_preparsing, _text_retrieval_model, graph, entities_to_rank)
+    return rank_model('text', graph, input_data, entities_to_rank, cache, deadline)
 
 
-def rank_examples_based(graph: PPGraph, input_data: Query, entities_to_rank: List[URIRef]) -> Ranking:
+def rank_examples_based(graph: PPGraph, input_data: Query, entities_to_rank: List[URIRef],
+                        cache: Optional[ResultCache] = None, lsh_index: Optional['MinHashLSH'] = None,
+                        min_collisions: int = LSH_MIN_COLLISIONS, deadline: Optional[Deadline] = None) -> Ranking:
     """Rates entities based on example-based (structure) model  and input query.
 
     Args:
         graph: RDF triples to use
         input_data: relation (topic) and examples
         entities_to_rank: list of entities that should be rated
+        cache: reuse rankings and scores computed before
+        lsh_index: approximate mode, score only entities colliding with examples in the index;
+                    if entities_to_rank is empty, all colliding entities are ranked
+        min_collisions: amount of LSH bands that must collide, more = faster but worse recall
+        deadline: return partial ranking if it passes, see rank
 
     Returns:
         Ordered/sorted list containing tuples: (rate, entity),
         best matching entities comes first
     """
-    return rank(input_data, _examples_preparsing, _example_retrieval_model, graph, entities_to_rank)
+    if lsh_index is not None:
+        _, examples = input_data
+        graph.require(examples)
+        with graph.lock.read():
+            entities_to_rank = lsh_index.candidates(
+                graph, examples, entities_to_rank, min_collisions)
 
+    return rank_model('examples', graph, input_data, entities_to_rank, cache, deadline)
 
-def rank_combined(rankings: Tuple[Ranking, Ranking]) -> Ranking:
-    lambda_param = D('0.5')
-    delta_param = D('0.1')
 
-    combined_ranking: DefaultDict[URIRef, D] = defaultdict(D)
+def threshold_top_k(streams: List[Iterator[Tuple[D, URIRef]]], random_access: List[Callable[[URIRef], D]],
+                    weights: List[D], k: int) -> List[Tuple[D, URIRef]]:
+    """Finds k entities with the best weighted sum of scores, using Fagin's Threshold Algorithm.
+
+    Streams are read in parallel (sorted access). Every newly seen entity is scored fully
+    with random access to other models. Reading stops as soon as k-th best score is not
+    worse than the threshold - weighted sum of the last scores read from every stream,
+    which bounds the score of any entity not seen yet.
+
+    It saves work only if streams are produced lazily and random access is cheap
+    (like scores looked up in a store), merging fully scored rankings is not faster
+    than combine_scores.
+
+    Args:
+        streams: scores of every model, sorted - best first
+        random_access: functions returning the score of an entity in every model
+                    (zero if the model didn't score the entity)
+        weights: weight of every model
+        k: amount of entities to return
 
+    Returns:
+        Ordered/sorted list containing tuples: (rate, entity),
+        best matching entities comes first
+    """
+    top: List[Tuple[D, URIRef]] = []  # min-heap
+    seen: Set[URIRef] = set()
+    last_scores = [D(0)] * len(streams)
+    exhausted = [False] * len(streams)
+    sorted_accesses = 0
+
+    while not all(exhausted):
+        for i, stream in enumerate(streams):
+            if exhausted[i]:
+                continue
+
+            item = next(stream, None)
+            if item is None:
+                # unseen entities are not scored by this model
+                exhausted[i] = True
+                last_scores[i] = D(0)
+                continue
+
+            sorted_accesses += 1
+            score, entity = item
+            last_scores[i] = score
+            if entity in seen:
+                continue
+            seen.add(entity)
+
+            total_score = D(0)
+            for j, weight in enumerate(weights):
+                model_score = score if j == i else random_access[j](entity)
+                total_score += model_score * weight
+
+            if len(top) < k:
+                heapq.heappush(top, (total_score, entity))
+            elif total_score > top[0][0]:
+                heapq.heapreplace(top, (total_score, entity))
+
+        threshold = sum([last * weight for last,
+                         weight in zip(last_scores, weights)])
+        if len(top) == k and top[0][0] >= threshold:
+            break
+
+    L.info(' ~> threshold algorithm stopped after %d sorted accesses, %d entities seen',
+           sorted_accesses, len(seen))
+    return sorted(top, reverse=True)
+
+
+def rank_combined(rankings: Tuple[Ranking, Ranking], top_k: Optional[int] = None,
+                  lambda_param: D = COMBINED_LAMBDA, delta_param: D = COMBINED_DELTA,
+                  deadline: Optional[Deadline] = None) -> Ranking:
+    """Combines text-based and example-based rankings.
+
+    Args:
+        rankings: text-based and example-based rankings of the same entities
+        top_k: return only that many best entities
+        lambda_param: weight of example-based scores (text-based get 1 - lambda_param)
+        delta_param: if overlap of examples average precisions is lower,
+                    only the better ranking is used
+        deadline: deadline the rankings were computed with, entities not scored in time
+                    by any of them are skipped, so they are not favoured by the other model
+
+    Returns:
+        Ordered/sorted list containing tuples: (rate, entity),
+        best matching entities comes first
+    """
     ranking_text, ranking_example = rankings
     ap_example, ranking_example_data = ranking_example
     ap_text, ranking_text_data = ranking_text
-    overlap = min(ap_example, ap_text) / max(ap_example, ap_text)
+    if deadline is not None and deadline.partial:
+        ranking_example_data = [(v, entity) for v, entity in ranking_example_data
+                                if entity not in deadline.unscored]
+        ranking_text_data = [(v, entity) for v, entity in ranking_text_data
+                             if entity not in deadline.unscored]
+    overlap = rankings_overlap(ap_text, ap_example)
 
     L.info("Overlap = %s", overlap)
 
     if overlap < delta_param and ap_example > ap_text:
-        return ap_example, ranking_example_data
+        return ap_example, ranking_example_data[:top_k]
 
     elif overlap < delta_param and ap_example < ap_text:
-        return ap_text, ranking_text_data
+        return ap_text, ranking_text_data[:top_k]
 
     else:
-        for v, entity in ranking_example_data:
-            combined_ranking[entity] += v * lambda_param
+        return D(1), combine_scores(ranking_text_data, ranking_example_data, lambda_param)[:top_k]
+
+
+def rank_combined_columnar(rankings: Tuple[RankingColumns, RankingColumns], top_k: Optional[int] = None,
+                           lambda_param: D = COMBINED_LAMBDA, delta_param: D = COMBINED_DELTA) -> RankingColumns:
+    """Combines columnar text-based and example-based rankings, like rank_combined (float scores)."""
+    (ap_text, ranking_text_data), (ap_example, ranking_example_data) = rankings
+    overlap = rankings_overlap(ap_text, ap_example)
+
+    L.info("Overlap = %s", overlap)
+
+    if overlap < delta_param and ap_example > ap_text:
+        return ap_example, ranking_example_data[:top_k]
+
+    elif overlap < delta_param and ap_example < ap_text:
+        return ap_text, ranking_text_data[:top_k]
+
+    return D(1), combine_columnar(ranking_text_data, ranking_example_data, float(lambda_param))[:top_k]
+
+
+def rank_cascade(graph: PPGraph, input_data: Query, entities_to_rank: List[URIRef], top_n: int = CASCADE_TOP_N,
+                 cache: Optional[ResultCache] = None, deadline: Optional[Deadline] = None,
+                 top_k: Optional[int] = None, lsh_index: Optional['MinHashLSH'] = None,
+                 min_collisions: int = LSH_MIN_COLLISIONS) -> Tuple[Ranking, Ranking, Ranking]:
+    """Combined ranking where the text-based model scores only the best entities of the example-based one.
+
+    Example-based scores are cheap (set overlaps of cached representations), text-based ones
+    need labels of all linked entities. Entities below top_n of the example-based ranking
+    are dropped, recall of the first stage is the quality cost (see `benchmark.py cascade`).
+
+    Args:
+        graph: RDF triples to use
+        input_data: relation (topic) and examples
+        entities_to_rank: list of entities that should be rated
+        top_n: amount of entities passed to the text-based model
+        cache: reuse rankings and scores computed before
+        deadline: return partial rankings if it passes, see rank
+        top_k: return only that many best entities in the combined ranking
+        lsh_index: approximate first stage, see rank_examples_based
+        min_collisions: amount of LSH bands that must collide
+
+    Returns:
+        text-based ranking of top_n entities, example-based ranking of all entities
+        and combined ranking of top_n entities (example-based scores normalized again over them)
+    """
+    from example_based_entity_search.feature_store import shared_features
+
+    # both models read representations built with one pass over triples of the entities
+    with shared_features(graph):
+        ranking_example = rank_examples_based(graph, input_data, entities_to_rank, cache, lsh_index, min_collisions,
+                                              deadline=deadline.part(0.5) if deadline is not None else None)
+        ap_example, ranking_example_data = ranking_example
+        shortlist = [entity for _, entity in ranking_example_data[:top_n]]
+        L.info('Cascade: text-based scoring of %d / %d entities',
+               len(shortlist), len(ranking_example_data))
+
+        ranking_text = rank_text_based(
+            graph, input_data, shortlist, cache, deadline)
+
+    # text-based scores are normalized over the shortlist, example-based ones must be too
+    ranking_combined = rank_combined(
+        (ranking_text, (ap_example, _renormalized(ranking_example_data[:top_n]))), top_k, deadline=deadline)
+    return ranking_text, ranking_example, ranking_combined
+
+
+def _renormalized(ranking_data: List[Tuple[D, URIRef]]) -> List[Tuple[D, URIRef]]:
+    """Min/max normalization of a part of sorted ranking (best entities first)."""
+    if not ranking_data:
+        return []
+    max_val, min_val = ranking_data[0][0], ranking_data[-1][0]
+    norm_denominator = max_val - min_val
+    if norm_denominator == 0:
+        norm_denominator = D(1)
+    return [((v - min_val) / norm_denominator, entity) for v, entity in ranking_data]
+
+
+def rankings_overlap(ap_text: D, ap_example: D) -> D:
+    """Ratio of worse to better average precision of examples."""
+    if max(ap_example, ap_text) > 0:
+        return min(ap_example, ap_text) / max(ap_example, ap_text)
+    return D(0)
+
+
+def combine_scores(ranking_text_data: List[Tuple[D, URIRef]], ranking_example_data: List[Tuple[D, URIRef]],
+                   lambda_param: D) -> List[Tuple[D, URIRef]]:
+    """Weighted sum of normalized scores, sorted."""
+    combined_ranking: DefaultDict[URIRef, D] = defaultdict(D)
+    for v, entity in ranking_example_data:
+        combined_ranking[entity] += v * lambda_param
 
-        for v, entity in ranking_text_data:
-            combined_ranking[entity] += v * (1 - lambda_param)
+    for v, entity in ranking_text_data:
+        combined_ranking[entity] += v * (1 - lambda_param)
 
-        return D(1), [(v, k) for k, v in sorted(combined_ranking.items(), key=lambda item: item[1], reverse=True)]
+    return [(v, k) for k, v in sorted(combined_ranking.items(), key=lambda item: item[1], reverse=True)]
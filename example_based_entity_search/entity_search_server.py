@@ -0,0 +1,455 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Long-running ranking server with JSON API.
+
+    The graph is loaded once and rankings are computed by a pool of workers.
+
+    Endpoints:
+        GET  /health          - liveness and graph info
+        GET  /metrics         - requests counters and latencies
+        POST /rank/text       - text-based ranking
+        POST /rank/examples   - example-based ranking
+        POST /rank/combined   - combined ranking
+        POST /rank/<model>    - ranking with any other registered retrieval model (see entity_search_lib.MODELS)
+        POST /rank/similar    - entities similar to examples, from neighbours graph (knn.py)
+
+    Ranking requests take JSON like:
+        {"topic": "...", "examples": ["http://..."], "candidates": ["http://..."], "top_k": 10,
+         "min_shared_types": 1, "min_collisions": 1, "deadline": 0.5}
+    where `top_k`, `min_shared_types`, `min_collisions` and `deadline` are optional. The second prunes
+    candidates not sharing enough types and categories with examples (requires server started with `--type_index`).
+    The third overrides server's `--min_collisions`: amount of LSH bands in which entities scored by
+    the example-based model collide with examples (requires server started with `--lsh`).
+    The last one (seconds, defaults to server's `--deadline`) makes the server return the best ranking
+    found in time, with "partial": true and "unscored" list of entities that were not scored.
+
+    Similar entities requests take JSON like:
+        {"examples": ["http://..."], "top_k": 10, "rescore": false}
+    where neighbours of examples are merged, and re-scored exactly with the graph if `rescore` is true
+    (requires server started with `--knn`).
+
+    Author: Paweł Płatek
+"""
+
+
+import argparse
+import json
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from sys import exit
+from threading import Lock
+from time import monotonic
+from typing import (TYPE_CHECKING, Any, Callable, DefaultDict, Dict, List,
+                    Optional, Tuple)
+
+from example_based_entity_search.config import (CACHE_MAX_SIZE, CACHE_TTL,
+                                                LSH_MIN_COLLISIONS,
+                                                SERVER_DEADLINE, SERVER_HOST,
+                                                SERVER_PORT, SERVER_TIMEOUT,
+                                                SERVER_WORKERS, L)
+
+# rdflib and the lib take most of the startup time, they are imported
+# where needed, after arguments are parsed (`--help` needs none of them)
+if TYPE_CHECKING:
+    from rdflib import URIRef
+
+    from example_based_entity_search.cache import ResultCache
+    from example_based_entity_search.deadline import Deadline
+    from example_based_entity_search.entity_search_lib import Ranking
+    from example_based_entity_search.knn import NeighbourGraph
+    from example_based_entity_search.lsh import MinHashLSH
+    from example_based_entity_search.posting_lists import TypeIndex
+    from example_based_entity_search.utils import PPGraph
+
+
+def _rank_text(graph: 'PPGraph', input_data: Tuple[str, List['URIRef']], entities_to_rank: List['URIRef'],
+               cache: Optional['ResultCache'] = None, top_k: Optional[int] = None,
+               deadline: Optional['Deadline'] = None, lsh_index: Optional['MinHashLSH'] = None,
+               min_collisions: int = LSH_MIN_COLLISIONS) -> 'Ranking':
+    from example_based_entity_search.entity_search_lib import rank_text_based
+    ap, ranking = rank_text_based(
+        graph, input_data, entities_to_rank, cache, deadline)
+    return ap, ranking[:top_k]
+
+
+def _rank_examples(graph: 'PPGraph', input_data: Tuple[str, List['URIRef']], entities_to_rank: List['URIRef'],
+                   cache: Optional['ResultCache'] = None, top_k: Optional[int] = None,
+                   deadline: Optional['Deadline'] = None, lsh_index: Optional['MinHashLSH'] = None,
+                   min_collisions: int = LSH_MIN_COLLISIONS) -> 'Ranking':
+    from example_based_entity_search.entity_search_lib import \
+        rank_examples_based
+    ap, ranking = rank_examples_based(
+        graph, input_data, entities_to_rank, cache, lsh_index, min_collisions, deadline=deadline)
+    return ap, ranking[:top_k]
+
+
+def _rank_combined(graph: 'PPGraph', input_data: Tuple[str, List['URIRef']], entities_to_rank: List['URIRef'],
+                   cache: Optional['ResultCache'] = None, top_k: Optional[int] = None,
+                   deadline: Optional['Deadline'] = None, lsh_index: Optional['MinHashLSH'] = None,
+                   min_collisions: int = LSH_MIN_COLLISIONS) -> 'Ranking':
+    from example_based_entity_search.entity_search_lib import (
+        rank_combined, rank_examples_based, rank_text_based)
+
+    # half of the time for text-based model, the rest for example-based one
+    ranking_text = rank_text_based(graph, input_data, entities_to_rank, cache,
+                                   deadline.part(0.5) if deadline is not None else None)
+    ranking_example = rank_examples_based(
+        graph, input_data, entities_to_rank, cache, lsh_index, min_collisions, deadline=deadline)
+    return rank_combined((ranking_text, ranking_example), top_k, deadline=deadline)
+
+
+def _ranker(model_name: str) -> Callable[..., 'Ranking']:
+    """Ranker of registered model, with the same arguments as RANKERS (LSH index is not used)."""
+    def ranker(graph: 'PPGraph', input_data: Tuple[str, List['URIRef']], entities_to_rank: List['URIRef'],
+               cache: Optional['ResultCache'] = None, top_k: Optional[int] = None,
+               deadline: Optional['Deadline'] = None, lsh_index: Optional['MinHashLSH'] = None,
+               min_collisions: int = LSH_MIN_COLLISIONS) -> 'Ranking':
+        from example_based_entity_search.entity_search_lib import rank_model
+        ap, ranking = rank_model(
+            model_name, graph, input_data, entities_to_rank, cache, deadline)
+        return ap, ranking[:top_k]
+    return ranker
+
+
+RANKERS: Dict[str, Callable[..., 'Ranking']] = {
+    'text': _rank_text,
+    'examples': _rank_examples,
+    'combined': _rank_combined
+}
+
+
+class ServerMetrics:
+    """Thread-safe counters of served requests."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.started = monotonic()
+        self.in_flight = 0
+        self.requests: DefaultDict[str, int] = defaultdict(int)
+        self.statuses: DefaultDict[int, int] = defaultdict(int)
+        self.timeouts = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def request_started(self, endpoint: str):
+        with self._lock:
+            self.in_flight += 1
+            self.requests[endpoint] += 1
+
+    def request_finished(self, status: int, latency: float):
+        with self._lock:
+            self.in_flight -= 1
+            self.statuses[status] += 1
+            if status == 504:
+                self.timeouts += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            finished = sum(self.statuses.values())
+            return {
+                'uptime': monotonic() - self.started,
+                'in_flight': self.in_flight,
+                'requests': dict(self.requests),
+                'statuses': {str(k): v for k, v in self.statuses.items()},
+                'timeouts': self.timeouts,
+                'latency_mean': self.latency_total / finished if finished else 0.0,
+                'latency_max': self.latency_max
+            }
+
+
+class RankingServer(ThreadingMixIn, HTTPServer):
+    """HTTP server that shares one graph between all requests.
+
+    Every connection is handled in its own thread, but rankings are computed
+    in a bounded pool of workers, so at most `workers` queries run at once.
+    """
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], graph: 'PPGraph',
+                 workers: int = SERVER_WORKERS, timeout: float = SERVER_TIMEOUT,
+                 cache: Optional['ResultCache'] = None, type_index: Optional['TypeIndex'] = None,
+                 neighbours: Optional['NeighbourGraph'] = None, deadline: Optional[float] = SERVER_DEADLINE,
+                 lsh_index: Optional['MinHashLSH'] = None, min_collisions: int = LSH_MIN_COLLISIONS):
+        super().__init__(address, RankingRequestHandler)
+        self.graph = graph
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.request_timeout = timeout
+        self.deadline = deadline
+        self.metrics = ServerMetrics()
+        self.cache = cache
+        self.type_index = type_index
+        self.neighbours = neighbours
+        self.lsh_index = lsh_index
+        self.min_collisions = min_collisions
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+
+class RankingRequestHandler(BaseHTTPRequestHandler):
+    server: RankingServer
+
+    def log_message(self, format, *args):
+        L.debug('%s - %s', self.address_string(), format % args)
+
+    def send_json(self, status: int, data: Dict[str, Any]):
+        body = json.dumps(data).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {'status': 'ok', 'graph_size': self.server.graph.size})
+        elif self.path == '/metrics':
+            metrics = self.server.metrics.to_dict()
+            if self.server.cache is not None:
+                metrics['cache'] = self.server.cache.stats()
+            self.send_json(200, metrics)
+        else:
+            self.send_json(404, {'error': f'Unknown endpoint `{self.path}`'})
+
+    def do_POST(self):
+        from example_based_entity_search.entity_search_lib import MODELS
+
+        prefix = '/rank/'
+        ranker_name = self.path[len(prefix):]
+        if not self.path.startswith(prefix) or \
+                (ranker_name not in RANKERS and ranker_name not in MODELS and ranker_name != 'similar'):
+            self.send_json(404, {'error': f'Unknown endpoint `{self.path}`'})
+            return
+
+        self.server.metrics.request_started(self.path)
+        start = monotonic()
+        if ranker_name == 'similar':
+            status, response = self.handle_similar()
+        else:
+            status, response = self.handle_ranking(
+                RANKERS.get(ranker_name) or _ranker(ranker_name))
+        took = monotonic() - start
+        response['took'] = took
+        self.server.metrics.request_finished(status, took)
+        self.send_json(status, response)
+
+    def _run(self, function: Callable, *args, deadline: Optional['Deadline'] = None) -> Tuple[int, Dict[str, Any]]:
+        """Runs the ranking in the workers pool, with timeout."""
+        from example_based_entity_search.utils import ranking_to_dict
+
+        future = self.server.executor.submit(function, *args)
+        try:
+            ranking = future.result(timeout=self.server.request_timeout)
+        except FutureTimeoutError:
+            # worker can't be interrupted, it will finish in the background
+            future.cancel()
+            L.warning('Request timed out after %s seconds', self.server.request_timeout)
+            return 504, {'error': 'Ranking timed out'}
+        except Exception as e:
+            L.error('Error when ranking: %s', e)
+            return 500, {'error': 'Error when ranking'}
+
+        response = ranking_to_dict(ranking)
+        if deadline is not None and deadline.partial:
+            response['partial'] = True
+            response['unscored'] = deadline.unscored_list()
+        return 200, response
+
+    def handle_similar(self) -> Tuple[int, Dict[str, Any]]:
+        from rdflib import URIRef
+
+        try:
+            if self.server.neighbours is None:
+                raise SyntaxError('server was started without neighbours graph')
+            content_length = int(self.headers.get('Content-Length', 0))
+            query = json.loads(self.rfile.read(content_length).decode('utf8'))
+            if not isinstance(query, dict) or not isinstance(query.get('examples'), list):
+                raise SyntaxError('`examples` list not found in query')
+            if not all([isinstance(example, str) for example in query['examples']]):
+                raise SyntaxError('`examples` must be a list of URIs')
+            examples = list(map(URIRef, query['examples']))
+            top_k = query.get('top_k')
+            if top_k is not None and (not isinstance(top_k, int) or isinstance(top_k, bool) or top_k < 1):
+                raise SyntaxError('`top_k` must be a positive integer')
+            graph = self.server.graph if query.get('rescore') else None
+        except (ValueError, SyntaxError) as e:
+            return 400, {'error': f'Bad query: {e}'}
+
+        return self._run(self.server.neighbours.rank, examples, graph, top_k)
+
+    def handle_ranking(self, ranker: Callable) -> Tuple[int, Dict[str, Any]]:
+        from example_based_entity_search.deadline import Deadline
+        from example_based_entity_search.utils import data_from_dict
+
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+            query = json.loads(self.rfile.read(content_length).decode('utf8'))
+            topic, examples, entities_to_rank = data_from_dict(query)
+            top_k = query.get('top_k')
+            if top_k is not None and (not isinstance(top_k, int) or isinstance(top_k, bool) or top_k < 1):
+                raise SyntaxError('`top_k` must be a positive integer')
+            min_shared_types = query.get('min_shared_types')
+            if min_shared_types is not None:
+                if not isinstance(min_shared_types, int) or isinstance(min_shared_types, bool) or min_shared_types < 1:
+                    raise SyntaxError('`min_shared_types` must be a positive integer')
+                if self.server.type_index is None:
+                    raise SyntaxError('server was started without types index')
+            min_collisions = query.get('min_collisions', self.server.min_collisions)
+            if 'min_collisions' in query:
+                if not isinstance(min_collisions, int) or isinstance(min_collisions, bool) or min_collisions < 1:
+                    raise SyntaxError('`min_collisions` must be a positive integer')
+                if self.server.lsh_index is None:
+                    raise SyntaxError('server was started without LSH index')
+            timeout = query.get('deadline', self.server.deadline)
+            if timeout is not None and (not isinstance(timeout, (int, float)) or isinstance(timeout, bool) or timeout <= 0):
+                raise SyntaxError('`deadline` must be a positive number of seconds')
+        except (ValueError, SyntaxError) as e:
+            return 400, {'error': f'Bad query: {e}'}
+
+        # counted from now, time spent waiting for a worker is included
+        deadline = Deadline(timeout) if timeout is not None else None
+
+        type_index = self.server.type_index
+        if min_shared_types is not None and type_index is not None:
+            # tiers add triples of the examples, other workers may be ranking meanwhile
+            self.server.graph.require(examples)
+            with self.server.graph.lock.read():
+                entities_to_rank = type_index.candidates(
+                    self.server.graph, examples, entities_to_rank, min_shared_types)
+
+        return self._run(ranker, self.server.graph, (topic, examples), entities_to_rank, self.server.cache, top_k,
+                         deadline, self.server.lsh_index, min_collisions, deadline=deadline)
+
+
+def main():
+    """Server entry point"""
+    # cmd line args
+    parser = argparse.ArgumentParser(description='Serve entities rankings')
+    parser.add_argument(
+        'triples_data',
+        help='Path to directory with triple files or path to triple file (or snapshot) or SPARQL endpoint url')
+    parser.add_argument('--host', default=SERVER_HOST, help='Address to listen on')
+    parser.add_argument('--port', default=SERVER_PORT, type=int, help='Port to listen on')
+    parser.add_argument('--workers', default=SERVER_WORKERS, type=int,
+                        help='Amount of rankings computed concurrently')
+    parser.add_argument('--timeout', default=SERVER_TIMEOUT, type=float,
+                        help='Request timeout in seconds')
+    parser.add_argument('--deadline', default=SERVER_DEADLINE, type=float,
+                        help='Return partial rankings after that many seconds (queries may override it)')
+    parser.add_argument('--cache_size', default=CACHE_MAX_SIZE, type=int,
+                        help='Amount of cached rankings, 0 disables the cache')
+    parser.add_argument('--cache_ttl', default=CACHE_TTL, type=float,
+                        help='Time to live of cached rankings in seconds')
+    parser.add_argument('--save_snapshot',
+                        help='Save loaded graph to the file, to speed up next start')
+    parser.add_argument('--type_index',
+                        help='Types posting lists (from posting_lists.py) for `min_shared_types` pruning')
+    parser.add_argument('--knn',
+                        help='Neighbours graph (from knn.py) for `/rank/similar` queries')
+    parser.add_argument('--lsh',
+                        help='MinHash LSH index (from lsh.py), the example-based model scores only '
+                        'entities colliding with examples')
+    parser.add_argument('--min_collisions', default=LSH_MIN_COLLISIONS, type=int,
+                        help='Amount of LSH bands colliding with an example (queries may override it)')
+    parser.add_argument('--features',
+                        help='Feature store directory, to reuse entities representations between runs')
+    parser.add_argument('--plugin', action='append', default=[],
+                        help='Module to import first, f.e. registering retrieval models (can be repeated)')
+    parser.add_argument("-v", "--verbose", help="debug output",
+                        action="store_true")
+
+    # args parsing and sanity checks
+    args = parser.parse_args()
+
+    L.setLevel('INFO')
+    if args.verbose:
+        L.setLevel('DEBUG')
+
+    from example_based_entity_search.cache import ResultCache
+    from example_based_entity_search.entity_search_lib import load_plugins
+    from example_based_entity_search.feature_store import FeatureStore
+    from example_based_entity_search.knn import NeighbourGraph
+    from example_based_entity_search.lsh import MinHashLSH
+    from example_based_entity_search.posting_lists import TypeIndex
+    from example_based_entity_search.utils import load_data, save_snapshot
+
+    try:
+        load_plugins(args.plugin)
+    except ImportError as e:
+        L.error('Error when loading plugin: %s', e)
+        return 1
+
+    # triples graph
+    try:
+        graph = load_data(args.triples_data)
+    except Exception as e:
+        L.error('Error when loading data from `%s`: %s', args.triples_data, e)
+        return 1
+
+    if args.save_snapshot:
+        try:
+            save_snapshot(graph, args.save_snapshot)
+        except Exception as e:
+            L.error('Error when saving snapshot to `%s`: %s', args.save_snapshot, e)
+            return 1
+
+    if args.features:
+        try:
+            FeatureStore.for_graph(args.features, graph)
+        except OSError as e:
+            L.error('Error when opening feature store `%s`: %s', args.features, e)
+            return 1
+
+    cache = None
+    if args.cache_size > 0:
+        cache = ResultCache(args.cache_size, args.cache_ttl)
+
+    type_index = None
+    if args.type_index:
+        try:
+            type_index = TypeIndex.load(args.type_index)
+        except Exception as e:
+            L.error('Error when loading types index from `%s`: %s', args.type_index, e)
+            return 1
+
+    neighbours = None
+    if args.knn:
+        try:
+            neighbours = NeighbourGraph(args.knn)
+        except Exception as e:
+            L.error('Error when loading neighbours graph from `%s`: %s', args.knn, e)
+            return 1
+
+    lsh_index = None
+    if args.lsh:
+        try:
+            lsh_index = MinHashLSH.load(args.lsh)
+        except Exception as e:
+            L.error('Error when loading LSH index from `%s`: %s', args.lsh, e)
+            return 1
+
+    server = RankingServer((args.host, args.port), graph, workers=args.workers,
+                           timeout=args.timeout, cache=cache, type_index=type_index,
+                           neighbours=neighbours, deadline=args.deadline,
+                           lsh_index=lsh_index, min_collisions=args.min_collisions)
+    L.info('Serving on http://%s:%d/', args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        L.info('Shutting down')
+    finally:
+        server.server_close()
+        if graph.features is not None:
+            graph.features.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
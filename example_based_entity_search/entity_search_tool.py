@@ -2,41 +2,100 @@
 # -*- coding: utf-8 -*-
 """Rank RDF entities based on query (plain text relation and example entities).
 
+    Batch mode reads queries from JSON lines file, like:
+        {"topic": "...", "examples": ["http://..."], "candidates": ["http://..."],
+         "models": ["text", "examples", "combined"], "top_k": 10, "id": "anything", "deadline": 0.5,
+         "min_collisions": 1}
+    where `models` (names of registered retrieval models and "combined"), `top_k`, `id`, `deadline`
+    and `min_collisions` (requires `--lsh`) are optional. Results are written as JSON lines
+    (in order of completion), each with line number of the query. Rankings not finished
+    before the deadline (seconds) have "partial": true and "unscored" list of entities.
+
     Author: Paweł Płatek
 """
 
 
 import argparse
+import json
+import sys
 from decimal import Decimal as D
-from sys import exit
-from typing import List, Optional, Tuple
-
-from rdflib import URIRef
+from typing import (TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Set,
+                    TextIO, Tuple)
+
+from example_based_entity_search.config import (BATCH_WORKERS,
+                                                CASCADE_TOP_N, D_PREC,
+                                                LSH_MIN_COLLISIONS,
+                                                SPARQL_ENDPOINT, URI_PREFIX,
+                                                L)
+
+# rdflib and the lib take most of the startup time, they are imported
+# where needed, after arguments are parsed (`--help` needs none of them)
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+
+    from rdflib import URIRef
+
+    from example_based_entity_search.cache import ResultCache
+    from example_based_entity_search.entity_search_lib import Ranking
+    from example_based_entity_search.lsh import MinHashLSH
+    from example_based_entity_search.utils import BackgroundLoader, PPGraph
+
+BATCH_MODELS = ['text', 'examples', 'combined']  # default ones
+
+
+def do_all_rankings(graph: 'PPGraph', topic: str, examples: List['URIRef'], entities_to_rank: List['URIRef'], relevant: List['URIRef'] = None,
+                    cache: Optional['ResultCache'] = None, timeout: Optional[float] = None, cascade: Optional[int] = None,
+                    lsh_index: Optional['MinHashLSH'] = None, min_collisions: int = LSH_MIN_COLLISIONS):
+    """Ranks entities and prints results, partial ones if they take longer than timeout seconds.
+
+    With cascade, the text-based model ranks only that many best entities of the example-based ranking.
+    With lsh_index, the example-based model scores only entities colliding with examples.
+    """
+    from example_based_entity_search.deadline import Deadline
+    from example_based_entity_search.entity_search_lib import (
+        rank_cascade, rank_combined, rank_examples_based, rank_text_based)
+    from example_based_entity_search.feature_store import shared_features
+
+    deadline = Deadline(timeout) if timeout is not None else None
+
+    if cascade is not None:
+        rankings = rank_cascade(graph, (topic, examples), entities_to_rank, cascade, cache, deadline,
+                                lsh_index=lsh_index, min_collisions=min_collisions)
+        print_rankings(rankings, relevant)
+        print(f'Cascade, text-based model ranked {len(rankings[0][1])} / {len(rankings[1][1])} entities')
+        if deadline is not None and deadline.partial:
+            print(f'Partial ranking, {len(deadline.unscored)} entities not scored in time')
+        return
 
-from example_based_entity_search.config import D_PREC, URI_PREFIX, L
-from example_based_entity_search.entity_search_lib import (rank_combined,
-                                                           rank_examples_based,
-                                                           rank_text_based)
-from example_based_entity_search.utils import (PPGraph, data_from_sample_file,
-                                               load_data, statistical_stats)
+    # make the rankings, half of the time for text-based model
+    # both models read representations built with one pass over triples of the entities
+    with shared_features(graph):
+        ranking_text = rank_text_based(graph, (topic, examples), entities_to_rank, cache,
+                                       deadline.part(0.5) if deadline is not None else None)
+        ranking_example = rank_examples_based(
+            graph, (topic, examples), entities_to_rank, cache, lsh_index, min_collisions, deadline=deadline)
+    ranking_combined = rank_combined(
+        (ranking_text, ranking_example), deadline=deadline)
 
+    # and print the results
+    print_rankings((ranking_text, ranking_example, ranking_combined), relevant)
+    if deadline is not None and deadline.partial:
+        print(f'Partial ranking, {len(deadline.unscored)} entities not scored in time')
 
-def do_all_rankings(graph: PPGraph, topic: str, examples: List[URIRef], entities_to_rank: List[URIRef], relevant: List[URIRef] = None):
-    """Ranks entities and prints results."""
-    # make the rankings
-    ranking_text = rank_text_based(graph, (topic, examples), entities_to_rank)
-    ranking_example = rank_examples_based(
-        graph, (topic, examples), entities_to_rank)
-    ranking_combined = rank_combined((ranking_text, ranking_example))
 
-    # and print the results
+def print_rankings(rankings: Tuple['Ranking', 'Ranking', 'Ranking'], relevant: Optional[List['URIRef']] = None):
+    """Prints text-based, example-based and combined rankings."""
+    ranking_text, ranking_example, ranking_combined = rankings
     print_ranking('text-based', ranking_text[1], relevant)
     print_ranking('example-based', ranking_example[1], relevant)
     print_ranking('combined', ranking_combined[1], relevant)
 
 
-def print_ranking(name: str, ranking: List[Tuple[D, URIRef]], relevant: Optional[List[URIRef]] = None):
+def print_ranking(name: str, ranking: List[Tuple[D, 'URIRef']], relevant: Optional[List['URIRef']] = None):
     """Prints ranking. If relevant entities are provided, also prints statistics."""
+    from example_based_entity_search.columnar import relevance
+    from example_based_entity_search.utils import statistical_stats
+
     print('-'*30)
     print(f'Ranking - {name}:')
     if not relevant:
@@ -47,46 +106,262 @@ def print_ranking(name: str, ranking: List[Tuple[D, URIRef]], relevant: Optional
     # how many top entities we would return in ideal case
     # paper sets this to 100
     evaluation_limit = len(relevant)
-    retrived: List[bool] = []
-    for i, (ranking_score, entity) in enumerate(ranking):
-        if entity in relevant:
-            if i < evaluation_limit:
-                retrived.append(True)
-            print(f' OO {entity} - {ranking_score}')
-        else:
-            if i < evaluation_limit:
-                retrived.append(False)
-            print(f' xx {entity} - {ranking_score}')
+    retrived = relevance(ranking, relevant)
+    for is_relevant, (ranking_score, entity) in zip(retrived, ranking):
+        print(f' {"OO" if is_relevant else "xx"} {entity} - {ranking_score}')
 
     print('~'*10)
-    stats = statistical_stats(retrived)
+    stats = statistical_stats(retrived[:evaluation_limit])
     for k, v in stats.items():
         print(f' {k} -> {v.quantize(D_PREC)}')
 
 
-def shell(graph: PPGraph):
-    """Run interactive query shell."""
+def rank_query(graph: 'PPGraph', query: Dict[str, Any], cache: Optional['ResultCache'] = None,
+               timeout: Optional[float] = None, lsh_index: Optional['MinHashLSH'] = None,
+               min_collisions: int = LSH_MIN_COLLISIONS) -> Dict[str, Any]:
+    """Ranks entities from a batch query with requested models.
+
+    Args:
+        graph: RDF triples to use
+        query: decoded JSON line
+        cache: reuse rankings and scores computed before
+        timeout: default deadline of the query, in seconds
+        lsh_index: approximate example-based ranking, see rank_examples_based
+        min_collisions: default amount of LSH bands that must collide
+
+    Returns:
+        rankings (as dictionaries) by model name
+    """
+    from example_based_entity_search.deadline import Deadline
+    from example_based_entity_search.entity_search_lib import (
+        MODELS, rank_combined, rank_examples_based, rank_model,
+        rank_text_based)
+    from example_based_entity_search.utils import (data_from_dict,
+                                                   ranking_to_dict)
+
+    topic, examples, entities_to_rank = data_from_dict(query)
+
+    models = query.get('models', BATCH_MODELS)
+    available = list(MODELS) + ['combined']
+    if not isinstance(models, list) or len(models) == 0 or \
+            not all([model in available for model in models]):
+        raise SyntaxError(
+            f'`models` must be a list of: {", ".join(available)}')
+
+    top_k = query.get('top_k')
+    if top_k is not None and (not isinstance(top_k, int) or isinstance(top_k, bool) or top_k < 1):
+        raise SyntaxError('`top_k` must be a positive integer')
+
+    if 'min_collisions' in query:
+        min_collisions = query['min_collisions']
+        if not isinstance(min_collisions, int) or isinstance(min_collisions, bool) or min_collisions < 1:
+            raise SyntaxError('`min_collisions` must be a positive integer')
+        if lsh_index is None:
+            raise SyntaxError('ranking without LSH index (see `--lsh`)')
+
+    timeout = query.get('deadline', timeout)
+    if timeout is not None and (not isinstance(timeout, (int, float)) or isinstance(timeout, bool) or timeout <= 0):
+        raise SyntaxError('`deadline` must be a positive number of seconds')
+    deadline = Deadline(timeout) if timeout is not None else None
+
+    rankings: Dict[str, Ranking] = dict()
+    if 'text' in models or 'combined' in models:
+        text_deadline = deadline
+        if deadline is not None and len(models) > 1:
+            text_deadline = deadline.part(0.5)
+        rankings['text'] = rank_text_based(
+            graph, (topic, examples), entities_to_rank, cache, text_deadline)
+    if 'examples' in models or 'combined' in models:
+        rankings['examples'] = rank_examples_based(
+            graph, (topic, examples), entities_to_rank, cache, lsh_index, min_collisions, deadline=deadline)
+    for model in models:
+        if model not in rankings and model != 'combined':
+            rankings[model] = rank_model(
+                model, graph, (topic, examples), entities_to_rank, cache, deadline)
+    if 'combined' in models:
+        rankings['combined'] = rank_combined(
+            (rankings['text'], rankings['examples']), top_k, deadline=deadline)
+
+    results = {model: ranking_to_dict((rankings[model][0], rankings[model][1][:top_k]))
+               for model in models}
+    if deadline is not None and deadline.partial:
+        for result in results.values():
+            result['partial'] = True
+            result['unscored'] = deadline.unscored_list()
+    return results
+
+
+def _batch_line(graph: 'PPGraph', line_number: int, line: str, cache: Optional['ResultCache'],
+                timeout: Optional[float] = None, lsh_index: Optional['MinHashLSH'] = None,
+                min_collisions: int = LSH_MIN_COLLISIONS) -> Dict[str, Any]:
+    """Ranks one line of batch file, errors are returned as results."""
+    result: Dict[str, Any] = {'line': line_number}
+    try:
+        query = json.loads(line)
+        if isinstance(query, dict) and 'id' in query:
+            result['id'] = query['id']
+        result['rankings'] = rank_query(graph, query, cache, timeout, lsh_index, min_collisions)
+    except (ValueError, SyntaxError) as e:
+        L.warning('Bad query in line %d: %s', line_number, e)
+        result['error'] = f'Bad query: {e}'
+    except Exception as e:
+        L.error('Error when ranking query in line %d: %s', line_number, e)
+        result['error'] = 'Error when ranking'
+    return result
+
+
+def run_batch(graph: 'PPGraph', lines: Iterable[str], out: TextIO, workers: int = BATCH_WORKERS,
+              cache: Optional['ResultCache'] = None, timeout: Optional[float] = None,
+              lsh_index: Optional['MinHashLSH'] = None, min_collisions: int = LSH_MIN_COLLISIONS) -> Tuple[int, int]:
+    """Ranks queries from JSON lines, writes results as soon as they are ready.
+
+    Lines are read lazily and at most 2 * workers queries are pending,
+    so memory use doesn't depend on the amount of queries. Deadline of queries
+    without one is timeout seconds from the moment they start to be ranked.
+    With lsh_index, example-based rankings score only entities colliding with examples.
+
+    Returns:
+        amount of queries, amount of failed queries
+    """
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    queries = 0
+    failed = 0
+    pending: Set[Future] = set()
+
+    def write_results(done: Iterable['Future']):
+        nonlocal failed
+        for future in done:
+            result = future.result()
+            if 'error' in result:
+                failed += 1
+            out.write(json.dumps(result) + '\n')
+        out.flush()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for line_number, line in enumerate(lines, 1):
+            if len(line.strip()) == 0:
+                continue
+            queries += 1
+            pending.add(executor.submit(
+                _batch_line, graph, line_number, line, cache, timeout, lsh_index, min_collisions))
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                write_results(done)
+        done, _ = wait(pending)
+        write_results(done)
+
+    return queries, failed
+
+
+def shell(graph: 'PPGraph', loader: Optional['BackgroundLoader'] = None, timeout: Optional[float] = None,
+          cascade: Optional[int] = None, lsh_index: Optional['MinHashLSH'] = None,
+          min_collisions: int = LSH_MIN_COLLISIONS) -> 'PPGraph':
+    """Run interactive query shell.
+
+    Args:
+        graph: triples to query
+        loader: triples being loaded in the background, they replace the graph when ready
+        timeout: show partial rankings of queries taking longer (seconds)
+        cascade: rank only that many best example-based entities with text-based model
+        lsh_index: score only entities colliding with examples with example-based model
+        min_collisions: amount of LSH bands that must collide
+
+    Returns:
+        graph used at exit
+    """
+    from rdflib import URIRef
+
+    from example_based_entity_search.cache import ResultCache
+    from example_based_entity_search.changesets import (apply_changeset,
+                                                        read_triples)
+    from example_based_entity_search.feature_store import FeatureStore
+    from example_based_entity_search.refinement import RefinementSession
+    from example_based_entity_search.utils import (BackgroundLoader,
+                                                   data_from_sample_file)
+
     L.info('-~'*30)
     L.info('Starting interactive shell')
 
+    # repeated queries reuse computed scores
+    cache = ResultCache()
+
+    # topic, examples, entities to rank, relevant entities
+    last_query: Optional[Tuple[str, List[URIRef], List[URIRef], Optional[List[URIRef]]]] = None
+    # refinements of the last query build on each other, until the query or the graph changes
+    session: Optional[RefinementSession] = None
+    session_version = 0
+
     def print_help():
         print('h/help - print this help')
-        print('l/load - load more triples from local files')
+        print('l/load - load more triples from local files (in the background)')
+        print('w/wait - wait until triples are loaded')
+        print('u/update - apply changeset (added and removed triples files)')
         print('q/query - make query')
         print('s/sample - make query from sample file')
+        print('r/refine - modify last query')
+        print('c/cache - print cache statistics')
         print('e/exit - exit shell')
 
-    def do_load(a_graph: PPGraph) -> PPGraph:
+    def do_load(a_graph: 'PPGraph') -> None:
+        nonlocal loader
+        if loader is not None:
+            print(f'Still loading `{loader.data_url}`, wait for it first')
+            return
+
         triples_path = input('Path to triples file or SPARQL endpoint url: ')
+        loader = BackgroundLoader(triples_path, a_graph)
+        print('Loading in the background, queries use the current triples until it finishes')
+
+    def do_update(a_graph: 'PPGraph') -> None:
+        if loader is not None:
+            print(f'Still loading `{loader.data_url}`, wait for it first')
+            return
 
+        added_path = input('File with added triples (blank line for none): ').strip()
+        removed_path = input('File with removed triples (blank line for none): ').strip()
         try:
-            a_graph = load_data(triples_path, a_graph)
+            added = read_triples(added_path) if added_path else []
+            removed = read_triples(removed_path) if removed_path else []
+            affected = apply_changeset(a_graph, added, removed, cache, lsh_index=lsh_index)
         except Exception as e:
-            L.error('Error when loading data from `%s`: %s', triples_path, e)
+            L.error('Error when applying changeset: %s', e)
+            return
+        print(f'Changeset applied, {len(affected)} entities affected')
 
-        return a_graph
+    def swap_graph(a_graph: 'PPGraph', wait: bool = False) -> 'PPGraph':
+        """Switches to the loaded graph, if it is ready."""
+        nonlocal loader
+        if loader is None or (not wait and not loader.done()):
+            return a_graph
 
-    def parse_entity_from_string(entity_string: str) -> URIRef:
+        try:
+            new_graph = loader.result()
+        except Exception as e:
+            L.error('Error when loading data from `%s`: %s', loader.data_url, e)
+            return a_graph
+        finally:
+            data_url, replaces, loader = loader.data_url, loader.replaces, None
+
+        # features of the old graph are wrong now
+        if a_graph.features is not None:
+            a_graph.features.close()
+            FeatureStore.for_graph(a_graph.features.directory, new_graph)
+
+        if replaces:
+            print(f'Loaded `{data_url}`, it replaces the previous graph')
+        else:
+            print(f'Loaded `{data_url}`, merged with the previous graph')
+        return new_graph
+
+    def prompt() -> str:
+        if loader is None:
+            return '> '
+        if loader.progress is None:
+            return '[loading] > '
+        return f'[loading {loader.progress:.0%}] > '
+
+    def parse_entity_from_string(entity_string: str) -> 'URIRef':
         if entity_string.startswith('<'):
             entity_string = entity_string[1:-1]
             L.warning('Entity starts with `<`, trimming to `%s`', entity_string)
@@ -95,7 +370,8 @@ def shell(graph: PPGraph):
             L.warning('Entity not an URI, prepending `%s`', URI_PREFIX)
         return URIRef(entity_string)
 
-    def do_query(a_graph: PPGraph) -> None:
+    def do_query(a_graph: 'PPGraph') -> None:
+        nonlocal last_query, session
         topic = input('Relation (topic, R), as plain text: ')
 
         examples_amount = None
@@ -122,32 +398,95 @@ def shell(graph: PPGraph):
                 break
             entities_to_rank.append(parse_entity_from_string(entity))
 
-        do_all_rankings(graph, topic, examples, entities_to_rank)
+        last_query, session = (topic, examples, entities_to_rank, None), None
+        do_all_rankings(a_graph, topic, examples, entities_to_rank, cache=cache, timeout=timeout,
+                        cascade=cascade, lsh_index=lsh_index, min_collisions=min_collisions)
 
     def do_sample(graph):
+        nonlocal last_query, session
         sample_file = input('Sample file to use: ')
         try:
-            do_all_rankings(graph, *data_from_sample_file(sample_file))
+            last_query, session = data_from_sample_file(sample_file), None
+            do_all_rankings(graph, *last_query, cache=cache, timeout=timeout, cascade=cascade,
+                            lsh_index=lsh_index, min_collisions=min_collisions)
         except Exception:
             L.error('Error when ranking')
 
+    def do_refine(a_graph: 'PPGraph') -> None:
+        nonlocal last_query, session, session_version
+        if last_query is None:
+            print('Make a query first')
+            return
+
+        topic, examples, entities_to_rank, relevant = last_query
+        if session is None or session.graph is not a_graph or session_version != a_graph.version:
+            session = RefinementSession(a_graph, topic, examples, entities_to_rank)
+        print('+x/-x URI - add/remove example')
+        print('+t/-t term - add/remove relation term')
+        print('+c/-c URI - add/remove entity to rank')
+        print('Enter (blank line) to finish')
+
+        while True:
+            print_rankings(session.rankings(), relevant)
+            print(f'Relation: {" ".join(session.terms)}')
+            print(f'Examples: {" ".join(session.examples)}')
+
+            # the refined query is the last one now
+            last_query = (' '.join(session.terms), list(session.examples),
+                          list(session.entities_to_rank), relevant)
+            session_version = a_graph.version
+
+            while True:
+                command = input('refine> ').strip().split(maxsplit=1)
+                if len(command) == 0:
+                    return
+                if len(command) == 2 and command[0] in ['+x', '-x', '+t', '-t', '+c', '-c']:
+                    break
+                print('Wrong input')
+
+            action, argument = command
+            if action == '+t':
+                session.add_term(argument)
+            elif action == '-t':
+                session.remove_term(argument)
+            else:
+                entity = parse_entity_from_string(argument)
+                {
+                    '+x': session.add_example,
+                    '-x': session.remove_example,
+                    '+c': session.add_entity,
+                    '-c': session.remove_entity
+                }[action](entity)
+
     print_help()
     while True:
-        choice = input('> ').lower()
+        choice = input(prompt()).lower()
+        graph = swap_graph(graph)
         if choice in ['h', 'help']:
             print_help()
         elif choice in ['l', 'load']:
-            graph = do_load(graph)
+            do_load(graph)
+        elif choice in ['w', 'wait']:
+            graph = swap_graph(graph, wait=True)
+        elif choice in ['u', 'update']:
+            do_update(graph)
         elif choice in ['q', 'query']:
             do_query(graph)
         elif choice in ['s', 'sample']:
             do_sample(graph)
+        elif choice in ['r', 'refine']:
+            do_refine(graph)
+        elif choice in ['c', 'cache']:
+            for k, v in cache.stats().items():
+                print(f' {k} -> {v}')
         elif choice in ['e', 'exit']:
             break
         else:
             print('Wrong input')
             print_help()
 
+    return graph
+
 
 def main():
     """Tool entry point"""
@@ -162,6 +501,37 @@ def main():
     parser.add_argument(
         '--shell', action='store_true',
         help='Run interactive shell')
+    parser.add_argument(
+        '--background', action='store_true',
+        help='Start the shell right away, querying the default SPARQL endpoint until triples are loaded')
+    parser.add_argument(
+        '--batch',
+        help='JSON lines file with queries (`-` for stdin)')
+    parser.add_argument(
+        '--out', default='-',
+        help='File to write batch results to (default: stdout)')
+    parser.add_argument(
+        '--workers', default=BATCH_WORKERS, type=int,
+        help='Amount of batch queries ranked concurrently')
+    parser.add_argument(
+        '--deadline', type=float,
+        help='Show partial rankings of queries taking longer than that many seconds')
+    parser.add_argument(
+        '--cascade', type=int,
+        help='Rank only that many best entities of the example-based ranking with the text-based model '
+        f'(sample and shell modes, f.e. {CASCADE_TOP_N})')
+    parser.add_argument(
+        '--lsh',
+        help='MinHash LSH index (from lsh.py), the example-based model scores only entities colliding with examples')
+    parser.add_argument(
+        '--min_collisions', type=int, default=LSH_MIN_COLLISIONS,
+        help='Amount of LSH bands colliding with an example, more = faster but worse recall')
+    parser.add_argument(
+        '--features',
+        help='Feature store directory, to reuse entities representations between runs')
+    parser.add_argument(
+        '--plugin', action='append', default=[],
+        help='Module to import first, f.e. registering retrieval models (can be repeated)')
     parser.add_argument("-v", "--verbose", help="debug output",
                         action="store_true")
 
@@ -172,27 +542,89 @@ def main():
     if args.verbose:
         L.setLevel('DEBUG')
 
+    from example_based_entity_search.cache import ResultCache
+    from example_based_entity_search.entity_search_lib import load_plugins
+    from example_based_entity_search.feature_store import FeatureStore
+    from example_based_entity_search.lsh import MinHashLSH
+    from example_based_entity_search.utils import (BackgroundLoader,
+                                                   data_from_sample_file,
+                                                   load_data)
+
+    try:
+        load_plugins(args.plugin)
+    except ImportError as e:
+        L.error('Error when loading plugin: %s', e)
+        return 1
+
     # triples graph
+    loader = None
     try:
-        graph = load_data(args.triples_data)
+        if args.background and args.shell:
+            loader = BackgroundLoader(args.triples_data)
+            try:
+                graph = load_data(SPARQL_ENDPOINT)
+            except Exception:
+                L.warning('Waiting for triples from `%s`', args.triples_data)
+                graph, loader = loader.result(), None
+        else:
+            graph = load_data(args.triples_data)
     except Exception as e:
         L.error('Error when loading data from `%s`: %s', args.triples_data, e)
         return 1
 
+    if args.features:
+        try:
+            FeatureStore.for_graph(args.features, graph)
+        except OSError as e:
+            L.error('Error when opening feature store `%s`: %s', args.features, e)
+            return 1
+
+    lsh_index = None
+    if args.lsh:
+        try:
+            lsh_index = MinHashLSH.load(args.lsh)
+        except Exception as e:
+            L.error('Error when loading LSH index from `%s`: %s', args.lsh, e)
+            return 1
+
     # execute query from sample file
     if args.sample_file:
         try:
-            do_all_rankings(graph, *data_from_sample_file(args.sample_file))
+            do_all_rankings(graph, *data_from_sample_file(args.sample_file), timeout=args.deadline,
+                            cascade=args.cascade, lsh_index=lsh_index, min_collisions=args.min_collisions)
         except Exception:
             L.error("Error when raking")
             return 1
 
+    # execute queries from batch file
+    if args.batch:
+        try:
+            batch_file = sys.stdin if args.batch == '-' else open(
+                args.batch, 'r', encoding='utf8')
+            out_file = sys.stdout if args.out == '-' else open(
+                args.out, 'w', encoding='utf8')
+        except OSError as e:
+            L.error('Error when opening batch files: %s', e)
+            return 1
+
+        try:
+            queries, failed = run_batch(graph, batch_file, out_file, args.workers, ResultCache(),
+                                        args.deadline, lsh_index, args.min_collisions)
+        finally:
+            for f in [batch_file, out_file]:
+                if f not in [sys.stdin, sys.stdout]:
+                    f.close()
+        L.info('Ranked %d queries, %d failed', queries, failed)
+
     # execute queries from shell
     if args.shell:
-        shell(graph)
+        graph = shell(graph, loader, args.deadline, args.cascade, lsh_index, args.min_collisions)
+
+    if graph.features is not None:
+        graph.features.close()
 
     return 0
 
 
 if __name__ == '__main__':
-    exit(main())
+    sys.exit(main())
@@ -2,6 +2,15 @@
 # -*- coding: utf-8 -*-
 """Statistical evaluation for the lib.
 
+    Usage:
+        python ./example_based_entity_search/evaluate.py ./pp_data
+        # tune rank_combined parameters, both models are ranked only once per sample
+        python ./example_based_entity_search/evaluate.py ./pp_data --sweep
+        # confidence intervals over 20 random draws of examples per sample
+        python ./example_based_entity_search/evaluate.py ./pp_data --trials 20 --workers 4
+        # other registered retrieval models, by name
+        python ./example_based_entity_search/evaluate.py ./pp_data --models text,examples,my_model
+
     Author: Paweł Płatek
 """
 
@@ -10,20 +19,46 @@ import argparse
 from collections import defaultdict
 from decimal import Decimal as D
 from glob import glob
+from multiprocessing import Pool
+from os import cpu_count
 from os.path import join as path_join
-from typing import DefaultDict, Dict, List, Set
+from random import Random
+from sys import exit
+from typing import (DefaultDict, Dict, Iterator, List, Mapping, Optional, Set,
+                    Tuple, Union)
 
 from rdflib import URIRef
 
-from example_based_entity_search.config import D_PREC, L
-from example_based_entity_search.entity_search_lib import (rank_combined,
-                                                           rank_examples_based,
-                                                           rank_text_based)
+from example_based_entity_search.columnar import ColumnarRanking, relevance
+from example_based_entity_search.config import (COMBINED_DELTA,
+                                                COMBINED_LAMBDA,
+                                                CONFIDENCE_Z, D_PREC,
+                                                EVALUATION_TRIALS, L)
+from example_based_entity_search.entity_search_lib import (MODELS, Query,
+                                                           Ranking,
+                                                           RankingColumns,
+                                                           combine_scores,
+                                                           load_plugins,
+                                                           rank_combined,
+                                                           rank_combined_columnar,
+                                                           rank_model,
+                                                           rank_model_columnar,
+                                                           rankings_overlap)
+from example_based_entity_search.feature_store import (MemoryFeatures,
+                                                       shared_features)
 from example_based_entity_search.utils import (PPGraph, data_from_sample_file,
                                                load_data, statistical_stats)
 
 
-def load_graph(evaluation_data: str):
+DEFAULT_MODELS = ['text', 'examples']
+RankingData = Union[List[Tuple[D, URIRef]], ColumnarRanking]
+
+
+def load_graph(evaluation_data: str, manifest: Optional[str] = None):
+    """All triples files of evaluation data, or lazily loaded graph of their manifest."""
+    if manifest is not None:
+        return load_data(manifest)
+
     triples = glob(path_join(evaluation_data, '*.nq'))
 
     # load all graphs
@@ -34,74 +69,149 @@ def load_graph(evaluation_data: str):
     return graph
 
 
-def evaluation(graph: PPGraph, evaluation_data: str):
-    samples = glob(path_join(evaluation_data, '*.yml'))
+def samples_files(evaluation_data: str) -> List[str]:
+    return sorted(glob(path_join(evaluation_data, '*.yml')))
 
-    # collect all entities
+
+def _samples_entities(samples: List[str]) -> List[URIRef]:
+    """Candidates and relevant entities of all samples (no matter which are drawn as examples)."""
     entities_to_rank_unique: Set[URIRef] = set()
     for sample_file in samples:
-        try:
-            _, examples, entities_to_rank_part, _ = data_from_sample_file(
-                sample_file)
-        except SyntaxError:
-            L.error('Error when loading data')
-            return
-
+        _, examples, entities_to_rank_part, _ = data_from_sample_file(
+            sample_file)
         entities_to_rank_unique.update(examples)
         entities_to_rank_unique.update(entities_to_rank_part)
+    return list(entities_to_rank_unique)
 
-    entities_to_rank: List[URIRef] = list(entities_to_rank_unique)
-    mean_stats: Dict[str, DefaultDict[str, D]] = {
-        'text': defaultdict(D), 'examples': defaultdict(D), 'combined': defaultdict(D)}
-    mean_stats_denominator = {'text': 0, 'examples': 0, 'combined': 0}
 
-    # do ranking for every sample file
-    for sample_file in samples:
-        print(f'Stats for `{sample_file}`:')
+def _sample_query(sample_file: str, entities_to_rank: List[URIRef],
+                  rng: Optional[Random] = None) -> Tuple[Query, List[URIRef], List[URIRef]]:
+    """Query of the sample, entities to rank without its examples and relevant entities."""
+    topic, examples, _, relevant = data_from_sample_file(sample_file, rng)
+
+    entities_to_rank_wo_examples = entities_to_rank[:]
+    for example in examples:
+        if example in entities_to_rank_wo_examples:
+            entities_to_rank_wo_examples.remove(example)
+    return (topic, examples), entities_to_rank_wo_examples, relevant
+
+
+def _rank_sample(graph: PPGraph, sample_file: str, entities_to_rank: List[URIRef],
+                 rng: Optional[Random] = None,
+                 models: List[str] = DEFAULT_MODELS) -> Tuple[List[URIRef], Dict[str, Ranking]]:
+    """Rankings of the entities (without examples) for the sample, by model name.
+
+    Combined ranking is added if both text and examples models are used.
+    """
+    input_data, entities_to_rank_wo_examples, relevant = _sample_query(
+        sample_file, entities_to_rank, rng)
+    rankings = {model: rank_model(model, graph, input_data, entities_to_rank_wo_examples)
+                for model in models}
+    if 'text' in rankings and 'examples' in rankings:
+        rankings['combined'] = rank_combined(
+            (rankings['text'], rankings['examples']))
+    return relevant, rankings
+
+
+def _rank_sample_columnar(graph: PPGraph, sample_file: str, entities_to_rank: List[URIRef],
+                          models: List[str] = DEFAULT_MODELS) -> Tuple[List[URIRef], Dict[str, RankingColumns]]:
+    """Like _rank_sample, but rankings keep float scores in arrays (see columnar.py)."""
+    input_data, entities_to_rank_wo_examples, relevant = _sample_query(
+        sample_file, entities_to_rank)
+    rankings = {model: rank_model_columnar(model, graph, input_data, entities_to_rank_wo_examples)
+                for model in models}
+    if 'text' in rankings and 'examples' in rankings:
+        rankings['combined'] = rank_combined_columnar(
+            (rankings['text'], rankings['examples']))
+    return relevant, rankings
+
+
+def _samples(graph: PPGraph, evaluation_data: str, models: List[str]) -> Iterator[Tuple[str, List[URIRef]]]:
+    """Sample files with entities to rank: candidates of all samples.
+
+    Text and examples models share representations until all samples are read.
+    """
+    samples = samples_files(evaluation_data)
+
+    # collect all entities
+    try:
+        entities_to_rank = _samples_entities(samples)
+    except SyntaxError:
+        L.error('Error when loading data')
+        return
+
+    with shared_features(graph, 'text' in models and 'examples' in models):
+        for sample_file in samples:
+            yield sample_file, entities_to_rank
+
+
+def samples_rankings(graph: PPGraph, evaluation_data: str,
+                     models: List[str] = DEFAULT_MODELS) -> Iterator[Tuple[str, List[URIRef], Dict[str, Ranking]]]:
+    """Rankings of models for every sample file.
+
+    All samples rank the same entities (candidates of all samples), without examples.
+
+    Yields:
+        sample file, relevant entities, rankings by model name
+    """
+    for sample_file, entities_to_rank in _samples(graph, evaluation_data, models):
+        try:
+            relevant, rankings = _rank_sample(
+                graph, sample_file, entities_to_rank, models=models)
+        except Exception as e:
+            L.error('Error when loading data: %s', e)
+            return
+        yield sample_file, relevant, rankings
+
+
+def samples_columnar_rankings(graph: PPGraph, evaluation_data: str, models: List[str] = DEFAULT_MODELS
+                              ) -> Iterator[Tuple[str, List[URIRef], Dict[str, RankingColumns]]]:
+    """Like samples_rankings, but rankings are columnar."""
+    for sample_file, entities_to_rank in _samples(graph, evaluation_data, models):
         try:
-            topic, examples, _, relevant = data_from_sample_file(
-                sample_file)
+            relevant, rankings = _rank_sample_columnar(
+                graph, sample_file, entities_to_rank, models)
         except Exception as e:
             L.error('Error when loading data: %s', e)
             return
+        yield sample_file, relevant, rankings
+
 
-        entities_to_rank_wo_examples = entities_to_rank[:]
-        for example in examples:
-            if example in entities_to_rank_wo_examples:
-                entities_to_rank_wo_examples.remove(example)
+def _retrived(ranking: RankingData, relevant: List[URIRef]) -> bytes:
+    """Relevance mask of top entities, as many as relevant ones."""
+    return relevance(ranking[:len(relevant)], relevant)
 
-        ranking_text = rank_text_based(
-            graph, (topic, examples), entities_to_rank_wo_examples)
-        ranking_example = rank_examples_based(
-            graph, (topic, examples), entities_to_rank_wo_examples)
-        ranking_combined = rank_combined((ranking_text, ranking_example))
-        rankings = {'text': ranking_text[1],
-                    'examples': ranking_example[1], 'combined': ranking_combined[1]}
+
+def evaluation(graph: PPGraph, evaluation_data: str, models: List[str] = DEFAULT_MODELS, columnar: bool = False):
+    mean_stats: Dict[str, DefaultDict[str, D]] = dict()
+    mean_stats_denominator: Dict[str, int] = dict()
+
+    # columnar rankings are read like lists, only their scores are floats
+    all_rankings: Iterator[Tuple[str, List[URIRef], Mapping[str, Tuple[D, RankingData]]]] = (
+        samples_columnar_rankings(graph, evaluation_data, models) if columnar
+        else samples_rankings(graph, evaluation_data, models))
+    for sample_file, relevant, rankings_data in all_rankings:
+        print(f'Stats for `{sample_file}`:')
+        rankings = {ranking_type: ranking for ranking_type,
+                    (_, ranking) in rankings_data.items()}
 
         # make the ranking
-        for ranking_type in mean_stats.keys():
+        for ranking_type in rankings.keys():
             print(f'  Ranking with `{ranking_type}-based` method')
 
             # how many top entities we would return in ideal case
             # paper sets this to 100
-            evaluation_limit = len(relevant)
-            retrived: List[bool] = []
-            for i, (ranking_score, entity) in enumerate(rankings[ranking_type]):
-                if i < evaluation_limit:
-                    if entity in relevant:
-                        retrived.append(True)
-                        print(f'OO {entity} - {ranking_score}')
-                    else:
-                        retrived.append(False)
-                        print(f'xx {entity} - {ranking_score}')
-                else:
-                    break
+            top = rankings[ranking_type][:len(relevant)]
+            retrived = _retrived(top, relevant)
+            for is_relevant, (ranking_score, entity) in zip(retrived, top):
+                print(f'{"OO" if is_relevant else "xx"} {entity} - {ranking_score}')
 
             stats = statistical_stats(retrived)
             for k, v in stats.items():
                 print(f'    {k} -> {v.quantize(D_PREC)}')
-                mean_stats[ranking_type][k] += v
-            mean_stats_denominator[ranking_type] += 1
+                mean_stats.setdefault(ranking_type, defaultdict(D))[k] += v
+            mean_stats_denominator[ranking_type] = mean_stats_denominator.get(
+                ranking_type, 0) + 1
 
     print('Mean stats:')
     for ranking_type in mean_stats.keys():
@@ -111,11 +221,175 @@ def evaluation(graph: PPGraph, evaluation_data: str):
                 f'    Mean-{k} -> {(v / mean_stats_denominator[ranking_type]).quantize(D_PREC)}')
 
 
+def sweep(graph: PPGraph, evaluation_data: str, lambdas: List[D], deltas: List[D]):
+    """Mean AvgPrec of combined rankings for a grid of lambda and delta parameters.
+
+    Both models are ranked once per sample. Delta only decides whether rankings are combined
+    (or the better one is used), so every sample needs one combination per lambda
+    and every grid cell is a choice between that and the better ranking.
+    """
+    grid: List[List[D]] = [[D(0)] * len(deltas) for _ in lambdas]
+    samples_amount = 0
+
+    for sample_file, relevant, rankings in samples_rankings(graph, evaluation_data):
+        samples_amount += 1
+        (ap_text, ranking_text_data), (ap_example,
+                                       ranking_example_data) = rankings['text'], rankings['examples']
+        overlap = rankings_overlap(ap_text, ap_example)
+
+        # what rank_combined returns for low overlap
+        single_avg_prec = None
+        if ap_example != ap_text:
+            better_ranking = ranking_example_data if ap_example > ap_text else ranking_text_data
+            single_avg_prec = statistical_stats(
+                _retrived(better_ranking, relevant))['AvgPrec']
+
+        for i, lambda_param in enumerate(lambdas):
+            combined_avg_prec = statistical_stats(_retrived(combine_scores(
+                ranking_text_data, ranking_example_data, lambda_param), relevant))['AvgPrec']
+            for j, delta_param in enumerate(deltas):
+                if single_avg_prec is not None and overlap < delta_param:
+                    grid[i][j] += single_avg_prec
+                else:
+                    grid[i][j] += combined_avg_prec
+        print(f'`{sample_file}`: overlap {overlap.quantize(D_PREC)}')
+
+    if samples_amount == 0:
+        L.error('No samples to evaluate')
+        return
+
+    print('Mean-AvgPrec (rows: lambda, columns: delta):')
+    print('lambda\\delta ' + ' '.join([f'{delta_param:>8}' for delta_param in deltas]))
+    best = (D(-1), D(0), D(0))
+    for i, lambda_param in enumerate(lambdas):
+        row = []
+        for j, delta_param in enumerate(deltas):
+            mean_avg_prec = grid[i][j] / samples_amount
+            row.append(f'{mean_avg_prec.quantize(D_PREC):>8}')
+            if mean_avg_prec > best[0]:
+                best = (mean_avg_prec, lambda_param, delta_param)
+        print(f'{lambda_param:>12} ' + ' '.join(row))
+
+    print(f'Best: lambda={best[1]}, delta={best[2]}, Mean-AvgPrec -> {best[0].quantize(D_PREC)} '
+          f'(current: lambda={COMBINED_LAMBDA}, delta={COMBINED_DELTA})')
+
+
+# graph of trials worker process
+_trials_graph: Optional[PPGraph] = None
+_trials_entities: List[URIRef] = []
+_trials_models: List[str] = []
+
+
+def _init_trials(graph: PPGraph, entities_to_rank: List[URIRef], models: List[str]):
+    global _trials_graph, _trials_entities, _trials_models
+    _trials_graph = graph
+    _trials_entities = entities_to_rank
+    _trials_models = models
+
+
+def _run_trial(task: Tuple[str, int]) -> Tuple[str, int, Dict[str, Dict[str, D]]]:
+    """Stats of all methods for one seeded draw of examples."""
+    sample_file, seed = task
+    assert _trials_graph is not None
+    relevant, rankings = _rank_sample(
+        _trials_graph, sample_file, _trials_entities, Random(seed), _trials_models)
+    return sample_file, seed, {ranking_type: statistical_stats(_retrived(ranking, relevant))
+                               for ranking_type, (_, ranking) in rankings.items()}
+
+
+def _mean_interval(values: List[D]) -> Tuple[D, D]:
+    """Mean and half-width of its confidence interval (normal approximation)."""
+    mean = sum(values, D(0)) / len(values)
+    if len(values) < 2:
+        return mean, D(0)
+    variance = sum([(value - mean) ** 2 for value in values], D(0)) / (len(values) - 1)
+    return mean, CONFIDENCE_Z * (variance / len(values)).sqrt()
+
+
+def monte_carlo(graph: PPGraph, evaluation_data: str, trials: int, workers: int, seed: int = 0,
+                models: List[str] = DEFAULT_MODELS):
+    """Evaluation over many random draws of examples.
+
+    Representations of all entities are computed once, before worker processes start,
+    so trials only score them. Draw `i` of every sample uses Random(seed + i).
+    """
+    samples = samples_files(evaluation_data)
+    try:
+        entities_to_rank = _samples_entities(samples)
+    except SyntaxError:
+        L.error('Error when loading data')
+        return
+
+    print(f'Computing representations of {len(entities_to_rank)} entities...')
+    graph.require(entities_to_rank)
+    # in memory, so forked workers share them; the previous features are restored afterwards
+    previous_features, graph.features = graph.features, MemoryFeatures()
+    try:
+        for entity in entities_to_rank:
+            graph.features.features(graph, entity)
+        L.debug('Graph size: %d', graph.size)  # computed once, not in every worker
+
+        tasks = [(sample_file, seed + trial)
+                 for sample_file in samples for trial in range(trials)]
+        results: Dict[str, Dict[int, Dict[str, Dict[str, D]]]] = {
+            sample_file: dict() for sample_file in samples}
+        print(f'Running {len(tasks)} trials with {workers} workers...')
+        with Pool(workers, initializer=_init_trials, initargs=(graph, entities_to_rank, models)) as pool:
+            for sample_file, trial_seed, stats in pool.imap_unordered(_run_trial, tasks):
+                results[sample_file][trial_seed] = stats
+    finally:
+        graph.features = previous_features
+
+    ranking_types = models[:]
+    if 'text' in models and 'examples' in models:
+        ranking_types.append('combined')
+    stats_names = ['R-Precision', 'AvgPrec']
+    for sample_file in samples:
+        print(f'Stats for `{sample_file}` ({trials} draws):')
+        for ranking_type in ranking_types:
+            print(f'  Ranking with `{ranking_type}-based` method')
+            for stats_name in stats_names:
+                mean, interval = _mean_interval([results[sample_file][seed + trial][ranking_type][stats_name]
+                                                 for trial in range(trials)])
+                print(f'    {stats_name} -> {mean.quantize(D_PREC)} +- {interval.quantize(D_PREC)}')
+
+    # mean over samples in every trial, interval over trials
+    print(f'Mean stats ({CONFIDENCE_Z} * standard error over {trials} trials):')
+    for ranking_type in ranking_types:
+        print(f'  Ranking with `{ranking_type}-based` method')
+        for stats_name in stats_names:
+            trials_means = [sum([results[sample_file][seed + trial][ranking_type][stats_name]
+                                 for sample_file in samples], D(0)) / len(samples) for trial in range(trials)]
+            mean, interval = _mean_interval(trials_means)
+            print(f'    Mean-{stats_name} -> {mean.quantize(D_PREC)} +- {interval.quantize(D_PREC)}')
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Evaluate ebes library.')
     parser.add_argument(
         'evaluation_data',
         help='Path to directory with triple files (.nq) and sample files (.yml)')
+    parser.add_argument('--sweep', action='store_true',
+                        help='Evaluate combined ranking for a grid of lambda and delta parameters')
+    parser.add_argument('--lambdas', default='0,0.1,0.2,0.3,0.4,0.5,0.6,0.7,0.8,0.9,1',
+                        help='Comma separated lambda values for --sweep')
+    parser.add_argument('--deltas', default='0,0.05,0.1,0.2,0.3,0.5,1',
+                        help='Comma separated delta values for --sweep')
+    parser.add_argument('--trials', type=int,
+                        help=f'Evaluate over that many random draws of examples per sample (f.e. {EVALUATION_TRIALS})')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the first draw in --trials mode')
+    parser.add_argument('--workers', type=int, default=cpu_count() or 1,
+                        help='Amount of worker processes in --trials mode')
+    parser.add_argument('--models', default=','.join(DEFAULT_MODELS),
+                        help='Comma separated names of retrieval models to evaluate '
+                        '(combined ranking is added if both text and examples are evaluated)')
+    parser.add_argument('--plugin', action='append', default=[],
+                        help='Module to import first, f.e. registering retrieval models (can be repeated)')
+    parser.add_argument('--columnar', action='store_true',
+                        help='Keep rankings as arrays of float scores (less memory for many candidates)')
+    parser.add_argument('--manifest',
+                        help='Manifest of the triple files (see manifest.py), load only triples of ranked entities')
     parser.add_argument("-v", "--verbose", help="debug output",
                         action="store_true")
 
@@ -125,7 +399,31 @@ if __name__ == '__main__':
     if args.verbose:
         L.setLevel('DEBUG')
 
+    try:
+        load_plugins(args.plugin)
+    except ImportError as e:
+        L.error('Error when loading plugin: %s', e)
+        exit(1)
+
+    models = args.models.split(',')
+    unknown = [model for model in models if model not in MODELS]
+    if unknown:
+        L.error('Unknown retrieval models: %s (available: %s)',
+                ', '.join(unknown), ', '.join(MODELS))
+        exit(1)
+
     print('Loading graphs...')
-    graph = load_graph(args.evaluation_data)
+    try:
+        graph = load_graph(args.evaluation_data, args.manifest)
+    except ValueError as e:
+        L.error('Error when loading data: %s', e)
+        exit(1)
 
-    evaluation(graph, args.evaluation_data)
+    if args.trials:
+        monte_carlo(graph, args.evaluation_data,
+                    args.trials, args.workers, args.seed, models)
+    elif args.sweep:
+        sweep(graph, args.evaluation_data, list(map(D, args.lambdas.split(','))),
+              list(map(D, args.deltas.split(','))))
+    else:
+        evaluation(graph, args.evaluation_data, models, args.columnar)
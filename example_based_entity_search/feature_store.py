@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Persistent store of per-entity features.
+
+    Text representations (term frequencies of attributes, types and links) and
+    triples set representations depend only on the graph, so they are computed
+    once and reused by next runs. Triples are stored as 64 bit hashes, which is
+    enough for the example-based model (it only compares triples).
+
+    Store is a directory with subdirectory per graph fingerprint (hash of
+    contents of triples files) and hub policy, containing:
+        features.dat - records: header (json length, amount of hashes, uint32),
+                       text representation as json, sorted hashes (uint64)
+        features.idx - lines with entity, record offset and length
+    Records are appended the first time an entity is used, the data file
+    is memory-mapped and the index is loaded at once when opening.
+    Recently used records are kept decoded in memory (FEATURES_MEMO_SIZE of them).
+    Features of entities changed by changesets are kept in memory only,
+    so the files always match the triples files of the fingerprint.
+
+    Usage:
+        python -m example_based_entity_search.feature_store ./pp_data/ ./features --workers 4
+        ebes-rank ./pp_data/ --features ./features -s pp_data/sample1.yml
+
+    Author: Paweł Płatek
+"""
+
+
+import argparse
+import json
+import mmap
+import struct
+from collections import defaultdict
+from contextlib import contextmanager
+from multiprocessing import Pool
+from os import makedirs
+from os.path import getsize, isfile
+from os.path import join as path_join
+from sys import exit
+from threading import Lock
+from typing import (Any, DefaultDict, Dict, FrozenSet, Iterable, Iterator,
+                    Optional, Tuple)
+
+from rdflib import URIRef
+
+from example_based_entity_search.cache import LRUCache
+from example_based_entity_search.config import (FEATURES_MEMO_SIZE,
+                                                HUB_DEGREE, HUB_POLICY,
+                                                HUB_PREDICATE_CAP,
+                                                TEXT_TERMS_THRESHOLD, L)
+from example_based_entity_search.entity_search_lib import \
+    _entity_representations
+from example_based_entity_search.lsh import _triple_hash, graph_entities
+from example_based_entity_search.utils import PPGraph, load_data
+
+RECORD_HEADER = struct.Struct('<II')
+
+TextRepresentation = Dict[str, DefaultDict[str, int]]
+Features = Tuple[TextRepresentation, FrozenSet[int]]
+
+
+def compute_features(graph: PPGraph, entity: URIRef) -> Features:
+    """Text representation and hashed triples set representation of the entity."""
+    text_representation, triples_set = _entity_representations(graph, entity)
+    return text_representation, frozenset([_triple_hash(tr) for tr in triples_set])
+
+
+def _encode_features(features: Features) -> bytes:
+    text_representation, triples_hashes = features
+    text_data = json.dumps(text_representation,
+                           ensure_ascii=False).encode('utf8')
+    return RECORD_HEADER.pack(len(text_data), len(triples_hashes)) + text_data + \
+        struct.pack(f'<{len(triples_hashes)}Q', *sorted(triples_hashes))
+
+
+def _decode_features(data: bytes) -> Features:
+    text_length, hashes_amount = RECORD_HEADER.unpack_from(data, 0)
+    text_start = RECORD_HEADER.size
+    text_representation = {cs_name: defaultdict(int, cs) for cs_name, cs in
+                           json.loads(data[text_start:text_start + text_length].decode('utf8')).items()}
+    triples_hashes = frozenset(struct.unpack_from(
+        f'<{hashes_amount}Q', data, text_start + text_length))
+    return text_representation, triples_hashes
+
+
+class FeatureStore:
+    """Features of entities of one graph, computed on first use.
+
+    Attach it to the graph (graph.features = store) to make the models use it.
+    """
+
+    def __init__(self, directory: str, fingerprint: str):
+        self.directory = directory
+        self.path = path_join(directory, fingerprint)
+        makedirs(self.path, exist_ok=True)
+        self._data_path = path_join(self.path, 'features.dat')
+        self._index_path = path_join(self.path, 'features.idx')
+        self._lock = Lock()
+        self._data: Optional[mmap.mmap] = None
+        self._index: Dict[URIRef, Tuple[int, int]] = dict()
+        self._memo = LRUCache(FEATURES_MEMO_SIZE)  # decoded records
+        # entities changed by changesets, with features computed after the change
+        self._changed: Dict[URIRef, Optional[Features]] = dict()
+
+        if isfile(self._index_path):
+            with open(self._index_path, 'r', encoding='utf8') as f:
+                for line in f:
+                    entity, offset, length = line.rstrip('\n').rsplit('\t', 2)
+                    self._index[URIRef(entity)] = (int(offset), int(length))
+        self._map_data()
+
+        self._data_file = open(self._data_path, 'ab')
+        self._index_file = open(self._index_path, 'a', encoding='utf8')
+        self.hits = 0
+        self.misses = 0
+        L.info('Feature store `%s`: %d entities', self.path, len(self._index))
+
+    @classmethod
+    def for_graph(cls, directory: str, graph: PPGraph) -> 'FeatureStore':
+        """Opens the store of the graph and attaches it to the graph."""
+        # representations of hubs depend on the policy
+        policy = f'{HUB_POLICY}-{HUB_DEGREE}-{HUB_PREDICATE_CAP}-{TEXT_TERMS_THRESHOLD}'
+        store = cls(directory, f'{graph.fingerprint()}-{policy}')
+        graph.features = store
+        return store
+
+    def _map_data(self):
+        if self._data is not None:
+            self._data.close()
+            self._data = None
+        if isfile(self._data_path) and getsize(self._data_path) > 0:
+            with open(self._data_path, 'rb') as f:
+                self._data = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, entity: URIRef) -> bool:
+        if entity in self._changed:
+            return self._changed[entity] is not None
+        return entity in self._index
+
+    def invalidate(self, entities: Iterable[URIRef]):
+        """Features of the entities will be computed again (and kept in memory)."""
+        for entity in entities:
+            self._changed[entity] = None
+
+    def get(self, entity: URIRef) -> Optional[Features]:
+        with self._lock:
+            features = self._memo.get(entity)
+            if features is not None or entity not in self._index:
+                return features
+            offset, length = self._index[entity]
+            if self._data is None or offset + length > len(self._data):
+                # written after the data was mapped
+                self._data_file.flush()
+                self._map_data()
+            assert self._data is not None
+            features = _decode_features(self._data[offset:offset + length])
+            self._memo.put(entity, features)
+            return features
+
+    def put(self, entity: URIRef, features: Features):
+        data = _encode_features(features)
+        with self._lock:
+            if entity in self._index:
+                return
+            offset = self._data_file.tell()
+            self._data_file.write(data)
+            self._index_file.write(f'{entity}\t{offset}\t{len(data)}\n')
+            self._index[entity] = (offset, len(data))
+            self._memo.put(entity, features)
+
+    def features(self, graph: PPGraph, entity: URIRef) -> Features:
+        if entity in self._changed:
+            features = self._changed[entity]
+            if features is None:
+                self.misses += 1
+                features = compute_features(graph, entity)
+                self._changed[entity] = features
+            else:
+                self.hits += 1
+            return features
+
+        features = self.get(entity)
+        if features is not None:
+            self.hits += 1
+            return features
+        self.misses += 1
+        features = compute_features(graph, entity)
+        self.put(entity, features)
+        return features
+
+    def text_representation(self, graph: PPGraph, entity: URIRef) -> TextRepresentation:
+        return self.features(graph, entity)[0]
+
+    def triples_features(self, graph: PPGraph, entity: URIRef) -> FrozenSet[int]:
+        return self.features(graph, entity)[1]
+
+    def flush(self):
+        with self._lock:
+            self._data_file.flush()
+            self._index_file.flush()
+
+    def close(self):
+        self.flush()
+        self._data_file.close()
+        self._index_file.close()
+        with self._lock:
+            if self._data is not None:
+                self._data.close()
+                self._data = None
+            self._memo.clear()
+
+
+class MemoryFeatures:
+    """Features kept in memory, with the FeatureStore interface.
+
+    Computed once, they are shared with worker processes forked afterwards.
+    Triples are kept as they are, not hashed.
+    """
+
+    def __init__(self):
+        self._features: Dict[URIRef, Tuple[TextRepresentation, FrozenSet[Any]]] = dict()
+
+    def __len__(self) -> int:
+        return len(self._features)
+
+    def __contains__(self, entity: URIRef) -> bool:
+        return entity in self._features
+
+    def invalidate(self, entities: Iterable[URIRef]):
+        for entity in entities:
+            self._features.pop(entity, None)
+
+    def features(self, graph: PPGraph, entity: URIRef) -> Tuple[TextRepresentation, FrozenSet[Any]]:
+        if entity not in self._features:
+            text_representation, triples_set = _entity_representations(graph, entity)
+            self._features[entity] = (text_representation, frozenset(triples_set))
+        return self._features[entity]
+
+    def text_representation(self, graph: PPGraph, entity: URIRef) -> TextRepresentation:
+        return self.features(graph, entity)[0]
+
+    def triples_features(self, graph: PPGraph, entity: URIRef) -> FrozenSet[Any]:
+        return self.features(graph, entity)[1]
+
+    def close(self):
+        pass
+
+
+@contextmanager
+def shared_features(graph: PPGraph, enabled: bool = True) -> Iterator[None]:
+    """Keeps features in memory while in the context, if the graph has no feature store.
+
+    Models ranking the same entities then read representations built in one pass
+    over their triples, instead of building their own. Disabled, it does nothing.
+    """
+    if not enabled or graph.features is not None:
+        yield
+        return
+
+    graph.features = MemoryFeatures()
+    try:
+        yield
+    finally:
+        graph.features = None
+
+
+# graph of precompute worker process
+_worker_graph: Optional[PPGraph] = None
+
+
+def _init_worker(triples_data: str):
+    global _worker_graph
+    _worker_graph = load_data(triples_data)
+
+
+def _worker_features(entity: URIRef) -> Tuple[URIRef, Features]:
+    assert _worker_graph is not None
+    return entity, compute_features(_worker_graph, entity)
+
+
+def precompute(triples_data: str, directory: str, workers: int, entities: Optional[Iterable[URIRef]] = None) -> int:
+    """Fills the store with features of all subjects in the graph.
+
+    Returns:
+        amount of computed entities
+    """
+    graph = load_data(triples_data)
+    store = FeatureStore.for_graph(directory, graph)
+    if entities is None:
+        entities = graph_entities(graph)
+    missing = [entity for entity in entities if entity not in store]
+    L.info('Computing features of %d entities', len(missing))
+
+    with Pool(workers, initializer=_init_worker, initargs=(triples_data,)) as pool:
+        for i, (entity, features) in enumerate(pool.imap_unordered(_worker_features, missing, chunksize=64)):
+            if i % 1000 == 0:
+                L.info(' ~> entity no %d / %d', i, len(missing))
+            store.put(entity, features)
+    store.close()
+    return len(missing)
+
+
+def main():
+    """Precomputes features of all subjects in the graph"""
+    parser = argparse.ArgumentParser(
+        description='Precompute features of entities')
+    parser.add_argument(
+        'triples_data',
+        help='Path to directory with triple files or path to triple file')
+    parser.add_argument('directory', help='Feature store directory')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Amount of worker processes')
+    parser.add_argument("-v", "--verbose", help="debug output",
+                        action="store_true")
+
+    # args parsing and sanity checks
+    args = parser.parse_args()
+
+    L.setLevel('INFO')
+    if args.verbose:
+        L.setLevel('DEBUG')
+
+    try:
+        computed = precompute(args.triples_data, args.directory, args.workers)
+    except Exception as e:
+        L.error('Error when precomputing features of `%s`: %s',
+                args.triples_data, e)
+        return 1
+
+    L.info('Computed features of %d entities', computed)
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
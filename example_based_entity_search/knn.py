@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Offline k-nearest-neighbours graph of entities, for "more like these" queries.
+
+    With a single example x, the example-based score of an entity e is |x & e| / |x|
+    (overlap of triples sets). Overlaps of all pairs are the sparse matrix product A * A^T,
+    where A[e, tr] = 1 if triple tr is in the representation of e. It is computed in blocks
+    of rows (entities) by worker processes, walking an inverted index of triples,
+    and only k biggest overlaps of every entity are kept.
+
+    With many examples X, the score is sum(x in X) |x & e| / sum(x, y in X) |x & y|,
+    so merging neighbour lists of examples gives scores of entities found in all of them
+    (lower bounds of the rest). Triples shared by more than KNN_MAX_POSTING entities
+    are left out of representations (sizes included), so the scores are approximate.
+    Candidates can be re-scored exactly with the graph.
+
+    Files:
+        <path>        - header (magic, amount of entities, k; uint32), then a fixed size
+                        record per entity: size of its representation (without common triples)
+                        and k (neighbour id, overlap)
+                        pairs (uint32), unused pairs have id 0xffffffff
+        <path>.terms  - TermDictionary of entities, its ids are record numbers
+
+    Usage:
+        python -m example_based_entity_search.knn build ./pp_data/ neighbours.knn -k 50 --workers 4
+        python -m example_based_entity_search.knn query neighbours.knn http://dbpedia.org/resource/Neil_Armstrong
+
+    Author: Paweł Płatek
+"""
+
+
+import argparse
+import heapq
+import mmap
+import struct
+from array import array
+from collections import Counter
+from decimal import Decimal as D
+from multiprocessing import Pool
+from sys import exit
+from typing import Dict, List, Optional, Tuple
+
+from rdflib import URIRef
+
+from example_based_entity_search.config import (KNN_BLOCK_SIZE, KNN_K,
+                                                KNN_MAX_POSTING, L)
+from example_based_entity_search.entity_search_lib import (
+    Ranking, _entity_triples_features, _finish_ranking, rank_examples_based)
+from example_based_entity_search.lsh import _triple_hash, graph_entities
+from example_based_entity_search.term_dictionary import TermDictionary
+from example_based_entity_search.utils import PPGraph, load_data
+
+MAGIC = b'EBKN'
+HEADER = struct.Struct('<4sII')
+NO_NEIGHBOUR = 0xffffffff
+
+Postings = Dict[int, array]
+
+# representations and inverted index of build worker processes
+_block_representations: List[array] = []
+_block_postings: Postings = dict()
+
+
+def _init_block_worker(representations: List[array], postings: Postings):
+    global _block_representations, _block_postings
+    _block_representations = representations
+    _block_postings = postings
+
+
+def _record(size: int, neighbours: List[Tuple[int, int]], k: int) -> bytes:
+    values = [size]
+    for neighbour_id, overlap in neighbours:
+        values.extend((neighbour_id, overlap))
+    values.extend([NO_NEIGHBOUR, 0] * (k - len(neighbours)))
+    return struct.pack(f'<{1 + 2 * k}I', *values)
+
+
+def _neighbours_block(task: Tuple[int, int, int]) -> Tuple[int, bytes]:
+    """Rows start:end of A * A^T, k biggest values of every row."""
+    start, end, k = task
+    records = []
+    for entity_id in range(start, end):
+        overlaps: Counter = Counter()
+        for triple_hash in _block_representations[entity_id]:
+            overlaps.update(_block_postings.get(triple_hash, ()))
+        del overlaps[entity_id]
+        # the biggest overlaps, smaller ids first on ties
+        neighbours = heapq.nlargest(k, overlaps.items(),
+                                    key=lambda item: (item[1], -item[0]))
+        records.append(_record(
+            len(_block_representations[entity_id]), neighbours, k))
+    return start, b''.join(records)
+
+
+def build_neighbours(graph: PPGraph, path: str, k: int = KNN_K, workers: int = 1,
+                     block_size: int = KNN_BLOCK_SIZE, max_posting: int = KNN_MAX_POSTING):
+    """Computes k nearest neighbours of all subjects in the graph and saves them.
+
+    Args:
+        graph: RDF triples to use
+        path: file to save neighbours in (and `path`.terms)
+        k: amount of neighbours of every entity
+        workers: amount of processes computing blocks
+        block_size: amount of entities in a block
+        max_posting: triples shared by more entities are skipped, they say little
+                    about similarity and make the product quadratic
+    """
+    terms = TermDictionary.build([str(entity)
+                                  for entity in graph_entities(graph)])
+    entities = [URIRef(term) for term in terms]
+    L.info('Computing representations of %d entities', len(entities))
+
+    representations: List[array] = []
+    postings: Postings = dict()
+    for entity_id, entity in enumerate(entities):
+        hashes = array('Q', sorted(set([_triple_hash(tr)
+                                        for tr in _entity_triples_features(graph, entity)])))
+        representations.append(hashes)
+        for triple_hash in hashes:
+            postings.setdefault(triple_hash, array('I')).append(entity_id)
+
+    common = [triple_hash for triple_hash,
+              posting in postings.items() if len(posting) > max_posting]
+    for triple_hash in common:
+        del postings[triple_hash]
+    L.info('Inverted index of %d triples (%d common skipped)',
+           len(postings), len(common))
+
+    # sizes match overlaps, both without common triples
+    if common:
+        representations = [array('Q', [triple_hash for triple_hash in hashes if triple_hash in postings])
+                           for hashes in representations]
+
+    tasks = [(start, min(start + block_size, len(entities)), k)
+             for start in range(0, len(entities), block_size)]
+    blocks: Dict[int, bytes] = dict()
+    with Pool(workers, initializer=_init_block_worker, initargs=(representations, postings)) as pool:
+        for i, (start, records) in enumerate(pool.imap_unordered(_neighbours_block, tasks)):
+            blocks[start] = records
+            L.info(' ~> block no %d / %d', i + 1, len(tasks))
+
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(entities), k))
+        for start in sorted(blocks):
+            f.write(blocks[start])
+    terms.save(path + '.terms')
+    L.info('Saved %d neighbours of %d entities', k, len(entities))
+
+
+class NeighbourGraph:
+    """Memory-mapped neighbour lists saved with build_neighbours."""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count, self.k = HEADER.unpack_from(self._buffer, 0)
+        if magic != MAGIC:
+            raise ValueError(f'`{path}` is not a neighbours file')
+        self._record = struct.Struct(f'<{1 + 2 * self.k}I')
+        self._terms = TermDictionary.open(path + '.terms')
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __contains__(self, entity: URIRef) -> bool:
+        return self._terms.id(str(entity)) is not None
+
+    def _read(self, entity: URIRef) -> Optional[Tuple[int, List[Tuple[int, int]]]]:
+        """Size of the representation and (overlap, neighbour id) pairs."""
+        entity_id = self._terms.id(str(entity))
+        if entity_id is None:
+            return None
+        values = self._record.unpack_from(
+            self._buffer, HEADER.size + self._record.size * entity_id)
+        neighbours = [(values[i + 1], values[i]) for i in range(1, len(values), 2)
+                      if values[i] != NO_NEIGHBOUR]
+        return values[0], neighbours
+
+    def neighbours(self, entity: URIRef) -> List[Tuple[int, URIRef]]:
+        """(overlap, neighbour) pairs, the biggest overlap first."""
+        record = self._read(entity)
+        if record is None:
+            return []
+        return [(overlap, URIRef(self._terms.term(neighbour_id))) for overlap, neighbour_id in record[1]]
+
+    def rank(self, examples: List[URIRef], graph: Optional[PPGraph] = None,
+             top_k: Optional[int] = None) -> Ranking:
+        """Ranks neighbours of examples with the example-based model.
+
+        Args:
+            examples: example entities
+            graph: if provided, merged neighbours are re-scored exactly with it,
+                        otherwise scores ignore common triples (see build_neighbours)
+            top_k: return only that many best entities
+
+        Returns:
+            Ranking, best matching entities comes first
+        """
+        records = dict()
+        for example in examples:
+            record = self._read(example)
+            if record is None:
+                L.warning('No neighbours of `%s`', example)
+                continue
+            records[example] = (record[0], {URIRef(self._terms.term(neighbour_id)): overlap
+                                            for overlap, neighbour_id in record[1]})
+        if not records:
+            return D(0), []
+
+        # sum(x in X) |x & e|
+        overlaps: Counter = Counter()
+        for _, neighbours in records.values():
+            overlaps.update(neighbours)
+        candidates = sorted(set(overlaps).difference(examples))
+        L.info('KNN: %d candidates from %d examples',
+               len(candidates), len(records))
+
+        if graph is not None:
+            ap, ranking = rank_examples_based(
+                graph, ('', examples), candidates)
+            return ap, ranking[:top_k]
+
+        # sum(x, y in X) |x & y|, overlaps of examples not in their lists are unknown (0)
+        denominator = D(sum([size + overlaps[example]
+                        for example, (size, _) in records.items()]))
+        ranking = [(D(overlaps[entity]) / denominator, entity)
+                   for entity in candidates]
+        examples_ranking = [(D(records[example][0] + overlaps[example]) / denominator, example)
+                            for example in records]
+        ap, ranking = _finish_ranking(ranking, examples_ranking, examples)
+        return ap, ranking[:top_k]
+
+
+def main():
+    """Builds or queries neighbours graph"""
+    parser = argparse.ArgumentParser(
+        description='Entities k-nearest-neighbours graph')
+    parser.add_argument("-v", "--verbose", help="debug output",
+                        action="store_true")
+    subparsers = parser.add_subparsers(dest='command')
+
+    parser_build = subparsers.add_parser(
+        'build', help='Compute neighbours of all entities')
+    parser_build.add_argument(
+        'triples_data',
+        help='Path to directory with triple files or path to triple file')
+    parser_build.add_argument('out_file', help='File to save neighbours in')
+    parser_build.add_argument('-k', type=int, default=KNN_K,
+                              help='Amount of neighbours of every entity')
+    parser_build.add_argument('--workers', type=int, default=4,
+                              help='Amount of worker processes')
+    parser_build.add_argument('--block_size', type=int, default=KNN_BLOCK_SIZE,
+                              help='Amount of entities processed by a worker at once')
+
+    parser_query = subparsers.add_parser(
+        'query', help='Rank entities similar to examples')
+    parser_query.add_argument('neighbours_file', help='File with neighbours')
+    parser_query.add_argument('examples', nargs='+', help='Example URIs')
+    parser_query.add_argument('--top_k', type=int, default=10)
+    parser_query.add_argument(
+        '--rescore', help='Re-score candidates exactly with triples from this path')
+
+    # args parsing and sanity checks
+    args = parser.parse_args()
+
+    L.setLevel('INFO')
+    if args.verbose:
+        L.setLevel('DEBUG')
+
+    if args.command == 'build':
+        try:
+            graph = load_data(args.triples_data)
+        except Exception as e:
+            L.error('Error when loading data from `%s`: %s',
+                    args.triples_data, e)
+            return 1
+        build_neighbours(graph, args.out_file, args.k,
+                         args.workers, args.block_size)
+
+    elif args.command == 'query':
+        graph = None
+        try:
+            neighbours = NeighbourGraph(args.neighbours_file)
+            if args.rescore:
+                graph = load_data(args.rescore)
+        except Exception as e:
+            L.error('Error when loading `%s`: %s', args.neighbours_file, e)
+            return 1
+        _, ranking = neighbours.rank(
+            list(map(URIRef, args.examples)), graph, args.top_k)
+        for score, entity in ranking:
+            print(f'{entity} - {score}')
+
+    else:
+        parser.print_help()
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
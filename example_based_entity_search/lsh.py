@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""MinHash signatures and LSH index of entities triples sets.
+
+    Example-based model scores overlap of triples sets, so entities similar to examples
+    have similar MinHash signatures. Signatures are split into bands of rows, entities
+    with identical band land in the same bucket. At query time only entities colliding
+    with examples in at least `min_collisions` bands are scored exactly.
+
+    More bands with less rows = better recall, more candidates to score.
+
+    Usage:
+        python -m example_based_entity_search.lsh ./pp_data/ entities.lsh --bands 64 --rows 1
+
+    Author: Paweł Płatek
+"""
+
+
+import argparse
+import pickle
+from collections import Counter, defaultdict
+from hashlib import blake2b
+from random import Random
+from sys import exit
+from typing import Counter as CounterType
+from typing import DefaultDict, Iterable, List, Optional, Set, Tuple
+
+from rdflib import URIRef
+
+from example_based_entity_search.config import (LSH_BANDS,
+                                                LSH_MIN_COLLISIONS, LSH_ROWS,
+                                                L)
+from example_based_entity_search.entity_search_lib import (
+    Triple, _triples_set_representation)
+from example_based_entity_search.utils import PPGraph, load_data
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 64) - 1
+
+Signature = Tuple[int, ...]
+
+
+def _triple_hash(tr: Triple) -> int:
+    """Stable (across processes) 64 bit hash of the triple."""
+    text = ' '.join(['' if node is None else node.n3() for node in tr])
+    return int.from_bytes(blake2b(text.encode('utf8'), digest_size=8).digest(), 'little')
+
+
+class MinHashLSH:
+    """Locality sensitive hashing index of entities."""
+
+    def __init__(self, bands: int = LSH_BANDS, rows: int = LSH_ROWS, seed: int = 1):
+        self.bands = bands
+        self.rows = rows
+        random = Random(seed)
+        self._permutations = [(random.randint(1, MERSENNE_PRIME - 1), random.randint(0, MERSENNE_PRIME - 1))
+                              for _ in range(bands * rows)]
+        self._buckets: List[DefaultDict[Signature, Set[URIRef]]] = [
+            defaultdict(set) for _ in range(bands)]
+        self.entities: Set[URIRef] = set()
+
+    def signature(self, representation: Iterable[Triple]) -> Signature:
+        """MinHash signature of the set of triples."""
+        hashes = [_triple_hash(tr) % MERSENNE_PRIME for tr in representation]
+        if not hashes:
+            return tuple([MAX_HASH] * len(self._permutations))
+        return tuple([min([(a * h + b) % MERSENNE_PRIME for h in hashes])
+                      for a, b in self._permutations])
+
+    def _bands(self, signature: Signature) -> Iterable[Tuple[int, Signature]]:
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows]
+
+    def add(self, entity: URIRef, representation: Iterable[Triple]):
+        for band, band_signature in self._bands(self.signature(representation)):
+            self._buckets[band][band_signature].add(entity)
+        self.entities.add(entity)
+
+    def add_entities(self, graph: PPGraph, entities: Iterable[URIRef]):
+        for i, entity in enumerate(entities):
+            if i % 1000 == 0:
+                L.info(' ~> indexing entity no %d', i)
+            self.add(entity, _triples_set_representation(graph, entity))
+
+    def update(self, graph: PPGraph, entities: Iterable[URIRef]):
+        """Indexes indexed entities again, f.e. after a changeset changed them."""
+        changed = self.entities.intersection(entities)
+        if not changed:
+            return
+        # old signatures are not kept, so search all buckets
+        for buckets in self._buckets:
+            for band_signature in list(buckets):
+                buckets[band_signature].difference_update(changed)
+                if not buckets[band_signature]:
+                    del buckets[band_signature]
+        self.add_entities(graph, sorted(changed))
+
+    def collisions(self, representation: Iterable[Triple]) -> CounterType[URIRef]:
+        """Counts bands in which entities collide with the representation."""
+        counts: CounterType[URIRef] = Counter()
+        for band, band_signature in self._bands(self.signature(representation)):
+            counts.update(self._buckets[band].get(band_signature, ()))
+        return counts
+
+    def candidates(self, graph: PPGraph, examples: List[URIRef], entities_to_rank: Optional[List[URIRef]] = None,
+                   min_collisions: int = LSH_MIN_COLLISIONS) -> List[URIRef]:
+        """Finds entities similar to any of examples.
+
+        Args:
+            graph: RDF triples to use
+            examples: example entities
+            entities_to_rank: if provided, return only these entities (in the same order)
+            min_collisions: required amount of bands colliding with an example
+
+        Returns:
+            candidates to score
+        """
+        found: Set[URIRef] = set()
+        for example in examples:
+            collisions = self.collisions(
+                _triples_set_representation(graph, example))
+            found.update([entity for entity, count in collisions.items()
+                          if count >= min_collisions])
+        found.difference_update(examples)
+
+        if entities_to_rank:
+            candidates = [
+                entity for entity in entities_to_rank if entity in found]
+            L.info('LSH: %d / %d entities collide with examples',
+                   len(candidates), len(entities_to_rank))
+        else:
+            candidates = sorted(found)
+            L.info('LSH: %d / %d indexed entities collide with examples',
+                   len(candidates), len(self.entities))
+        return candidates
+
+    # index is pickled as builtin types only, so it can be loaded
+    # no matter whether it was saved by this module run as a script
+    def save(self, path: str):
+        state = {
+            'bands': self.bands,
+            'rows': self.rows,
+            'permutations': self._permutations,
+            'buckets': [dict(buckets) for buckets in self._buckets],
+            'entities': self.entities
+        }
+        with open(path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path: str) -> 'MinHashLSH':
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        if not isinstance(state, dict) or 'permutations' not in state:
+            raise ValueError(f'`{path}` is not LSH index')
+        index = MinHashLSH(state['bands'], state['rows'])
+        index._permutations = state['permutations']
+        for buckets, saved_buckets in zip(index._buckets, state['buckets']):
+            buckets.update(saved_buckets)
+        index.entities = state['entities']
+        return index
+
+
+def graph_entities(graph: PPGraph) -> List[URIRef]:
+    """All URIs that are subjects of some triple."""
+    return sorted(set([s for s in graph.subjects() if isinstance(s, URIRef)]))
+
+
+def main():
+    """Builds LSH index of all entities in the graph"""
+    parser = argparse.ArgumentParser(
+        description='Build MinHash LSH index of entities')
+    parser.add_argument(
+        'triples_data',
+        help='Path to directory with triple files or path to triple file')
+    parser.add_argument('out_file', help='File to save index in')
+    parser.add_argument('--bands', type=int, default=LSH_BANDS,
+                        help='Amount of bands, more bands = better recall')
+    parser.add_argument('--rows', type=int, default=LSH_ROWS,
+                        help='Amount of rows in a band, more rows = less candidates')
+    parser.add_argument("-v", "--verbose", help="debug output",
+                        action="store_true")
+
+    # args parsing and sanity checks
+    args = parser.parse_args()
+
+    L.setLevel('INFO')
+    if args.verbose:
+        L.setLevel('DEBUG')
+
+    try:
+        graph = load_data(args.triples_data)
+    except Exception as e:
+        L.error('Error when loading data from `%s`: %s', args.triples_data, e)
+        return 1
+
+    index = MinHashLSH(args.bands, args.rows)
+    index.add_entities(graph, graph_entities(graph))
+    index.save(args.out_file)
+    L.info('Indexed %d entities', len(index.entities))
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Manifest of triples files, for lazy loading of entities a query needs.
+
+    Triples files (N-Quads or N-Triples dumps) are scanned once, line by line, and
+    every entity is mapped to byte ranges of lines where it is the subject or the object.
+    Labels of entities are mapped separately, text representations need labels of linked
+    entities only. Amount of distinct triples and degree statistics are recorded too,
+    so models see the same graph size and hubs as with all files loaded.
+
+    The graph opened from the manifest starts empty. Rankings call graph.require with
+    examples and candidates of the query, which reads their ranges (and labels of entities
+    they link to) into the in-memory store. Loaded entities are kept for next queries.
+
+    Usage:
+        python -m example_based_entity_search.manifest ./pp_data/ pp_data/all.manifest
+        ebes-rank pp_data/all.manifest -s pp_data/sample1.yml
+
+    Author: Paweł Płatek
+"""
+
+
+import argparse
+import pickle
+import re
+from collections import Counter, defaultdict
+from glob import glob
+from hashlib import blake2b
+from os.path import abspath, getmtime, getsize, isdir, isfile
+from pathlib import Path
+from sys import exit
+from threading import Lock
+from typing import (DefaultDict, Dict, Iterable, Iterator, List, Match,
+                    Optional, Set, Tuple)
+
+from rdflib import ConjunctiveGraph, URIRef
+from rdflib.util import guess_format
+
+from example_based_entity_search.config import (HUB_DEGREE, LANGS,
+                                                MANIFEST_EXTENSION, L)
+from example_based_entity_search.degrees import DegreeStats
+from example_based_entity_search.utils import LABEL_PREDICATES, PPGraph
+
+# formats with one triple per line, ranges of lines can be parsed on their own
+LINE_FORMATS = ('nquads', 'nt')
+LINE_FILE_EXTENSIONS = ['nq', 'nt']
+
+# subject, predicate, object of N-Triples (or N-Quads) line; URIs and language of literals are captured
+_TRIPLE_LINE = re.compile(
+    rb'\s*(<([^>]*)>|_:\S+)\s+<([^>]*)>\s+(<([^>]*)>|_:\S+|"(?:[^"\\]|\\.)*"(?:@([\w-]+)|\^\^<[^>]*>)?)')
+_LABEL_PREDICATES = {str(label_predicate).encode('utf8') for label_predicate in LABEL_PREDICATES}
+
+Range = Tuple[int, int, int]  # file id, offset, length
+
+
+def _add_range(ranges: List[Range], file_id: int, offset: int, length: int):
+    """Appends the line, merged with the previous one if they are adjacent."""
+    if ranges:
+        last_file_id, last_offset, last_length = ranges[-1]
+        if last_file_id == file_id and last_offset + last_length == offset:
+            ranges[-1] = (file_id, last_offset, last_length + length)
+            return
+        if ranges[-1] == (file_id, offset, length):
+            return
+    ranges.append((file_id, offset, length))
+
+
+def _triples_files(triples_data: str) -> List[str]:
+    if not isdir(triples_data):
+        if guess_format(triples_data) not in LINE_FORMATS:
+            raise ValueError(
+                f'`{triples_data}` is not N-Quads or N-Triples file')
+        return [triples_data]
+
+    triples_files = []
+    for extension in LINE_FILE_EXTENSIONS:
+        triples_files.extend(sorted(glob(f'{triples_data}/*.{extension}')))
+    if glob(f'{triples_data}/*.rdf'):
+        L.warning('Only N-Quads and N-Triples files are put in the manifest, `.rdf` files are skipped')
+    return triples_files
+
+
+def _triple_lines(triples_file: str, ranges: Optional[Iterable[Tuple[int, int]]] = None) -> \
+        Iterator[Tuple[int, bytes, Match[bytes]]]:
+    """Offsets, lines and their matches, from the ranges (offset, length) of the file or from all of it."""
+    with open(triples_file, 'rb') as f:
+        if ranges is None:
+            chunks: Iterable[Tuple[int, Iterable[bytes]]] = [(0, f)]
+        else:
+            chunks = ((offset, _read_range(f, offset, length)) for offset, length in ranges)
+        for offset, lines in chunks:
+            for line in lines:
+                match = _TRIPLE_LINE.match(line)
+                if match is not None:
+                    yield offset, line, match
+                elif line.strip() and not line.lstrip().startswith(b'#'):
+                    L.warning('Skipping not parsed line of `%s`: %s',
+                              triples_file, line[:100])
+                offset += len(line)
+
+
+def _read_range(f, offset: int, length: int) -> List[bytes]:
+    f.seek(offset)
+    return f.read(length).splitlines(keepends=True)
+
+
+def _triple_key(match: Match[bytes]) -> bytes:
+    return blake2b(b' '.join(match.group(1, 3, 4)), digest_size=8).digest()
+
+
+def _used(match: Match[bytes]) -> bool:
+    """Same as utils._check_triple, without parsing the line."""
+    if match.group(2) is None or match.group(4).startswith(b'_:'):
+        return False
+    language = match.group(6)
+    return (language.decode('utf8') if language is not None else None) in LANGS
+
+
+def build_manifest(triples_data: str, path: str, hub_degree: int = HUB_DEGREE):
+    """Scans triples files and saves their manifest.
+
+    Args:
+        triples_data: path to N-Quads (N-Triples) file or directory with them
+        path: file to save the manifest in
+        hub_degree: entities with more links are hubs, their links per predicate are counted
+    """
+    triples_files = _triples_files(triples_data)
+    entities: Dict[str, List[Range]] = dict()
+    labels: Dict[str, List[Range]] = dict()
+    seen: Set[bytes] = set()
+    in_degrees: Counter = Counter()
+    out_degrees: Counter = Counter()
+
+    for file_id, triples_file in enumerate(triples_files):
+        L.info('Scanning %d / %d (`%s`)', file_id + 1,
+               len(triples_files), triples_file)
+        for offset, line, match in _triple_lines(triples_file):
+            triple_subject, triple_object = match.group(2), match.group(5)
+            if triple_subject is not None:
+                _add_range(entities.setdefault(triple_subject.decode('utf8'), []),
+                           file_id, offset, len(line))
+                if match.group(3) in _LABEL_PREDICATES:
+                    _add_range(labels.setdefault(triple_subject.decode('utf8'), []),
+                               file_id, offset, len(line))
+            if triple_object is not None and triple_object != triple_subject:
+                _add_range(entities.setdefault(triple_object.decode('utf8'), []),
+                           file_id, offset, len(line))
+
+            # the same triple may be in many files
+            key = _triple_key(match)
+            if key in seen:
+                continue
+            seen.add(key)
+            if _used(match):
+                out_degrees[triple_subject.decode('utf8')] += 1
+                if triple_object is not None:  # degrees of literals are never read
+                    in_degrees[triple_object.decode('utf8')] += 1
+
+    # links per predicate of hubs, from their lines only
+    in_predicates: Dict[str, Dict[str, int]] = dict()
+    out_predicates: Dict[str, Dict[str, int]] = dict()
+    for degrees, predicates, node_group in [(in_degrees, in_predicates, 5), (out_degrees, out_predicates, 2)]:
+        for node, degree in degrees.items():
+            if degree <= hub_degree:
+                continue
+            node_seen: Set[bytes] = set()
+            counts: Counter = Counter()
+            by_file: DefaultDict[int, List[Tuple[int, int]]] = defaultdict(list)
+            for file_id, offset, length in entities[node]:
+                by_file[file_id].append((offset, length))
+            for file_id, file_ranges in by_file.items():
+                for _, _, match in _triple_lines(triples_files[file_id], file_ranges):
+                    key = _triple_key(match)
+                    if match.group(node_group) == node.encode('utf8') and _used(match) and key not in node_seen:
+                        node_seen.add(key)
+                        counts[match.group(3).decode('utf8')] += 1
+            predicates[node] = dict(counts)
+
+    state = {
+        'files': [(abspath(triples_file), getsize(triples_file), getmtime(triples_file))
+                  for triples_file in triples_files],
+        'size': len(seen),
+        'entities': entities,
+        'labels': labels,
+        'hub_degree': hub_degree,
+        'in_degrees': dict(in_degrees),
+        'out_degrees': dict(out_degrees),
+        'in_predicates': in_predicates,
+        'out_predicates': out_predicates
+    }
+    with open(path, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    L.info('Saved manifest of %d entities, %d triples in %d files',
+           len(entities), len(seen), len(triples_files))
+
+
+class Manifest:
+    """Byte ranges of entities in triples files, loads them into its graph on demand.
+
+    Manifest remembers which entities were loaded, so it backs a single graph.
+    """
+
+    def __init__(self, state: Dict):
+        self.files: List[Tuple[str, int, float]] = state['files']
+        self.size: int = state['size']
+        self.entities: Dict[str, List[Range]] = state['entities']
+        self.labels: Dict[str, List[Range]] = state['labels']
+        self._state = state
+        self._loaded: Set[URIRef] = set()
+        self._labelled: Set[URIRef] = set()
+        self._lock = Lock()
+
+    @staticmethod
+    def load(path: str) -> 'Manifest':
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        if not isinstance(state, dict) or 'entities' not in state:
+            raise ValueError(f'`{path}` is not a manifest')
+        for triples_file, size, mtime in state['files']:
+            if not isfile(triples_file) or getsize(triples_file) != size or getmtime(triples_file) != mtime:
+                raise ValueError(
+                    f'`{triples_file}` changed since `{path}` was built, build the manifest again')
+        return Manifest(state)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = Lock()
+
+    def degrees(self) -> DegreeStats:
+        stats = DegreeStats(self._state['hub_degree'])
+        for name in ['in_degrees', 'out_degrees']:
+            getattr(stats, name).update({URIRef(node): degree
+                                         for node, degree in self._state[name].items()})
+        for name in ['in_predicates', 'out_predicates']:
+            getattr(stats, name).update({URIRef(node): Counter({URIRef(triple_predicate): count
+                                                                for triple_predicate, count in counts.items()})
+                                         for node, counts in self._state[name].items()})
+        return stats
+
+    def graph(self) -> PPGraph:
+        """Empty graph with size and degrees of all files, filled by graph.require."""
+        graph = PPGraph(ConjunctiveGraph())
+        graph.sources = [triples_file for triples_file, _, _ in self.files]
+        graph._size = self.size
+        graph.degrees = self.degrees()
+        graph.tiers.append(self)
+        return graph
+
+    def _load_ranges(self, graph: PPGraph, ranges: Iterable[Range]) -> int:
+        by_file: DefaultDict[int, Set[Tuple[int, int]]] = defaultdict(set)
+        for file_id, offset, length in ranges:
+            by_file[file_id].add((offset, length))
+
+        loaded = 0
+        for file_id, file_ranges in sorted(by_file.items()):
+            triples_file = self.files[file_id][0]
+            with open(triples_file, 'rb') as f:
+                chunks = []
+                for offset, length in sorted(file_ranges):
+                    f.seek(offset)
+                    chunks.append(f.read(length))
+            data = b''.join(chunks)
+            loaded += len(data)
+            graph.store.parse(data=data.decode('utf8'), format=guess_format(triples_file),
+                              publicID=Path(triples_file).as_uri())
+        return loaded
+
+    def require(self, graph: PPGraph, entities: Iterable[URIRef]):
+        """Loads triples of the entities and labels of entities they link to.
+
+        Graph version is not changed: representations of loaded entities are complete,
+        so nothing computed before is invalidated. The graph is locked for writing while
+        triples are parsed into it, so rankings running in other threads wait.
+        """
+        with self._lock:
+            missing = [entity for entity in dict.fromkeys(entities)
+                       if isinstance(entity, URIRef) and entity not in self._loaded]
+            if not missing:
+                return
+            with graph.lock.write():
+                loaded = self._load_ranges(graph, [triples_range for entity in missing
+                                                   for triples_range in self.entities.get(str(entity), ())])
+                self._loaded.update(missing)
+
+                linked = {triple_object for entity in missing for triple_object in graph.objects(entity)
+                          if isinstance(triple_object, URIRef)}
+                linked.difference_update(self._loaded)
+                linked.difference_update(self._labelled)
+                loaded += self._load_ranges(graph, [triples_range for entity in linked
+                                                    for triples_range in self.labels.get(str(entity), ())])
+                self._labelled.update(linked)
+            L.info('Loaded %d entities and labels of %d linked entities (%d bytes)',
+                   len(missing), len(linked), loaded)
+
+
+def main():
+    """Builds manifest of triples files"""
+    parser = argparse.ArgumentParser(
+        description='Build manifest of triples files for lazy loading')
+    parser.add_argument(
+        'triples_data',
+        help='Path to directory with N-Quads (N-Triples) files or path to such file')
+    parser.add_argument(
+        'out_file', help=f'File to save the manifest in (use `.{MANIFEST_EXTENSION}` extension)')
+    parser.add_argument('--hub_degree', type=int, default=HUB_DEGREE,
+                        help='Count links per predicate of entities with more links')
+    parser.add_argument("-v", "--verbose", help="debug output",
+                        action="store_true")
+
+    # args parsing and sanity checks
+    args = parser.parse_args()
+
+    L.setLevel('INFO')
+    if args.verbose:
+        L.setLevel('DEBUG')
+
+    try:
+        build_manifest(args.triples_data, args.out_file, args.hub_degree)
+    except Exception as e:
+        L.error('Error when building manifest from `%s`: %s',
+                args.triples_data, e)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
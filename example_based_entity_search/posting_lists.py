@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Type and category posting lists for candidates pruning.
+
+    Every type (rdf:type object) and category (dct:subject object) is mapped to
+    the bitmap of entities having it. Bitmaps are roaring-style: entity ids are
+    split by high 16 bits into containers, sparse containers are sorted arrays
+    of low 16 bits, dense ones are 2^16 bit sets (python ints). Intersections
+    and unions work on whole containers, so pruning candidates by types is
+    much cheaper than scoring them.
+
+    Usage:
+        python -m example_based_entity_search.posting_lists ./pp_data/ types.idx
+
+    Author: Paweł Płatek
+"""
+
+
+import argparse
+import pickle
+from array import array
+from sys import exit
+from typing import (Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple,
+                    Union)
+
+from rdflib import RDF, URIRef
+from rdflib.namespace import DCTERMS
+
+from example_based_entity_search.config import L
+from example_based_entity_search.utils import PPGraph, load_data
+
+# predicates linking entities to types and categories
+TYPE_PREDICATES = (RDF.type, DCTERMS.subject,
+                   URIRef('http://www.w3.org/2004/02/skos/core#subject'),
+                   URIRef('http://purl.org/dc/elements/1.1/subject'))
+
+ARRAY_MAX_SIZE = 4096  # bigger containers are stored as bit sets
+Container = Union[array, int]
+
+
+def _cardinality(container: Container) -> int:
+    if isinstance(container, int):
+        return bin(container).count('1')
+    return len(container)
+
+
+def _to_bits(container: Union[Container, Iterable[int]]) -> int:
+    if isinstance(container, int):
+        return container
+    bits = 0
+    for value in container:
+        bits |= 1 << value
+    return bits
+
+
+def _iter_bits(bits: int) -> Iterator[int]:
+    while bits:
+        lowest = bits & -bits
+        yield lowest.bit_length() - 1
+        bits ^= lowest
+
+
+def _optimize(bits: int) -> Optional[Container]:
+    """Chooses the smaller representation, None for empty container."""
+    if bits == 0:
+        return None
+    if _cardinality(bits) <= ARRAY_MAX_SIZE:
+        return array('H', _iter_bits(bits))
+    return bits
+
+
+def _container_and(first: Container, second: Container) -> Optional[Container]:
+    if isinstance(first, int) and isinstance(second, int):
+        return _optimize(first & second)
+    if isinstance(first, int):
+        first, second = second, first
+    assert not isinstance(first, int)
+    if isinstance(second, int):
+        result = array('H', [value for value in first if (second >> value) & 1])
+    else:
+        result = array('H', sorted(set(first).intersection(second)))
+    return result if len(result) > 0 else None
+
+
+def _container_or(first: Container, second: Container) -> Container:
+    if isinstance(first, int) or isinstance(second, int) or len(first) + len(second) > ARRAY_MAX_SIZE:
+        result = _optimize(_to_bits(first) | _to_bits(second))
+        assert result is not None
+        return result
+    return array('H', sorted(set(first).union(second)))
+
+
+class Bitmap:
+    """Compressed set of non-negative integers."""
+
+    def __init__(self, values: Iterable[int] = ()):
+        self._containers: Dict[int, Container] = dict()
+        grouped: Dict[int, Set[int]] = dict()
+        for value in values:
+            grouped.setdefault(value >> 16, set()).add(value & 0xffff)
+        for key, low_values in grouped.items():
+            if len(low_values) > ARRAY_MAX_SIZE:
+                self._containers[key] = _to_bits(low_values)
+            else:
+                self._containers[key] = array('H', sorted(low_values))
+
+    @classmethod
+    def _from_containers(cls, containers: Dict[int, Container]) -> 'Bitmap':
+        bitmap = cls()
+        bitmap._containers = containers
+        return bitmap
+
+    def __len__(self) -> int:
+        return sum([_cardinality(container) for container in self._containers.values()])
+
+    def __bool__(self) -> bool:
+        return len(self._containers) > 0
+
+    def __contains__(self, value: int) -> bool:
+        container = self._containers.get(value >> 16)
+        if container is None:
+            return False
+        if isinstance(container, int):
+            return bool((container >> (value & 0xffff)) & 1)
+        return (value & 0xffff) in container
+
+    def __iter__(self) -> Iterator[int]:
+        for key in sorted(self._containers):
+            container = self._containers[key]
+            low_values = _iter_bits(container) if isinstance(
+                container, int) else container
+            for value in low_values:
+                yield (key << 16) | value
+
+    def __and__(self, other: 'Bitmap') -> 'Bitmap':
+        containers = dict()
+        for key in set(self._containers).intersection(other._containers):
+            container = _container_and(
+                self._containers[key], other._containers[key])
+            if container is not None:
+                containers[key] = container
+        return Bitmap._from_containers(containers)
+
+    def __or__(self, other: 'Bitmap') -> 'Bitmap':
+        containers = dict(self._containers)
+        for key, container in other._containers.items():
+            if key in containers:
+                containers[key] = _container_or(containers[key], container)
+            else:
+                containers[key] = container
+        return Bitmap._from_containers(containers)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Bitmap):
+            return NotImplemented
+        return list(self) == list(other)
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate size of the data."""
+        return sum([(container.bit_length() + 7) // 8 if isinstance(container, int)
+                    else container.itemsize * len(container)
+                    for container in self._containers.values()])
+
+
+def at_least(bitmaps: List[Bitmap], k: int) -> Bitmap:
+    """Values present in at least k of the bitmaps.
+
+    counts[j] keeps values found in at least j + 1 bitmaps so far,
+    so it needs len(bitmaps) * k bitmap operations.
+    """
+    counts: List[Bitmap] = [Bitmap() for _ in range(k)]
+    for bitmap in bitmaps:
+        for j in range(k - 1, 0, -1):
+            counts[j] = counts[j] | (counts[j - 1] & bitmap)
+        counts[0] = counts[0] | bitmap
+    return counts[k - 1] if k > 0 else Bitmap()
+
+
+class TypeIndex:
+    """Posting lists of entities for every type and category."""
+
+    def __init__(self):
+        self.entities: List[URIRef] = []
+        self._ids: Dict[URIRef, int] = dict()
+        self.postings: Dict[URIRef, Bitmap] = dict()
+
+    @classmethod
+    def from_graph(cls, graph: PPGraph) -> 'TypeIndex':
+        index = cls()
+        types_entities: Dict[URIRef, Set[int]] = dict()
+        for type_predicate in TYPE_PREDICATES:
+            for entity, entity_type in graph.subject_objects(type_predicate):
+                if not isinstance(entity, URIRef) or not isinstance(entity_type, URIRef):
+                    continue
+                types_entities.setdefault(
+                    entity_type, set()).add(index._entity_id(entity))
+        index.postings = {entity_type: Bitmap(ids)
+                          for entity_type, ids in types_entities.items()}
+        L.info('Indexed %d entities with %d types',
+               len(index.entities), len(index.postings))
+        return index
+
+    def apply_changeset(self, added: Iterable[Tuple[Any, Any, Any]], removed: Iterable[Tuple[Any, Any, Any]]):
+        """Updates posting lists of types added to or removed from entities."""
+        def types_ids(triples: Iterable[Tuple[Any, Any, Any]], new_entities: bool) -> Dict[URIRef, Set[int]]:
+            ids: Dict[URIRef, Set[int]] = dict()
+            for entity, triple_predicate, entity_type in triples:
+                if triple_predicate not in TYPE_PREDICATES or not isinstance(entity, URIRef) \
+                        or not isinstance(entity_type, URIRef):
+                    continue
+                if new_entities or entity in self._ids:
+                    ids.setdefault(entity_type, set()).add(
+                        self._entity_id(entity))
+            return ids
+
+        removed_ids = types_ids(removed, False)
+        added_ids = types_ids(added, True)
+        for entity_type in set(removed_ids).union(added_ids):
+            ids = set(self.entities_with(entity_type)).difference(
+                removed_ids.get(entity_type, ())).union(added_ids.get(entity_type, ()))
+            if ids:
+                self.postings[entity_type] = Bitmap(ids)
+            else:
+                self.postings.pop(entity_type, None)
+        L.info('Updated %d posting lists', len(set(removed_ids).union(added_ids)))
+
+    def _entity_id(self, entity: URIRef) -> int:
+        if entity not in self._ids:
+            self._ids[entity] = len(self.entities)
+            self.entities.append(entity)
+        return self._ids[entity]
+
+    def entities_with(self, entity_type: URIRef) -> Bitmap:
+        return self.postings.get(entity_type, Bitmap())
+
+    def ids(self, entities: Iterable[URIRef]) -> Bitmap:
+        """Bitmap of known entities, unknown ones are skipped."""
+        return Bitmap([self._ids[entity] for entity in entities if entity in self._ids])
+
+    def types_of(self, graph: PPGraph, entities: Iterable[URIRef]) -> Set[URIRef]:
+        """Indexed types and categories of the entities."""
+        types = set()
+        for entity in entities:
+            for type_predicate in TYPE_PREDICATES:
+                types.update([entity_type for entity_type in graph.objects(entity, type_predicate)
+                              if entity_type in self.postings])
+        return types
+
+    def sharing_types(self, types: Iterable[URIRef], min_shared_types: int = 1) -> Bitmap:
+        """Entities having at least `min_shared_types` of the types."""
+        bitmaps = [self.entities_with(entity_type) for entity_type in types]
+        if min_shared_types <= 1:
+            result = Bitmap()
+            for bitmap in bitmaps:
+                result = result | bitmap
+            return result
+        return at_least(bitmaps, min_shared_types)
+
+    def candidates(self, graph: PPGraph, examples: List[URIRef], entities_to_rank: Optional[List[URIRef]] = None,
+                   min_shared_types: int = 1) -> List[URIRef]:
+        """Prunes entities not sharing enough types and categories with examples.
+
+        Args:
+            graph: RDF triples to use (to find types of examples)
+            examples: example entities
+            entities_to_rank: if provided, return only these entities (in the same order)
+            min_shared_types: required amount of types shared with all examples
+
+        Returns:
+            candidates to score
+        """
+        examples_types = self.types_of(graph, examples)
+        found = self.sharing_types(examples_types, min_shared_types)
+        examples_ids = self.ids(examples)
+
+        if entities_to_rank:
+            candidates = [entity for entity in entities_to_rank
+                          if entity in self._ids and self._ids[entity] in found
+                          and self._ids[entity] not in examples_ids]
+            L.info('Types: %d / %d entities share at least %d of %d examples types',
+                   len(candidates), len(entities_to_rank), min_shared_types, len(examples_types))
+        else:
+            candidates = sorted([self.entities[entity_id] for entity_id in found
+                                 if entity_id not in examples_ids])
+            L.info('Types: %d / %d indexed entities share at least %d of %d examples types',
+                   len(candidates), len(self.entities), min_shared_types, len(examples_types))
+        return candidates
+
+    # index is pickled as builtin types only, so it can be loaded
+    # no matter whether it was saved by this module run as a script
+    def save(self, path: str):
+        state = {
+            'entities': self.entities,
+            'postings': {entity_type: bitmap._containers for entity_type, bitmap in self.postings.items()}
+        }
+        with open(path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path: str) -> 'TypeIndex':
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        if not isinstance(state, dict) or 'postings' not in state:
+            raise ValueError(f'`{path}` is not types index')
+        index = TypeIndex()
+        index.entities = state['entities']
+        index._ids = {entity: i for i, entity in enumerate(index.entities)}
+        index.postings = {entity_type: Bitmap._from_containers(containers)
+                          for entity_type, containers in state['postings'].items()}
+        return index
+
+
+def main():
+    """Builds posting lists of all types in the graph"""
+    parser = argparse.ArgumentParser(
+        description='Build types and categories posting lists')
+    parser.add_argument(
+        'triples_data',
+        help='Path to directory with triple files or path to triple file')
+    parser.add_argument('out_file', help='File to save index in')
+    parser.add_argument("-v", "--verbose", help="debug output",
+                        action="store_true")
+
+    # args parsing and sanity checks
+    args = parser.parse_args()
+
+    L.setLevel('INFO')
+    if args.verbose:
+        L.setLevel('DEBUG')
+
+    try:
+        graph = load_data(args.triples_data)
+    except Exception as e:
+        L.error('Error when loading data from `%s`: %s', args.triples_data, e)
+        return 1
+
+    index = TypeIndex.from_graph(graph)
+    index.save(args.out_file)
+    L.info('Saved %d posting lists (%d bytes of bitmaps)', len(index.postings),
+           sum([bitmap.nbytes for bitmap in index.postings.values()]))
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Incremental query refinement.
+
+    Session keeps intermediate results of both retrieval models, so adding
+    or removing a single example, relation term or entity to rank updates
+    the rankings without computing everything from scratch.
+
+    Author: Paweł Płatek
+"""
+
+
+from collections import Counter, defaultdict
+from decimal import Decimal as D
+from typing import Counter as CounterType
+from typing import DefaultDict, Dict, List, Set, Tuple
+
+from rdflib import URIRef
+
+from example_based_entity_search.config import L
+from example_based_entity_search.entity_search_lib import (
+    Ranking, Triple, _finish_ranking, _text_representation,
+    _text_term_probability, _triples_set_representation, normalize_relation,
+    rank_combined)
+from example_based_entity_search.utils import PPGraph
+
+
+class RefinementSession:
+    """Query that can be modified incrementally.
+
+    Example-based model score of an entity e is:
+        P(e | theta_X) = sum(tr in e) n(tr, X) / sum(tr in X) n(tr, X)^2
+    where n(tr, X) is the number of examples containing the triple tr.
+    Session stores n(tr, X), the denominator and the nominator of every
+    tracked entity (partial sums). Adding an example changes n(tr, X) only for
+    its triples, so only entities sharing these triples are updated.
+
+    Text-based model score is a product of per-term probabilities,
+    which are stored per entity and computed only for new terms.
+    """
+
+    def __init__(self, graph: PPGraph, topic: str, examples: List[URIRef], entities_to_rank: List[URIRef]):
+        self.graph = graph
+        self.terms: List[str] = []
+        self.examples: List[URIRef] = []
+        self.entities_to_rank: List[URIRef] = []
+
+        # example-based model state
+        self._triples_counts: CounterType[Triple] = Counter()  # n(tr, X)
+        self._denominator = 0  # sum(tr in X) n(tr, X)^2
+        self._partial_sums: Dict[URIRef, int] = dict()  # sum(tr in e) n(tr, X)
+        self._entities_with_triple: DefaultDict[Triple,
+                                                Set[URIRef]] = defaultdict(set)
+
+        # text-based model state
+        self._ni = graph.size
+        self._text_representations: Dict[URIRef, Tuple[Dict, Dict[str, int]]] = dict()
+        self._terms_probabilities: DefaultDict[URIRef,
+                                               Dict[str, D]] = defaultdict(dict)
+
+        # both examples and entities to rank are tracked, maybe twice
+        self._tracked: CounterType[URIRef] = Counter()
+
+        graph.require(list(examples) + list(entities_to_rank))
+        for entity in entities_to_rank:
+            self.add_entity(entity)
+        for example in examples:
+            self.add_example(example)
+        for term in normalize_relation(topic).split():
+            self.add_term(term)
+
+    def _track(self, entity: URIRef):
+        self._tracked[entity] += 1
+        if self._tracked[entity] > 1:
+            return
+
+        self.graph.require([entity])
+        representation = _triples_set_representation(self.graph, entity)
+        self._partial_sums[entity] = sum(
+            [self._triples_counts[tr] for tr in representation])
+        for tr in representation:
+            self._entities_with_triple[tr].add(entity)
+
+    def _untrack(self, entity: URIRef):
+        self._tracked[entity] -= 1
+        if self._tracked[entity] > 0:
+            return
+
+        del self._tracked[entity]
+        for tr in _triples_set_representation(self.graph, entity):
+            self._entities_with_triple[tr].discard(entity)
+            if len(self._entities_with_triple[tr]) == 0:
+                del self._entities_with_triple[tr]
+        del self._partial_sums[entity]
+        self._text_representations.pop(entity, None)
+        self._terms_probabilities.pop(entity, None)
+
+    def _update_triples_counts(self, example: URIRef, change: int):
+        for tr in _triples_set_representation(self.graph, example):
+            count = self._triples_counts[tr]
+            # (n + 1)^2 - n^2 == 2n + 1, (n - 1)^2 - n^2 == -2n + 1
+            self._denominator += 2 * count * change + 1
+            self._triples_counts[tr] = count + change
+            if self._triples_counts[tr] == 0:
+                del self._triples_counts[tr]
+
+            for entity in self._entities_with_triple.get(tr, ()):
+                self._partial_sums[entity] += change
+
+    def add_example(self, example: URIRef):
+        L.info('Adding example %s', example)
+        self._track(example)
+        self._update_triples_counts(example, 1)
+        self.examples.append(example)
+
+    def remove_example(self, example: URIRef):
+        if example not in self.examples:
+            L.warning('%s is not an example', example)
+            return
+        L.info('Removing example %s', example)
+        self.examples.remove(example)
+        self._update_triples_counts(example, -1)
+        self._untrack(example)
+
+    def add_entity(self, entity: URIRef):
+        L.info('Adding entity to rank %s', entity)
+        self._track(entity)
+        self.entities_to_rank.append(entity)
+
+    def remove_entity(self, entity: URIRef):
+        if entity not in self.entities_to_rank:
+            L.warning('%s is not ranked', entity)
+            return
+        L.info('Removing entity to rank %s', entity)
+        self.entities_to_rank.remove(entity)
+        self._untrack(entity)
+
+    def add_term(self, term: str):
+        self.terms.extend(normalize_relation(term).split())
+
+    def remove_term(self, term: str):
+        term = normalize_relation(term)
+        if term not in self.terms:
+            L.warning('`%s` is not in the relation', term)
+            return
+        self.terms.remove(term)
+
+    def _examples_score(self, entity: URIRef) -> D:
+        if self._denominator == 0:
+            return D(0)
+        return D(self._partial_sums[entity]) / D(self._denominator)
+
+    def _text_score(self, entity: URIRef) -> D:
+        if entity not in self._text_representations:
+            representations = _text_representation(self.graph, entity)
+            representations_lengths = {cs_name: sum(cs.values()) for
+                                       cs_name, cs in representations.items()}
+            self._text_representations[entity] = (
+                representations, representations_lengths)
+
+        terms_probabilities = self._terms_probabilities[entity]
+        final_probability = D('1.0')
+        for t in self.terms:
+            if t not in terms_probabilities:
+                terms_probabilities[t] = _text_term_probability(
+                    *self._text_representations[entity], self._ni, t)
+            final_probability *= terms_probabilities[t]
+        return final_probability
+
+    def _ranking(self, score) -> Ranking:
+        ranking = [(score(entity), entity) for entity in self.entities_to_rank]
+        examples_ranking = [(score(entity), entity)
+                            for entity in self.examples]
+        return _finish_ranking(ranking, examples_ranking, self.examples)
+
+    def rank_text_based(self) -> Ranking:
+        return self._ranking(self._text_score)
+
+    def rank_examples_based(self) -> Ranking:
+        return self._ranking(self._examples_score)
+
+    def rankings(self) -> Tuple[Ranking, Ranking, Ranking]:
+        """Computes text-based, example-based and combined rankings."""
+        ranking_text = self.rank_text_based()
+        ranking_example = self.rank_examples_based()
+        return ranking_text, ranking_example, rank_combined((ranking_text, ranking_example))
@@ -0,0 +1,494 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Sharded ranking: graph partitioned by entities, scatter-gather queries.
+
+    Every entity is owned by one shard (chosen by hash of its URI). The shard holds
+    all triples needed to rank the entity: outlinks, inlinks and labels of objects.
+    Shards are served by workers, coordinator preparses the query, broadcasts it
+    and merges top entities from every shard.
+
+    Workers exchange pickles with the coordinator, so anyone who can connect and knows
+    the secret key can run code on them. The key has no default (set it with `--authkey`
+    or SHARD_AUTHKEY_ENV variable, local workers get a random one) and workers listen
+    on 127.0.0.1, unless told otherwise.
+
+    Usage:
+        export EBES_SHARD_AUTHKEY=`openssl rand -hex 32`  # the same on every node
+        ebes-shard partition ./pp_data/ ./shards -n 4
+        ebes-shard worker ./shards/shard0.nq --port 8200  # on every node
+        ebes-shard rank ./shards -s sample.yml --workers node1:8200,node2:8201,...
+        ebes-shard rank ./shards -s sample.yml  # spawns local workers
+
+    Author: Paweł Płatek
+"""
+
+
+import argparse
+import heapq
+import json
+from bisect import bisect_right
+from decimal import Decimal as D
+from itertools import islice
+from multiprocessing import Process
+from multiprocessing.connection import Client, Connection, Listener
+from os import environ, makedirs
+from os.path import basename, dirname
+from os.path import join as path_join
+from secrets import token_bytes
+from sys import exit
+from threading import Thread
+from time import monotonic, sleep
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Set, Tuple
+from zlib import crc32
+
+from example_based_entity_search.config import (SHARD_AUTHKEY_ENV,
+                                                SHARD_CONNECT_TIMEOUT,
+                                                SHARD_PORT, L)
+
+# rdflib and the lib take most of the startup time, they are imported
+# where needed, after arguments are parsed (`--help` needs none of them)
+if TYPE_CHECKING:
+    from rdflib import URIRef
+
+    from example_based_entity_search.entity_search_lib import (Query,
+                                                               Ranking,
+                                                               Triple)
+    from example_based_entity_search.utils import PPGraph
+
+SHARDS_METADATA = 'shards.json'
+
+Address = Tuple[str, int]
+
+
+def shard_of(entity: 'URIRef', shards: int) -> int:
+    """Stable (across processes and nodes) shard number of the entity."""
+    return crc32(str(entity).encode('utf8')) % shards
+
+
+def partition_graph(graph: 'PPGraph', shards: int, out_dir: str) -> List[str]:
+    """Splits the graph into shards, saved as N-Quads files.
+
+    Triple (s, p, o) goes to the shard of s (outlink) and, if o is an URI, to the
+    shard of o (inlink). Shard of s also gets labels of o, for the text representation.
+
+    Returns:
+        paths to shard files
+    """
+    from rdflib import RDFS, URIRef
+
+    from example_based_entity_search.dump_data import n3_format
+
+    makedirs(out_dir, exist_ok=True)
+    shard_files = [path_join(out_dir, f'shard{i}.nq') for i in range(shards)]
+    outputs = [open(shard_file, 'w', encoding='utf8')
+               for shard_file in shard_files]
+    labeled: List[Set[URIRef]] = [set() for _ in range(shards)]
+
+    def write(shard: int, tr: Tuple[Any, Any, Any]):
+        outputs[shard].write(' '.join(map(n3_format, tr)))
+        outputs[shard].write(' .\n')
+
+    L.info('Partitioning graph into %d shards', shards)
+    try:
+        for tr in graph.triples((None, None, None)):
+            triple_subject, _, triple_object = tr
+            subject_shard = shard_of(triple_subject, shards)
+            write(subject_shard, tr)
+
+            if isinstance(triple_object, URIRef):
+                object_shard = shard_of(triple_object, shards)
+                if object_shard != subject_shard:
+                    write(object_shard, tr)
+
+                if triple_object not in labeled[subject_shard]:
+                    labeled[subject_shard].add(triple_object)
+                    for label_tr in graph.triples((triple_object, RDFS.label, None)):
+                        write(subject_shard, label_tr)
+    finally:
+        for output in outputs:
+            output.close()
+
+    with open(path_join(out_dir, SHARDS_METADATA), 'w', encoding='utf8') as f:
+        json.dump({'shards': shards, 'size': graph.size,
+                   'files': list(map(basename, shard_files))}, f)
+
+    return shard_files
+
+
+def _load_metadata(shards_dir: str) -> Dict[str, Any]:
+    with open(path_join(shards_dir, SHARDS_METADATA), 'r', encoding='utf8') as f:
+        return json.load(f)
+
+
+def _worker_score(graph: 'PPGraph', model_name: str, preparsed_data: Any, entities: List['URIRef'],
+                  examples_ranking: List[Tuple[D, 'URIRef']], top_k: Optional[int]) -> Dict[str, Any]:
+    """Scores shard's entities, returns best ones and data needed for global normalization."""
+    from example_based_entity_search.entity_search_lib import get_model
+    scores = get_model(model_name).score_many(preparsed_data, graph, entities)
+    ranking = sorted(zip(scores, entities))
+
+    # for every example: amount of entities ranked above it
+    above_examples = [len(ranking) - bisect_right(ranking, example_item)
+                      for example_item in examples_ranking]
+
+    return {
+        'top': ranking[::-1][:top_k],
+        'min': ranking[0][0] if ranking else None,
+        'max': ranking[-1][0] if ranking else None,
+        'above_examples': above_examples
+    }
+
+
+def _handle_connection(graph: 'PPGraph', info: Dict[str, Any], connection: Connection):
+    """Answers coordinator requests until the connection is closed."""
+    from example_based_entity_search.entity_search_lib import (
+        _triples_set_representation, get_model)
+
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            break
+
+        command, args = request[0], request[1:]
+        try:
+            if command == 'info':
+                response: Any = info
+            elif command == 'representations':
+                entities, = args
+                response = {entity: _triples_set_representation(graph, entity)
+                            for entity in entities}
+            elif command == 'score_examples':
+                model_name, preparsed_data, examples = args
+                response = list(zip(get_model(model_name).score_many(
+                    preparsed_data, graph, examples), examples))
+            elif command == 'score':
+                response = _worker_score(graph, *args)
+            else:
+                raise ValueError(f'Unknown command `{command}`')
+        except Exception as e:
+            L.error('Error when handling `%s`: %s', command, e)
+            response = e
+
+        connection.send(response)
+    connection.close()
+
+
+def serve_shard(shard_file: str, address: Address, authkey: bytes):
+    """Runs ranking worker for one shard, accepting coordinators that know the authkey."""
+    from example_based_entity_search.utils import load_data
+
+    metadata = _load_metadata(dirname(shard_file))
+    info = {
+        'shard': metadata['files'].index(basename(shard_file)),
+        'shards': metadata['shards'],
+        'size': metadata['size']
+    }
+    graph = load_data(shard_file)
+    L.info('Shard `%s` ready on %s:%d', shard_file, *address)
+
+    with Listener(address, authkey=authkey) as listener:
+        while True:
+            connection = listener.accept()
+            Thread(target=_handle_connection, args=(graph, info, connection),
+                   daemon=True).start()
+
+
+def start_local_workers(shards_dir: str, authkey: bytes, host: str = '127.0.0.1',
+                        port: int = SHARD_PORT) -> Tuple[List[Process], List[Address]]:
+    """Spawns one worker process per shard, listening on consecutive ports."""
+    metadata = _load_metadata(shards_dir)
+    processes = []
+    addresses = []
+    for i, shard_file in enumerate(metadata['files']):
+        address = (host, port + i)
+        process = Process(target=serve_shard, args=(
+            path_join(shards_dir, shard_file), address, authkey), daemon=True)
+        process.start()
+        processes.append(process)
+        addresses.append(address)
+    return processes, addresses
+
+
+def _connect(address: Address, authkey: bytes, timeout: float) -> Connection:
+    deadline = monotonic() + timeout
+    while True:
+        try:
+            return Client(address, authkey=authkey)
+        except ConnectionRefusedError:
+            if monotonic() > deadline:
+                raise
+            sleep(0.2)
+
+
+class ShardedRanker:
+    """Coordinator of shard workers.
+
+    Workers must be given in the order of shards.
+    """
+
+    def __init__(self, addresses: List[Address], authkey: bytes,
+                 timeout: float = SHARD_CONNECT_TIMEOUT):
+        self.connections = [_connect(address, authkey, timeout)
+                            for address in addresses]
+
+        infos = self._call_all([('info',)] * len(self.connections))
+        for i, info in enumerate(infos):
+            if info['shards'] != len(self.connections):
+                raise ValueError(
+                    f'Worker {i} serves one of {info["shards"]} shards, but got {len(self.connections)} workers')
+            if info['shard'] != i:
+                raise ValueError(
+                    f'Worker {i} serves shard {info["shard"]}, workers are not in order')
+        self.size = infos[0]['size']
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+
+    def _call_all(self, requests: List[Optional[Tuple]]) -> List[Any]:
+        """Sends requests to all workers (None = skip the worker), then gathers responses."""
+        for connection, request in zip(self.connections, requests):
+            if request is not None:
+                connection.send(request)
+
+        responses = []
+        for connection, request in zip(self.connections, requests):
+            response = None
+            if request is not None:
+                response = connection.recv()
+                if isinstance(response, Exception):
+                    raise response
+            responses.append(response)
+        return responses
+
+    def _partition(self, entities: List['URIRef']) -> List[List['URIRef']]:
+        partitioned: List[List[URIRef]] = [[] for _ in self.connections]
+        for entity in entities:
+            partitioned[shard_of(entity, len(self.connections))].append(entity)
+        return partitioned
+
+    def _preparse(self, model_name: str, input_data: 'Query') -> Any:
+        """Does what _text_preparsing/_examples_preparsing do, using data from workers."""
+        from example_based_entity_search.entity_search_lib import (
+            _examples_preparsing_from_representations, normalize_relation)
+
+        relation, examples = input_data
+        if model_name == 'text':
+            return normalize_relation(relation).split(), self.size
+
+        representations: Dict[URIRef, Set[Triple]] = dict()
+        for response in self._call_all([('representations', part) if part else None
+                                        for part in self._partition(examples)]):
+            if response is not None:
+                representations.update(response)
+        return _examples_preparsing_from_representations(
+            [representations[example] for example in examples])
+
+    def rank(self, model_name: str, input_data: 'Query', entities_to_rank: List['URIRef'],
+             top_k: Optional[int] = None) -> 'Ranking':
+        """Rates entities based on model (`text` or `examples`) and input query.
+
+        Args:
+            model_name: retrieval model to use
+            input_data: relation (topic) and examples
+            entities_to_rank: list of entities that should be rated
+            top_k: return only that many best entities
+
+        Returns:
+            Ordered/sorted list containing tuples: (rate, entity),
+            best matching entities comes first
+        """
+        from example_based_entity_search.entity_search_lib import \
+            _examples_average_precision
+
+        _, examples = input_data
+        L.info('Ranking %d entities on %d shards',
+               len(entities_to_rank), len(self.connections))
+        preparsed_data = self._preparse(model_name, input_data)
+
+        # score examples first, shards need them to compute average precision
+        examples_ranking: List[Tuple[D, URIRef]] = []
+        for response in self._call_all([('score_examples', model_name, preparsed_data, part) if part else None
+                                        for part in self._partition(examples)]):
+            if response is not None:
+                examples_ranking.extend(response)
+
+        responses = [response for response in self._call_all(
+            [('score', model_name, preparsed_data, part, examples_ranking, top_k) if part else None
+             for part in self._partition(entities_to_rank)]) if response is not None]
+
+        # global min/max normalization
+        min_val, max_val = D(0), D(0)
+        if responses:
+            min_val = min([response['min'] for response in responses])
+            max_val = max([response['max'] for response in responses])
+        norm_denominator = max_val - min_val
+        if norm_denominator == 0:
+            norm_denominator = D(1)
+
+        ranking = list(islice(heapq.merge(
+            *[response['top'] for response in responses], reverse=True), top_k))
+
+        # position of an example = entities and examples ranked above + 1
+        examples_positions = []
+        for i, example_item in enumerate(examples_ranking):
+            above_entities = sum([response['above_examples'][i]
+                                  for response in responses])
+            above_examples = len(
+                [item for item in examples_ranking if item > example_item])
+            examples_positions.append(above_entities + above_examples + 1)
+        ap = _examples_average_precision(
+            examples_positions, len(entities_to_rank) + len(examples))
+
+        L.info(" ~> normalization min = %s, max = %s", min_val, max_val)
+        L.info(" ~> AP = %s", ap)
+        return ap, [((v - min_val) / norm_denominator, entity) for v, entity in ranking]
+
+    def rank_text_based(self, input_data: 'Query', entities_to_rank: List['URIRef'],
+                        top_k: Optional[int] = None) -> 'Ranking':
+        return self.rank('text', input_data, entities_to_rank, top_k)
+
+    def rank_examples_based(self, input_data: 'Query', entities_to_rank: List['URIRef'],
+                            top_k: Optional[int] = None) -> 'Ranking':
+        return self.rank('examples', input_data, entities_to_rank, top_k)
+
+    def rank_combined(self, input_data: 'Query', entities_to_rank: List['URIRef'],
+                      top_k: Optional[int] = None) -> 'Ranking':
+        from example_based_entity_search.entity_search_lib import rank_combined
+
+        # entities missing in truncated rankings would be scored as zero, so get whole rankings
+        ranking_text = self.rank_text_based(input_data, entities_to_rank)
+        ranking_example = self.rank_examples_based(
+            input_data, entities_to_rank)
+        return rank_combined((ranking_text, ranking_example), top_k)
+
+
+def _parse_address(address: str) -> Address:
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def _authkey(authkey: Optional[str]) -> Optional[bytes]:
+    """Secret key from the option or the environment variable."""
+    authkey = authkey or environ.get(SHARD_AUTHKEY_ENV)
+    return authkey.encode('utf8') if authkey else None
+
+
+def main():
+    """Sharding tool entry point"""
+    parser = argparse.ArgumentParser(description='Sharded entities ranking')
+    parser.add_argument("-v", "--verbose", help="debug output",
+                        action="store_true")
+    subparsers = parser.add_subparsers(dest='command')
+
+    parser_partition = subparsers.add_parser(
+        'partition', help='Split graph into shards')
+    parser_partition.add_argument(
+        'triples_data', help='Path to directory with triple files or path to triple file')
+    parser_partition.add_argument(
+        'shards_dir', help='Directory to save shards in')
+    parser_partition.add_argument(
+        '-n', '--shards', type=int, default=4, help='Amount of shards')
+
+    parser_worker = subparsers.add_parser(
+        'worker', help='Serve one shard')
+    parser_worker.add_argument('shard_file', help='Shard file to serve')
+    parser_worker.add_argument('--host', default='127.0.0.1',
+                               help='Address to listen on')
+    parser_worker.add_argument('--port', type=int, default=SHARD_PORT,
+                               help='Port to listen on')
+    parser_worker.add_argument('--authkey',
+                               help=f'Secret key of coordinator and workers (default: ${SHARD_AUTHKEY_ENV})')
+
+    parser_rank = subparsers.add_parser(
+        'rank', help='Rank sample file using shards')
+    parser_rank.add_argument(
+        'shards_dir', help='Directory with shards')
+    parser_rank.add_argument(
+        '-s', '--sample_file', required=True,
+        help='YAML file with keys: `topic`, `relevant` and `not_relevant`')
+    parser_rank.add_argument(
+        '--workers',
+        help='Comma separated host:port addresses of workers, in shards order. '
+             'If not provided, local workers are started')
+    parser_rank.add_argument(
+        '-k', '--top_k', type=int, help='Return only that many best entities')
+    parser_rank.add_argument('--authkey',
+                             help=f'Secret key of workers (default: ${SHARD_AUTHKEY_ENV}, '
+                                  'random one for local workers)')
+
+    # args parsing and sanity checks
+    args = parser.parse_args()
+
+    L.setLevel('INFO')
+    if args.verbose:
+        L.setLevel('DEBUG')
+
+    if args.command == 'partition':
+        from example_based_entity_search.utils import load_data
+        try:
+            graph = load_data(args.triples_data)
+        except Exception as e:
+            L.error('Error when loading data from `%s`: %s',
+                    args.triples_data, e)
+            return 1
+        partition_graph(graph, args.shards, args.shards_dir)
+
+    elif args.command == 'worker':
+        authkey = _authkey(args.authkey)
+        if authkey is None:
+            L.error('Secret key is required, use --authkey or $%s', SHARD_AUTHKEY_ENV)
+            return 1
+        serve_shard(args.shard_file, (args.host, args.port), authkey)
+
+    elif args.command == 'rank':
+        from example_based_entity_search.entity_search_lib import rank_combined
+        from example_based_entity_search.entity_search_tool import \
+            print_rankings
+        from example_based_entity_search.utils import data_from_sample_file
+
+        authkey = _authkey(args.authkey)
+        processes: List[Process] = []
+        if args.workers:
+            if authkey is None:
+                L.error('Secret key of workers is required, use --authkey or $%s', SHARD_AUTHKEY_ENV)
+                return 1
+            addresses = [_parse_address(address)
+                         for address in args.workers.split(',')]
+        else:
+            authkey = authkey or token_bytes(32)
+            processes, addresses = start_local_workers(args.shards_dir, authkey)
+
+        ranker: Optional[ShardedRanker] = None
+        try:
+            topic, examples, entities_to_rank, relevant = data_from_sample_file(
+                args.sample_file)
+            ranker = ShardedRanker(addresses, authkey)
+            input_data = (topic, examples)
+            ranking_text = ranker.rank_text_based(input_data, entities_to_rank)
+            ranking_example = ranker.rank_examples_based(
+                input_data, entities_to_rank)
+            ranking_combined = rank_combined(
+                (ranking_text, ranking_example), args.top_k)
+            print_rankings((
+                (ranking_text[0], ranking_text[1][:args.top_k]),
+                (ranking_example[0], ranking_example[1][:args.top_k]),
+                ranking_combined), relevant)
+        except Exception as e:
+            L.error('Error when ranking: %s', e)
+            return 1
+        finally:
+            if ranker is not None:
+                ranker.close()
+            for process in processes:
+                process.terminate()
+
+    else:
+        parser.print_help()
+
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Out-of-core, read-only triples store.
+
+    Triples are kept on disk twice, as N-Triples lines sorted by subject (.spo)
+    and sorted by object (.ops). Sidecar index maps every subject and object
+    to the byte range of its lines in both files: terms are stored in the
+    front coded TermDictionary (.terms), ranges in fixed size records (.sorted)
+    indexed by term ids. All files are memory-mapped, so opening the store is
+    instant and memory is limited to the pages actually read.
+
+    Files are built with external merge sort: N-Triples and N-Quads files are read
+    in chunks of SORTED_CHUNK_SIZE lines, each chunk is sorted and spilled to disk,
+    then all chunks are merged. Other formats can't be split, they are parsed whole.
+
+    Usage:
+        python -m example_based_entity_search.sorted_store ./pp_data/ ./big_graph
+        ebes-rank big_graph.sorted --shell
+
+    Author: Paweł Płatek
+"""
+
+
+import argparse
+import heapq
+import mmap
+import struct
+from glob import glob
+from itertools import islice
+from os import remove
+from os.path import getsize, isdir
+from sys import exit
+from tempfile import mkstemp
+from typing import Callable, Dict, Iterator, List, Tuple, Union
+
+from rdflib import ConjunctiveGraph, Literal
+from rdflib.plugins.serializers.nt import _nt_row, _quoteLiteral
+from rdflib.store import Store
+from rdflib.util import from_n3, guess_format
+
+from example_based_entity_search.config import (SORTED_CHUNK_SIZE,
+                                                SORTED_STORE_EXTENSION,
+                                                TRIPLE_FILE_EXTENSIONS, L)
+from example_based_entity_search.term_dictionary import TermDictionary
+
+MAGIC = b'EBSS'
+HEADER = struct.Struct('<4sQ')  # magic, amount of triples
+RANGES = struct.Struct('<QQQQ')  # spo offset and length, ops offset and length
+
+Range = Tuple[int, int]
+
+# formats with one triple per line, chunks of lines can be parsed on their own
+LINE_FORMATS = ('nquads', 'nt')
+
+
+def _node_key(node) -> str:
+    """Node as written in N-Triples line."""
+    if isinstance(node, Literal):
+        return _quoteLiteral(node)
+    return node.n3()
+
+
+def _split_row(row: str) -> Tuple[str, str, str]:
+    """Splits N-Triples line into subject, predicate and object."""
+    triple_subject, triple_predicate, rest = row.split(' ', 2)
+    return triple_subject, triple_predicate, rest.rstrip('\n')[:-2]
+
+
+def _subject_key(row: str) -> Tuple[str, str]:
+    return _split_row(row)[0], row
+
+
+def _object_key(row: str) -> Tuple[str, str]:
+    return _split_row(row)[2], row
+
+
+def _mmap(path: str) -> Union[mmap.mmap, bytes]:
+    if getsize(path) == 0:
+        return b''  # empty files can't be mapped
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _rows_chunks(triples_file: str, chunk_size: int) -> Iterator[List[str]]:
+    """N-Triples lines of the file, in chunks of at most chunk_size triples.
+
+    Blank nodes get different labels in every chunk, the lib doesn't use them anyway.
+    """
+    data_format = guess_format(triples_file)
+    if data_format not in LINE_FORMATS:
+        L.warning('`%s` is not N-Triples nor N-Quads, parsing it whole', triples_file)
+        graph = ConjunctiveGraph()
+        graph.parse(triples_file, format=data_format)
+        yield [_nt_row(tr) for tr in graph.triples((None, None, None))]
+        return
+
+    with open(triples_file, 'r', encoding='utf8') as f:
+        while True:
+            lines = list(islice(f, chunk_size))
+            if not lines:
+                break
+            graph = ConjunctiveGraph()
+            graph.parse(data=''.join(lines), format=data_format)
+            yield [_nt_row(tr) for tr in graph.triples((None, None, None))]
+
+
+def _write_chunk(rows: List[str], key: Callable[[str], Tuple[str, str]]) -> str:
+    fd, path = mkstemp(suffix='.nt')
+    with open(fd, 'w', encoding='utf8') as f:
+        f.writelines(sorted(rows, key=key))
+    return path
+
+
+def _merge_chunks(chunks: List[str], key: Callable[[str], Tuple[str, str]], out_file: str) -> Tuple[int, Dict[str, Range]]:
+    """Merges sorted chunks, removes duplicated triples.
+
+    Returns:
+        amount of triples, byte ranges of keys
+    """
+    files = [open(chunk, 'r', encoding='utf8') for chunk in chunks]
+    ranges: Dict[str, Range] = dict()
+    count = 0
+    try:
+        with open(out_file, 'wb') as out:
+            previous_row = None
+            current_key = None
+            current_start = 0
+            offset = 0
+            for row in heapq.merge(*files, key=key):
+                if row == previous_row:
+                    continue
+                previous_row = row
+                row_key = key(row)[0]
+                if row_key != current_key:
+                    if current_key is not None:
+                        ranges[current_key] = (
+                            current_start, offset - current_start)
+                    current_key = row_key
+                    current_start = offset
+                data = row.encode('utf8')
+                out.write(data)
+                offset += len(data)
+                count += 1
+            if current_key is not None:
+                ranges[current_key] = (current_start, offset - current_start)
+    finally:
+        for f in files:
+            f.close()
+    return count, ranges
+
+
+def build_sorted_store(triples_data: str, base_path: str, chunk_size: int = SORTED_CHUNK_SIZE):
+    """Creates sorted store files from a triples file or directory of them.
+
+    Args:
+        triples_data: path to RDF file or directory with RDF files
+        base_path: path of created files without extensions
+        chunk_size: amount of lines sorted in memory at once
+    """
+    if isdir(triples_data):
+        triples_files = []
+        for extension in TRIPLE_FILE_EXTENSIONS:
+            triples_files.extend(glob(f'{triples_data}/*.{extension}'))
+    else:
+        triples_files = [triples_data]
+
+    spo_chunks: List[str] = []
+    ops_chunks: List[str] = []
+    try:
+        for i, triples_file in enumerate(triples_files):
+            L.info('Sorting %d / %d (`%s`)', i + 1,
+                   len(triples_files), triples_file)
+            for rows in _rows_chunks(triples_file, chunk_size):
+                spo_chunks.append(_write_chunk(rows, _subject_key))
+                ops_chunks.append(_write_chunk(rows, _object_key))
+
+        L.info('Merging %d chunks', len(spo_chunks))
+        count, spo_ranges = _merge_chunks(
+            spo_chunks, _subject_key, base_path + '.spo')
+        _, ops_ranges = _merge_chunks(
+            ops_chunks, _object_key, base_path + '.ops')
+    finally:
+        for chunk in spo_chunks + ops_chunks:
+            remove(chunk)
+
+    L.info('Writing index of %d subjects and %d objects',
+           len(spo_ranges), len(ops_ranges))
+    terms = TermDictionary.build(set(spo_ranges).union(ops_ranges))
+    terms.save(base_path + '.terms')
+
+    with open(f'{base_path}.{SORTED_STORE_EXTENSION}', 'wb') as f:
+        f.write(HEADER.pack(MAGIC, count))
+        for term in terms:
+            spo_range = spo_ranges.get(term, (0, 0))
+            ops_range = ops_ranges.get(term, (0, 0))
+            f.write(RANGES.pack(*spo_range, *ops_range))
+    L.info('Saved %d triples', count)
+
+
+class SortedTriplesStore(Store):
+    """Read-only rdflib store over files created with build_sorted_store.
+
+    Patterns with bound subject read lines of the subject, patterns with bound
+    object (and free subject) read lines of the object, other patterns scan
+    all triples.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        base_path = path[:-len('.' + SORTED_STORE_EXTENSION)]
+        self._ranges = _mmap(path)
+        magic, self._count = HEADER.unpack_from(self._ranges, 0)
+        if magic != MAGIC:
+            raise ValueError(f'`{path}` is not a sorted store')
+        self._terms = TermDictionary.open(base_path + '.terms')
+        self._spo = _mmap(base_path + '.spo')
+        self._ops = _mmap(base_path + '.ops')
+
+    @staticmethod
+    def triples_file(path: str) -> str:
+        """Subject sorted triples file of the store."""
+        return path[:-len('.' + SORTED_STORE_EXTENSION)] + '.spo'
+
+    def _lines(self, node, objects: bool) -> Iterator[str]:
+        """Lines with the node as the subject (or object)."""
+        term_id = self._terms.id(_node_key(node))
+        if term_id is None:
+            return
+        spo_offset, spo_length, ops_offset, ops_length = RANGES.unpack_from(
+            self._ranges, HEADER.size + RANGES.size * term_id)
+        if objects:
+            block = self._ops[ops_offset:ops_offset + ops_length]
+        else:
+            block = self._spo[spo_offset:spo_offset + spo_length]
+        for line in block.decode('utf8').split('\n'):
+            if line:
+                yield line
+
+    def _all_lines(self) -> Iterator[str]:
+        position = 0
+        while position < len(self._spo):
+            end = self._spo.find(b'\n', position)
+            if end == -1:
+                end = len(self._spo)
+            yield self._spo[position:end].decode('utf8')
+            position = end + 1
+
+    def triples(self, triple_pattern, context=None):
+        triple_subject, triple_predicate, triple_object = triple_pattern
+        if triple_subject is not None:
+            lines = self._lines(triple_subject, objects=False)
+        elif triple_object is not None:
+            lines = self._lines(triple_object, objects=True)
+        else:
+            lines = self._all_lines()
+
+        keys = [None if node is None else _node_key(node)
+                for node in triple_pattern]
+        for line in lines:
+            terms = _split_row(line)
+            if any([key is not None and key != term for key, term in zip(keys, terms)]):
+                continue
+            tr = (from_n3(terms[0]), from_n3(terms[1]), from_n3(terms[2]))
+            yield tr, iter(())
+
+    def __len__(self, context=None) -> int:
+        return self._count
+
+    def contexts(self, triple=None):
+        return iter(())
+
+    def add(self, triple, context, quoted=False):
+        raise TypeError('Sorted store is read-only')
+
+    def addN(self, quads):
+        raise TypeError('Sorted store is read-only')
+
+    def remove(self, triple, context=None):
+        raise TypeError('Sorted store is read-only')
+
+
+def main():
+    """Builds sorted store from triples files"""
+    parser = argparse.ArgumentParser(
+        description='Build out-of-core sorted triples store')
+    parser.add_argument(
+        'triples_data',
+        help='Path to directory with triple files or path to triple file')
+    parser.add_argument(
+        'base_path', help=f'Path of the store, without extension (`.{SORTED_STORE_EXTENSION}` is added)')
+    parser.add_argument('--chunk_size', type=int, default=SORTED_CHUNK_SIZE,
+                        help='Amount of lines sorted in memory at once')
+    parser.add_argument("-v", "--verbose", help="debug output",
+                        action="store_true")
+
+    # args parsing and sanity checks
+    args = parser.parse_args()
+
+    L.setLevel('INFO')
+    if args.verbose:
+        L.setLevel('DEBUG')
+
+    try:
+        build_sorted_store(args.triples_data, args.base_path, args.chunk_size)
+    except Exception as e:
+        L.error('Error when building sorted store from `%s`: %s',
+                args.triples_data, e)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
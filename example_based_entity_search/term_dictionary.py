@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compact dictionary of RDF terms (URIs and literals).
+
+    Terms are sorted and front coded in blocks: the first term of every block is
+    stored whole, the rest as (length of the prefix shared with the previous term, suffix).
+    URIs share long prefixes (like http://dbpedia.org/resource/), so that saves most
+    of the memory. The dictionary is a single bytes buffer that may be memory-mapped
+    from a file, terms are decoded on demand.
+
+    Binary format (little endian):
+        header: magic (4 bytes), amount of terms, block size, amount of blocks (uint32)
+        offsets of blocks in data (uint64 per block)
+        data: blocks of varint encoded lengths and UTF-8 encoded terms
+
+    Usage:
+        python -m example_based_entity_search.term_dictionary ./pp_data/ terms.dict
+
+    Author: Paweł Płatek
+"""
+
+
+import argparse
+import mmap
+import struct
+from sys import exit
+from typing import Iterable, Iterator, Optional, Tuple, Union
+
+from rdflib import Literal, URIRef
+from rdflib.util import from_n3
+
+from example_based_entity_search.config import TERMS_BLOCK_SIZE, L
+from example_based_entity_search.utils import PPGraph, load_data
+
+MAGIC = b'EBTD'
+HEADER = struct.Struct('<4sIII')
+OFFSET = struct.Struct('<Q')
+
+Node = Union[URIRef, Literal]
+Buffer = Union[bytes, mmap.mmap]
+
+
+def _encode_varint(value: int) -> bytes:
+    result = bytearray()
+    while value >= 0x80:
+        result.append((value & 0x7f) | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+
+def _decode_varint(buffer: Buffer, position: int) -> Tuple[int, int]:
+    """Returns decoded value and position after it."""
+    value = 0
+    shift = 0
+    while True:
+        byte = buffer[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+class TermDictionary:
+    """Bidirectional mapping between terms (strings) and consecutive integer ids.
+
+    Ids follow the order of UTF-8 encoded terms.
+    """
+
+    def __init__(self, buffer: Buffer):
+        magic, self._count, self._block_size, self._blocks = HEADER.unpack_from(
+            buffer, 0)
+        if magic != MAGIC:
+            raise ValueError('Not a term dictionary')
+        self._buffer = buffer
+        self._data_start = HEADER.size + OFFSET.size * self._blocks
+
+    @classmethod
+    def build(cls, terms: Iterable[str], block_size: int = TERMS_BLOCK_SIZE) -> 'TermDictionary':
+        """Creates dictionary from (not sorted, maybe repeated) terms."""
+        encoded_terms = sorted(set([term.encode('utf8') for term in terms]))
+        offsets = []
+        data = bytearray()
+        previous = b''
+        for i, term in enumerate(encoded_terms):
+            if i % block_size == 0:
+                offsets.append(len(data))
+                data += _encode_varint(len(term))
+                data += term
+            else:
+                shared = 0
+                max_shared = min(len(previous), len(term))
+                while shared < max_shared and previous[shared] == term[shared]:
+                    shared += 1
+                data += _encode_varint(shared)
+                data += _encode_varint(len(term) - shared)
+                data += term[shared:]
+            previous = term
+
+        header = HEADER.pack(MAGIC, len(encoded_terms),
+                             block_size, len(offsets))
+        offsets_data = b''.join([OFFSET.pack(offset) for offset in offsets])
+        return cls(header + offsets_data + bytes(data))
+
+    @classmethod
+    def from_graph(cls, graph: PPGraph, block_size: int = TERMS_BLOCK_SIZE) -> 'TermDictionary':
+        """Creates dictionary of all nodes in the graph."""
+        def nodes():
+            for tr in graph.triples((None, None, None)):
+                for node in tr:
+                    yield node.n3()
+        return cls.build(nodes(), block_size)
+
+    @classmethod
+    def open(cls, path: str) -> 'TermDictionary':
+        """Memory-maps dictionary saved with save."""
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(buffer)
+
+    def save(self, path: str):
+        with open(path, 'wb') as f:
+            f.write(self._buffer[:])
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._buffer)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _block_offset(self, block: int) -> int:
+        offset, = OFFSET.unpack_from(
+            self._buffer, HEADER.size + OFFSET.size * block)
+        return self._data_start + offset
+
+    def _first_term(self, block: int) -> bytes:
+        length, position = _decode_varint(
+            self._buffer, self._block_offset(block))
+        return self._buffer[position:position + length]
+
+    def _iter_block(self, block: int) -> Iterator[bytes]:
+        """Decodes terms of the block."""
+        position = self._block_offset(block)
+        length, position = _decode_varint(self._buffer, position)
+        term = self._buffer[position:position + length]
+        position += length
+        yield term
+
+        block_end = min(self._block_size, self._count -
+                        block * self._block_size)
+        for _ in range(1, block_end):
+            shared, position = _decode_varint(self._buffer, position)
+            length, position = _decode_varint(self._buffer, position)
+            term = term[:shared] + self._buffer[position:position + length]
+            position += length
+            yield term
+
+    def term(self, term_id: int) -> str:
+        """Returns term with the id, raises IndexError if there is no such id."""
+        if not 0 <= term_id < self._count:
+            raise IndexError(term_id)
+        block, in_block = divmod(term_id, self._block_size)
+        for i, term in enumerate(self._iter_block(block)):
+            if i == in_block:
+                return term.decode('utf8')
+        raise IndexError(term_id)
+
+    def id(self, term: str) -> Optional[int]:
+        """Returns id of the term or None if the term is not in the dictionary."""
+        if self._count == 0:
+            return None
+        encoded_term = term.encode('utf8')
+
+        # find the last block with the first term <= searched term
+        low, high = 0, self._blocks
+        while high - low > 1:
+            middle = (low + high) // 2
+            if self._first_term(middle) <= encoded_term:
+                low = middle
+            else:
+                high = middle
+
+        for i, block_term in enumerate(self._iter_block(low)):
+            if block_term == encoded_term:
+                return low * self._block_size + i
+            if block_term > encoded_term:
+                break
+        return None
+
+    def __contains__(self, term: str) -> bool:
+        return self.id(term) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        for block in range(self._blocks):
+            for term in self._iter_block(block):
+                yield term.decode('utf8')
+
+    # RDF nodes are stored in n3 format, so URIs and literals do not collide
+    def node_id(self, node: Node) -> Optional[int]:
+        return self.id(node.n3())
+
+    def node(self, node_id: int) -> Node:
+        node = from_n3(self.term(node_id))
+        if not isinstance(node, (URIRef, Literal)):
+            raise ValueError(f'Term {node_id} is not a node')
+        return node
+
+
+def main():
+    """Builds dictionary of all terms in the graph"""
+    parser = argparse.ArgumentParser(
+        description='Build compact dictionary of RDF terms')
+    parser.add_argument(
+        'triples_data',
+        help='Path to directory with triple files or path to triple file')
+    parser.add_argument('out_file', help='File to save dictionary in')
+    parser.add_argument('--block_size', type=int, default=TERMS_BLOCK_SIZE,
+                        help='Amount of terms in front coded block')
+    parser.add_argument("-v", "--verbose", help="debug output",
+                        action="store_true")
+
+    # args parsing and sanity checks
+    args = parser.parse_args()
+
+    L.setLevel('INFO')
+    if args.verbose:
+        L.setLevel('DEBUG')
+
+    try:
+        graph = load_data(args.triples_data)
+    except Exception as e:
+        L.error('Error when loading data from `%s`: %s', args.triples_data, e)
+        return 1
+
+    dictionary = TermDictionary.from_graph(graph, args.block_size)
+    dictionary.save(args.out_file)
+
+    raw_size = sum([len(term.encode('utf8')) for term in dictionary])
+    L.info('Saved %d terms in %d bytes (%d bytes of raw UTF-8)',
+           len(dictionary), dictionary.nbytes, raw_size)
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Local graph filled from a SPARQL endpoint, entity by entity.
+
+    Local triples (files, snapshot or manifest) are the first tier. Entities without
+    outlinks in the local graph are fetched from the endpoint when a query needs them:
+    their outlinks, inlinks and labels of entities they link to, in bulk (one query
+    of each kind per TIERED_BATCH_SIZE entities). Fetched triples are added to the local
+    graph (like a changeset) and appended to the write-back file, so the local tier fills up
+    from real queries and next runs do not ask the endpoint again.
+
+    Queries ask for at most TIERED_ROWS_LIMIT rows. Batches reaching it are asked again
+    in halves; an entity with more triples than that (a hub) is ranked with the ones
+    fetched, but they are not written back, so next runs fetch it again.
+
+    Data url is `<local data>::<endpoint url>` (default endpoint if the url is empty).
+    Write-back file is TIERED_WRITE_BACK in the local directory, or the local file path
+    with `.<TIERED_WRITE_BACK>` appended; it is loaded together with local data.
+
+    Usage:
+        ebes-rank 'pp_data/all.snapshot::http://dbpedia.org/sparql' -s pp_data/sample1.yml
+        ebes-rank 'pp_data/::' -s pp_data/sample1.yml
+
+    Author: Paweł Płatek
+"""
+
+
+from os.path import isdir, isfile, join
+from threading import Lock
+from typing import Iterable, List, Optional, Set, Tuple
+
+from rdflib import BNode, ConjunctiveGraph, Graph, URIRef
+from rdflib.term import Node
+
+from example_based_entity_search.config import (LANGS, SPARQL_ENDPOINT,
+                                                TIERED_BATCH_SIZE,
+                                                TIERED_ROWS_LIMIT,
+                                                TIERED_SEPARATOR,
+                                                TIERED_WRITE_BACK, L)
+from example_based_entity_search.dump_data import n3_format
+from example_based_entity_search.utils import (LABEL_PREDICATES, PPGraph,
+                                               load_data)
+
+_LANGS_FILTER = ', '.join(sorted({f'"{lang or ""}"' for lang in LANGS}))
+_LABEL_PREDICATES = ' '.join(
+    [label_predicate.n3() for label_predicate in LABEL_PREDICATES])
+
+# literals in other languages and blank nodes are not used by the lib, no need to transfer them
+# every row is a distinct triple, so a result with fewer triples than the limit is complete
+OUTLINKS_QUERY = '''CONSTRUCT { ?entity ?p ?o }
+WHERE {
+    VALUES ?entity { %s }
+    ?entity ?p ?o .
+    FILTER(!isBlank(?o) && (!isLiteral(?o) || lang(?o) IN (''' + _LANGS_FILTER + ''')))
+}
+LIMIT %d'''
+INLINKS_QUERY = '''CONSTRUCT { ?s ?p ?entity }
+WHERE {
+    VALUES ?entity { %s }
+    ?s ?p ?entity .
+    FILTER(!isBlank(?s))
+}
+LIMIT %d'''
+LABELS_QUERY = '''CONSTRUCT { ?o ?label_predicate ?label }
+WHERE {
+    SELECT DISTINCT ?o ?label_predicate ?label
+    WHERE {
+        VALUES ?entity { %s }
+        VALUES ?label_predicate { ''' + _LABEL_PREDICATES + ''' }
+        ?entity ?p ?o .
+        ?o ?label_predicate ?label .
+        FILTER(isIRI(?o) && lang(?label) IN (''' + _LANGS_FILTER + '''))
+    }
+}
+LIMIT %d'''
+
+Triple = Tuple[Node, Node, Node]
+
+
+def split_data_url(data_url: str) -> Tuple[str, str]:
+    """Local data and endpoint url of the tiered data url."""
+    local_data, endpoint = data_url.split(TIERED_SEPARATOR, 1)
+    return local_data, endpoint or SPARQL_ENDPOINT
+
+
+def write_back_file(local_data: str) -> str:
+    if isdir(local_data):
+        return join(local_data, TIERED_WRITE_BACK)
+    return f'{local_data}.{TIERED_WRITE_BACK}'
+
+
+class RemoteTier:
+    """Fetches triples of entities missing in the local graph from the endpoint."""
+
+    def __init__(self, endpoint: str, write_back: Optional[str] = None,
+                 batch_size: int = TIERED_BATCH_SIZE, rows_limit: int = TIERED_ROWS_LIMIT):
+        from rdflib.plugins.stores.sparqlstore import SPARQLStore
+        self.endpoint = endpoint
+        self.write_back = write_back
+        self.batch_size = batch_size
+        self.rows_limit = rows_limit
+        self._remote = Graph(store=SPARQLStore(endpoint))
+        self._fetched: Set[URIRef] = set()  # asked already, also ones the endpoint knows nothing about
+        self._lock = Lock()
+
+    def _construct(self, query: str, entities: List[URIRef]) -> Tuple[List[Triple], Set[URIRef]]:
+        """Triples of the entities and entities with truncated results.
+
+        Results reaching the rows limit may be truncated: the entities are asked again in halves,
+        down to single entities, whose triples are truncated indeed.
+        """
+        values = ' '.join([entity.n3() for entity in entities])
+        result = self._remote.query(query % (values, self.rows_limit)).graph
+        if result is None:
+            raise ValueError(f'`{self.endpoint}` returned no graph for CONSTRUCT query')
+        rows = len(result)
+        triples = [(s, p, o) for s, p, o in result
+                   if not isinstance(s, BNode) and not isinstance(o, BNode)]
+        if rows < self.rows_limit:
+            return triples, set()
+
+        if len(entities) == 1:
+            L.warning('More than %d triples of `%s`, they are not written back',
+                      self.rows_limit, entities[0])
+            return triples, set(entities)
+        half = len(entities) // 2
+        first, first_truncated = self._construct(query, entities[:half])
+        second, second_truncated = self._construct(query, entities[half:])
+        return first + second, first_truncated | second_truncated
+
+    def fetch(self, entities: List[URIRef]) -> Tuple[List[Triple], List[Triple]]:
+        """Outlinks, inlinks and labels of linked entities, queried in batches.
+
+        Returns:
+            fetched triples and the ones to write back (without triples of entities
+            with truncated results)
+        """
+        fetched: List[Triple] = []
+        complete: List[Triple] = []
+        for i in range(0, len(entities), self.batch_size):
+            batch = entities[i:i + self.batch_size]
+            outlinks, truncated = self._construct(OUTLINKS_QUERY, batch)
+            inlinks, truncated_inlinks = self._construct(INLINKS_QUERY, batch)
+            labels, truncated_labels = self._construct(LABELS_QUERY, batch)
+            truncated |= truncated_inlinks | truncated_labels
+
+            fetched.extend(outlinks + inlinks + labels)
+            complete.extend([tr for tr in outlinks if tr[0] not in truncated])
+            complete.extend([tr for tr in inlinks if tr[2] not in truncated])
+            if not truncated_labels:
+                complete.extend(labels)
+        return fetched, complete
+
+    def _write_back(self, write_back: str, triples: Iterable[Triple]):
+        context = URIRef(self.endpoint).n3()
+        with open(write_back, 'a', encoding='utf8') as f:
+            for tr in triples:
+                f.write(' '.join(map(n3_format, tr)))
+                f.write(f' {context} .\n')
+
+    def missing(self, graph: PPGraph, entities: Iterable[URIRef]) -> List[URIRef]:
+        """Entities not asked yet and without outlinks in the graph."""
+        return [entity for entity in dict.fromkeys(entities)
+                if isinstance(entity, URIRef) and entity not in self._fetched
+                and (entity, None, None) not in graph.store]
+
+    def require(self, graph: PPGraph, entities: Iterable[URIRef]):
+        """Fetches entities without outlinks in the graph and adds their triples to it.
+
+        Added triples are applied like a changeset: degrees and size are updated and
+        representations of affected entities are computed again. If the endpoint fails,
+        the query is served from local triples only and the entities are asked again next time.
+        The graph is locked for writing only while the triples are added, not while fetching.
+        """
+        entities = list(entities)
+        with self._lock:
+            with graph.lock.read():
+                missing = self.missing(graph, entities)
+            if not missing:
+                return
+
+            L.info('Fetching %d entities from `%s`', len(missing), self.endpoint)
+            try:
+                fetched, complete = self.fetch(missing)
+            except Exception as e:
+                L.warning('Error when fetching entities from `%s`, using local triples only: %s',
+                          self.endpoint, e)
+                return
+            self._fetched.update(missing)
+
+            with graph.lock.write():
+                added = [tr for tr in dict.fromkeys(fetched) if tr not in graph.store]
+                if not added:
+                    return
+                affected = graph.apply_changeset(added, [])
+                if graph.features is not None:
+                    graph.features.invalidate(affected)
+            if self.write_back is not None:
+                complete_triples = set(complete)
+                self._write_back(self.write_back, [tr for tr in added if tr in complete_triples])
+
+
+def load_tiered(data_url: str, old_graph: Optional[PPGraph] = None) -> PPGraph:
+    """Loads local data (and triples written back before), attaches the remote tier."""
+    from example_based_entity_search.changesets import read_triples
+    local_data, endpoint = split_data_url(data_url)
+    write_back = write_back_file(local_data)
+
+    graph = load_data(local_data, old_graph)
+    if not isinstance(graph.store, ConjunctiveGraph):
+        raise ValueError(
+            f'Local tier `{local_data}` must be an in-memory graph (files, snapshot or manifest)')
+
+    # files in the directory (with the write-back one) are loaded already
+    if isfile(write_back) and not isdir(local_data):
+        L.info('Loading triples fetched before from `%s`', write_back)
+        graph.apply_changeset(read_triples(write_back), [])
+        graph.sources.append(write_back)
+
+    L.info('Entities missing in local graph are fetched from `%s`', endpoint)
+    graph.tiers.append(RemoteTier(endpoint, write_back))
+    graph.sources.append(endpoint)
+    return graph
@@ -5,31 +5,149 @@
     Author: Paweł Płatek
 """
 
+import io
+import pickle
+from contextlib import contextmanager
 from decimal import Decimal as D
+from hashlib import blake2b
 from glob import glob
-from os.path import isdir, isfile
-from random import shuffle
-from typing import Dict, List, Optional, Tuple
+from itertools import count
+from os.path import abspath, getsize, isdir, isfile
+from pathlib import Path
+from random import Random, shuffle
+from sys import modules
+from threading import Condition, Lock, Thread, get_ident, local
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Optional,
+                    Sequence, Set, Tuple)
 
 from rdflib import RDF, RDFS, BNode, ConjunctiveGraph, Graph, Literal, URIRef
-from rdflib.plugins.stores.sparqlstore import SPARQLStore
+from rdflib.namespace import SKOS
+from rdflib.store import TripleAddedEvent
 from rdflib.util import guess_format
-from yaml import YAMLError, safe_load
 
 from example_based_entity_search.config import (EXAMPLES_AMOUNT, LANGS,
-                                                PREFIXES, SPARQL_ENDPOINT,
+                                                MANIFEST_EXTENSION, PREFIXES,
+                                                SNAPSHOT_EXTENSION,
+                                                SORTED_STORE_EXTENSION,
+                                                SPARQL_ENDPOINT,
+                                                TIERED_SEPARATOR,
                                                 TRIPLE_FILE_EXTENSIONS, L)
 
 
+_QUERY_LOCK = Lock()
+_GRAPH_UIDS = count()
+
+# changes of these triples change text representations of entities linking to the subject
+LABEL_PREDICATES = (RDFS.label, SKOS.prefLabel)
+
+
+def _is_remote(store) -> bool:
+    """Checks for SPARQLStore without importing it (it can't exist if not imported)."""
+    sparqlstore = modules.get('rdflib.plugins.stores.sparqlstore')
+    return sparqlstore is not None and isinstance(store, sparqlstore.SPARQLStore)
+
+
+def _check_triple(tr) -> bool:
+    """Whether the triple is used by the lib (no blank nodes, literals in known languages)."""
+    if isinstance(tr[0], BNode) or isinstance(tr[2], BNode):
+        return False
+    if isinstance(tr[2], Literal) and tr[2].language not in LANGS:
+        return False
+    return True
+
+
+@contextmanager
+def _added_triples(store, added: Optional[List[Tuple[Any, Any, Any]]]) -> Iterator[None]:
+    """Appends triples new to the local store to the list, while the store is modified.
+
+    Triples are caught with rdflib store events, so they are added in the order they
+    are parsed (representations read triples in that order).
+    """
+    if added is None:
+        yield
+        return
+
+    def collect(event):
+        if event.triple not in store:  # the event comes before the triple is added
+            added.append(event.triple)
+
+    dispatcher = store.store.dispatcher
+    previous = dispatcher.get_map()
+    events = dict(previous or {})
+    events[TripleAddedEvent] = list(events.get(TripleAddedEvent, [])) + [collect]
+    dispatcher.set_map(events)
+    try:
+        yield
+    finally:
+        dispatcher.set_map(previous)
+
+
+class ReadWriteLock:
+    """Lock shared by readers of the graph, exclusive for tiers adding triples to it.
+
+    Writers are preferred, so a stream of rankings does not starve loading. A thread
+    may take the read lock again while holding it (or the write lock), but must not
+    take the write lock while reading.
+    """
+
+    def __init__(self):
+        self._condition = Condition()
+        self._readers = 0
+        self._writer: Optional[int] = None  # ident of the thread holding the write lock
+        self._waiting_writers = 0
+        self._local = local()
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        depth = getattr(self._local, 'depth', 0)
+        with self._condition:
+            if self._writer != get_ident():
+                while self._writer is not None or (self._waiting_writers and not depth):
+                    self._condition.wait()
+            self._readers += 1
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        with self._condition:
+            self._waiting_writers += 1
+            while self._writer is not None or self._readers:
+                self._condition.wait()
+            self._waiting_writers -= 1
+            self._writer = get_ident()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer = None
+                self._condition.notify_all()
+
+
 class PPGraph:
     """Uniform interface for rdflib.Graph and rdflib.SPARQLStore."""
 
     def __init__(self, store):
-        supported_backends = [SPARQLStore, Graph, ConjunctiveGraph]
-        assert any(
-            [isinstance(store, backend) for backend in supported_backends]), store
+        assert isinstance(store, Graph) or _is_remote(store), store
         self.store = store
+        self.uid = next(_GRAPH_UIDS)  # unique in the process, id() is reused by graphs allocated later
         self._size = None  # lazy binding
+        self.version = 0  # changes every time triples are modified
+        self._base_version = 0  # version of the last change of (possibly) all entities
+        self._entity_versions: Dict[URIRef, int] = dict()  # versions of entities changed by changesets
+        self.sources: List[str] = []  # files (or urls) triples were loaded from
+        self.features = None  # optional FeatureStore with precomputed representations
+        self.degrees = None  # DegreeStats of local graphs, computed by load_data
+        self.tiers: List[Any] = []  # load missing triples on require, in order (manifest.py, tiered.py)
+        self.progress: Optional[Callable[[int], None]] = None  # called with amount of parsed bytes
+        self.lock = ReadWriteLock()  # tiers write under it while rankings (ebes-serve threads) read
 
     def __getattr__(self, name):
         attr = getattr(self.store, name, None)
@@ -38,22 +156,14 @@ class PPGraph:
 
     def triples(self, *args, **kwargs):
         """Lame but SPARQLStore returns different stuff than Graph."""
-
-        def check_triple(tr):
-            if isinstance(tr[0], BNode) or isinstance(tr[2], BNode):
-                return False
-            if isinstance(tr[2], Literal) and tr[2].language not in LANGS:
-                return False
-            return True
-
-        if isinstance(self.store, SPARQLStore):
+        if _is_remote(self.store):
             for tr, _ in self.store.triples(*args, **kwargs):
-                if not check_triple(tr):
+                if not _check_triple(tr):
                     continue
                 yield tr
         else:
             for tr in self.store.triples(*args, **kwargs):
-                if not check_triple(tr):
+                if not _check_triple(tr):
                     continue
                 yield tr
 
@@ -106,77 +216,429 @@ class PPGraph:
                     return label
 
     def parse(self, *args, **kwargs):
-        if isinstance(self.store, SPARQLStore):
+        """Parses triples into the graph.
+
+        Statistics of a graph that has them are updated with new triples only,
+        so loading many files one by one doesn't compute them again for every file.
+        """
+        if _is_remote(self.store):
+            L.warning(
+                'Switching PPGraph backend from remote endpoint to local files')
+            self.store = ConjunctiveGraph()
+            self.degrees = None
+        added: Optional[List[Tuple[Any, Any, Any]]] = None
+        if self.degrees is not None and isinstance(self.store, ConjunctiveGraph):
+            added = []
+        else:
+            self._size = None  # will need to recompute that
+            self.degrees = None
+        self._changed_all()
+
+        with _added_triples(self.store, added):
+            result = self._parse(*args, **kwargs)
+
+        if added is not None:
+            if self._size:
+                self._size += len(added)
+            self.degrees.update(self, [tr for tr in added if _check_triple(tr)], [])
+        return result
+
+    def _parse(self, *args, **kwargs):
+        source = kwargs.pop('source', args[0] if args else None)
+        args = args[1:]
+        if isinstance(source, str):
+            self.sources.append(source)
+
+            # read the file through progress counting reader
+            if self.progress is not None and isfile(source):
+                kwargs.setdefault('publicID', Path(abspath(source)).as_uri())
+                with open(source, 'rb') as f:
+                    reader = io.BufferedReader(_ProgressReader(f, self.progress))
+                    return self.store.parse(reader, *args, **kwargs)
+        return self.store.parse(source, *args, **kwargs)
+
+    def merge(self, other: 'PPGraph'):
+        """Adds all triples of other local graph, keeping their contexts.
+
+        Size and degree statistics are updated with new triples only, not computed again.
+        """
+        if _is_remote(self.store):
             L.warning(
                 'Switching PPGraph backend from remote endpoint to local files')
             self.store = ConjunctiveGraph()
-        self._size = None  # will need to recompute that
-        return self.store.parse(*args, **kwargs)
+            self._size = None
+            self.degrees = None
+        if not isinstance(self.store, ConjunctiveGraph):
+            raise ValueError('Triples can be merged only into in-memory graphs')
+
+        store = other.store
+        added = [tr for tr in dict.fromkeys(store.triples((None, None, None)))
+                 if tr not in self.store]
+        if isinstance(store, ConjunctiveGraph):
+            default_context = store.default_context.identifier
+            self.store.addN((s, p, o, self.store.default_context if c is None or c.identifier == default_context
+                             else self.store.get_context(c.identifier))
+                            for s, p, o, c in store.quads((None, None, None)))
+        else:
+            self.store.addN((s, p, o, self.store.default_context)
+                            for s, p, o in added)
+
+        if self._size:
+            self._size += len(added)
+        if self.degrees is not None:
+            self.degrees.update(self, [tr for tr in added if _check_triple(tr)], [])
+        self._changed_all()
+        self.sources.extend(other.sources)
+
+    def require(self, entities: Iterable[URIRef]):
+        """Makes sure triples of the entities are in the graph, before they are ranked.
+
+        Only graphs opened from a manifest or with a remote tier load anything,
+        other graphs have all triples already. Tiers take the write lock of the graph,
+        so it must not be called while holding the read lock.
+        """
+        entities = list(entities)
+        for tier in self.tiers:
+            tier.require(self, entities)
+
+    def _changed_all(self):
+        self.version += 1
+        self._base_version = self.version
+        self._entity_versions.clear()
+
+    def entity_version(self, entity: URIRef) -> int:
+        """Version of the graph in which triples of the entity last changed."""
+        return max(self._base_version, self._entity_versions.get(entity, 0))
+
+    def apply_changeset(self, added: Iterable[Tuple[Any, Any, Any]], removed: Iterable[Tuple[Any, Any, Any]]) -> Set[URIRef]:
+        """Removes and adds triples in place, without reloading the graph.
+
+        Size and degree statistics are updated incrementally and versions of affected
+        entities are bumped, so their cached representations are recomputed.
+
+        Args:
+            added: triples to add (to the default context)
+            removed: triples to remove (from all contexts), removed before adding
+
+        Returns:
+            entities whose representations may have changed: subjects and objects of changed
+            triples and, for changed labels, entities linking to the subject
+        """
+        if not isinstance(self.store, ConjunctiveGraph):
+            raise ValueError('Changesets can be applied only to in-memory graphs')
+
+        removed = [tr for tr in dict.fromkeys(removed) if tr in self.store]
+        for tr in removed:
+            self.store.remove(tr)
+        added = [tr for tr in dict.fromkeys(added) if tr not in self.store]
+        self.store.addN((s, p, o, self.store.default_context)
+                        for s, p, o in added)
+
+        if self._size:
+            self._size += len(added) - len(removed)
+        used_added = [tr for tr in added if _check_triple(tr)]
+        used_removed = [tr for tr in removed if _check_triple(tr)]
+        if self.degrees is not None:
+            self.degrees.update(self, used_added, used_removed)
+
+        affected: Set[URIRef] = set()
+        for triple_subject, triple_predicate, triple_object in used_added + used_removed:
+            for node in (triple_subject, triple_object):
+                if isinstance(node, URIRef):
+                    affected.add(node)
+            if triple_predicate in LABEL_PREDICATES:
+                affected.update([linking for linking in self.subjects(None, triple_subject)
+                                 if isinstance(linking, URIRef)])
+
+        self.version += 1
+        for entity in affected:
+            self._entity_versions[entity] = self.version
+        L.info('Changeset: %d triples added, %d removed, %d entities affected',
+               len(added), len(removed), len(affected))
+        return affected
+
+    def fingerprint(self) -> str:
+        """Hash of contents of all sources of triples (urls are hashed as they are)."""
+        sources_digests = []
+        for source in self.sources:
+            digest = blake2b(digest_size=16)
+            if isfile(source):
+                with open(source, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b''):
+                        digest.update(chunk)
+            else:
+                digest.update(source.encode('utf8'))
+            sources_digests.append(digest.digest())
+
+        # the same files loaded in any order give the same fingerprint
+        digest = blake2b(digest_size=16)
+        for source_digest in sorted(sources_digests):
+            digest.update(source_digest)
+        return digest.hexdigest()
 
     @property
     def size(self):
-        if isinstance(self.store, SPARQLStore):
+        if _is_remote(self.store):
             return 13370  # just something big
 
         if self._size:
             return self._size
 
-        results = self.store.query(PREFIXES + '''SELECT (count(?s) as ?X) 
-                       WHERE {  
-                          ?s ?p ?o . 
-                       }''')
-        self._size = list(results)[0][0].value
+        # sorted store knows its size, SPARQL query would scan all triples
+        if isinstance(self.store, Graph) and not isinstance(self.store, ConjunctiveGraph):
+            from example_based_entity_search.sorted_store import SortedTriplesStore
+            if isinstance(self.store.store, SortedTriplesStore):
+                self._size = len(self.store)
+                return self._size
+
+        # rdflib's SPARQL parser is not thread-safe
+        with _QUERY_LOCK:
+            if self._size:
+                return self._size
+            results = self.store.query(PREFIXES + '''SELECT (count(?s) as ?X) 
+                           WHERE {  
+                              ?s ?p ?o . 
+                           }''')
+            self._size = list(results)[0][0].value
         return self._size
 
 
+class _ProgressReader(io.RawIOBase):
+    """File wrapper reporting amount of read bytes."""
+
+    def __init__(self, raw_file, progress: Callable[[int], None]):
+        super().__init__()
+        self._file = raw_file
+        self._progress = progress
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        amount = self._file.readinto(buffer)
+        self._progress(amount or 0)
+        return amount
+
+
+def _load_snapshot_backend(data_url: str, old_graph: Optional[PPGraph]) -> PPGraph:
+    L.info('Loading triples from snapshot `%s`', data_url)
+    snapshot = load_snapshot(data_url)
+    if old_graph and old_graph.sources:
+        old_graph.merge(snapshot)
+        return old_graph
+    return snapshot
+
+
+def _load_sorted_store_backend(data_url: str, old_graph: Optional[PPGraph]) -> PPGraph:
+    from example_based_entity_search.sorted_store import SortedTriplesStore
+    L.info('Using out-of-core sorted store `%s`', data_url)
+    if old_graph and old_graph.sources:
+        L.warning('Sorted store is read-only, old triples are dropped')
+    graph = PPGraph(Graph(store=SortedTriplesStore(data_url)))
+    graph.sources = [data_url, SortedTriplesStore.triples_file(data_url)]
+    return graph
+
+
+def _load_manifest_backend(data_url: str, old_graph: Optional[PPGraph]) -> PPGraph:
+    from example_based_entity_search.manifest import Manifest
+    L.info('Using manifest `%s`, triples are loaded when needed', data_url)
+    if old_graph and old_graph.sources:
+        L.warning('Graph of the manifest is loaded lazily, old triples are dropped')
+    return Manifest.load(data_url).graph()
+
+
+def _load_tiered_backend(data_url: str, old_graph: Optional[PPGraph]) -> PPGraph:
+    from example_based_entity_search.tiered import load_tiered
+    return load_tiered(data_url, old_graph)
+
+
+def _load_file_backend(data_url: str, old_graph: Optional[PPGraph]) -> PPGraph:
+    graph = old_graph if old_graph else PPGraph(ConjunctiveGraph())
+    L.info('Loading triples from file `%s`', data_url)
+    data_format = guess_format(data_url)
+    graph.parse(data_url, format=data_format)
+    return graph
+
+
+def _load_directory_backend(data_url: str, old_graph: Optional[PPGraph]) -> PPGraph:
+    graph = old_graph if old_graph else PPGraph(ConjunctiveGraph())
+    L.info('Loading triples from files in directory `%s`', data_url)
+    for extension in TRIPLE_FILE_EXTENSIONS:
+        triples_files = glob(f'{data_url}/*.{extension}')
+        if len(triples_files) > 0:
+            L.info('Found %d `.%s` files', len(triples_files), extension)
+
+        for i, triples_file in enumerate(triples_files):
+            data_format = guess_format(triples_file)
+            L.debug('%d / %d (`%s`), data format: %s', i, len(triples_files),
+                    triples_file, data_format)
+            graph.parse(triples_file, format=data_format)
+    return graph
+
+
+def _load_sparql_backend(data_url: str, old_graph: Optional[PPGraph]) -> PPGraph:
+    from rdflib.plugins.stores.sparqlstore import SPARQLStore
+    L.info('Using remote graph from SPARQL endpoint `%s`', data_url)
+    graph = PPGraph(SPARQLStore(data_url))
+    graph.sources = [data_url]
+
+    # early fail
+    try:
+        graph.query('''SELECT DISTINCT ?s 
+               WHERE { 
+                  ?s rdf:type foaf:Person
+               } LIMIT 1''')
+    except Exception as e:
+        L.error("Can't load data from remote endpoint")
+        raise e
+    return graph
+
+
+# PPGraph backends: name, whether the backend handles data url, loader
+# loaders import their dependencies lazily, so unused backends cost nothing at startup
+Backend = Tuple[str, Callable[[str], bool],
+                Callable[[str, Optional[PPGraph]], PPGraph]]
+BACKENDS: List[Backend] = [
+    ('tiered', lambda data_url: TIERED_SEPARATOR in data_url, _load_tiered_backend),
+    ('snapshot', lambda data_url: isfile(data_url) and data_url.endswith('.' + SNAPSHOT_EXTENSION),
+     _load_snapshot_backend),
+    ('sorted', lambda data_url: isfile(data_url) and data_url.endswith('.' + SORTED_STORE_EXTENSION),
+     _load_sorted_store_backend),
+    ('manifest', lambda data_url: isfile(data_url) and data_url.endswith('.' + MANIFEST_EXTENSION),
+     _load_manifest_backend),
+    ('file', isfile, _load_file_backend),
+    ('directory', isdir, _load_directory_backend),
+    ('sparql', lambda data_url: True, _load_sparql_backend)
+]
+
+
+def register_backend(name: str, matches: Callable[[str], bool],
+                     loader: Callable[[str, Optional[PPGraph]], PPGraph]):
+    """Adds PPGraph backend, it takes precedence over already registered ones."""
+    BACKENDS.insert(0, (name, matches, loader))
+
+
 def load_data(data_url: str, old_graph: Optional[PPGraph] = None) -> PPGraph:
     """Create new PPGraph or add triples to the provided one.
 
+    Backend is the first registered one that handles data_url (see BACKENDS).
+
     Args:
         data_url: path to RDF file or url address of SPARQL endpoint,
-                    passing an url will invalidate old_graph
+                    passing an url, sorted store or manifest will invalidate old_graph
         old_graph: existing graph, will add triples to it
 
     Returns:
         Graph with triples loaded from data_url (lazy loaded in case of SPARQL endpoint)
     """
-    if old_graph:
-        graph = old_graph
+    for name, matches, loader in BACKENDS:
+        if matches(data_url):
+            L.debug('Using `%s` backend', name)
+            graph = loader(data_url, old_graph)
+            break
     else:
-        graph = PPGraph(ConjunctiveGraph())
+        raise ValueError(f'No backend for `{data_url}`')
 
-    if isfile(data_url):
-        L.info('Loading triples from file `%s`', data_url)
-        data_format = guess_format(data_url)
-        graph.parse(data_url, format=data_format)
-
-    elif isdir(data_url):
-        L.info('Loading triples from files in directory `%s`', data_url)
-        for extension in TRIPLE_FILE_EXTENSIONS:
-            triples_files = glob(f'{data_url}/*.{extension}')
-            if len(triples_files) > 0:
-                L.info('Found %d `.%s` files', len(triples_files), extension)
-
-            for i, triples_file in enumerate(triples_files):
-                data_format = guess_format(triples_file)
-                L.debug('%d / %d (`%s`), data format: %s', i, len(triples_files),
-                        triples_file, data_format)
-                graph.parse(triples_file, format=data_format)
+    # one pass over in-memory triples, remote and out-of-core graphs are too big for that
+    if graph.degrees is None and isinstance(graph.store, ConjunctiveGraph):
+        from example_based_entity_search.degrees import DegreeStats
+        graph.degrees = DegreeStats.from_graph(graph)
+    return graph
 
-    else:
-        L.info('Using remote graph from SPARQL endpoint `%s`', data_url)
-        graph = PPGraph(SPARQLStore(data_url))
 
-        # early fail
+class BackgroundLoader:
+    """Loads triples in a background thread.
+
+    The current graph is not modified while loading, so it can be queried until loading
+    finishes: triples are loaded into a new graph. Call result() to get the graph to use,
+    it merges new triples into the current local graph, or replaces the current graph if
+    either of them is remote, out-of-core or loaded lazily (then `replaces` is True).
+    """
+
+    def __init__(self, data_url: str, current: Optional[PPGraph] = None):
+        self.data_url = data_url
+        self.loaded_bytes = 0
+        self.total_bytes: Optional[int] = _local_size(data_url)
+        self.replaces: Optional[bool] = None  # known when loaded
+        self._current = current
+        self._graph: Optional[PPGraph] = None
+        self._error: Optional[Exception] = None
+        self._thread = Thread(target=self._load, daemon=True)
+        self._thread.start()
+
+    def _add_progress(self, amount: int):
+        self.loaded_bytes += amount
+
+    def _load(self):
         try:
-            graph.query('''SELECT DISTINCT ?s 
-                   WHERE { 
-                      ?s rdf:type foaf:Person
-                   } LIMIT 1''')
+            graph = PPGraph(ConjunctiveGraph())
+            graph.progress = self._add_progress
+            graph = load_data(self.data_url, graph)
+            graph.progress = None
+            self._graph = graph
         except Exception as e:
-            L.error("Can't load data from remote endpoint")
-            raise e
+            self._error = e
 
+    @property
+    def progress(self) -> Optional[float]:
+        """Parsed fraction of local files, None if unknown."""
+        if not self.total_bytes:
+            return None
+        return min(1.0, self.loaded_bytes / self.total_bytes)
+
+    def done(self) -> bool:
+        return not self._thread.is_alive()
+
+    def result(self) -> PPGraph:
+        """Waits for the new graph, raises loading error.
+
+        Merging happens in the calling thread, so the current graph must not be queried meanwhile.
+        """
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        assert self._graph is not None
+        current, self._current = self._current, None
+        self.replaces = current is None or not _mergeable(current) or not _mergeable(self._graph)
+        if not self.replaces:
+            assert current is not None
+            current.merge(self._graph)
+            self._graph = current
+        return self._graph
+
+
+def _mergeable(graph: PPGraph) -> bool:
+    """Whether the graph holds all its triples in memory."""
+    return isinstance(graph.store, ConjunctiveGraph) and not graph.tiers
+
+
+def _local_size(data_url: str) -> Optional[int]:
+    """Size of triples files in bytes, None for urls."""
+    if isfile(data_url):
+        return getsize(data_url)
+    if isdir(data_url):
+        return sum([getsize(triples_file) for extension in TRIPLE_FILE_EXTENSIONS
+                    for triples_file in glob(f'{data_url}/*.{extension}')])
+    return None
+
+
+def save_snapshot(graph: PPGraph, snapshot_file: str):
+    """Pickle local graph to a file, so it can be loaded without parsing."""
+    if _is_remote(graph.store):
+        L.error('Remote graph can not be saved as a snapshot')
+        raise ValueError(graph.store)
+
+    L.info('Saving snapshot of the graph to `%s`', snapshot_file)
+    with open(snapshot_file, 'wb') as f:
+        pickle.dump(graph.store, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_snapshot(snapshot_file: str) -> PPGraph:
+    """Load graph pickled with save_snapshot."""
+    with open(snapshot_file, 'rb') as f:
+        store = pickle.load(f)
+    graph = PPGraph(store)
+    graph.sources = [snapshot_file]
     return graph
 
 
@@ -209,15 +671,22 @@ def test_ppgraph(data_urls: List[str]):
                 o, Literal) or isinstance(o, BNode)
 
 
-def data_from_sample_file(sample_file: str) -> \
+def data_from_sample_file(sample_file: str, rng: Optional[Random] = None) -> \
         Tuple[str, List[URIRef], List[URIRef], List[URIRef]]:
-    """Parses sample file"""
+    """Parses sample file
+
+    Args:
+        sample_file: path to YAML sample file
+        rng: if provided, examples are always drawn randomly with it (also when the file
+                    sets top entities as examples), seed it for reproducible draws
+    """
     L.info('Preparing ranking for sample file `%s`', sample_file)
 
     if not isfile(sample_file):
         L.error('File `%s` do not exists, aborting!', sample_file)
         raise SyntaxError
 
+    from yaml import YAMLError, safe_load
     try:
         with open(sample_file, 'r', encoding='utf8') as f:
             sample_data = safe_load(f)
@@ -257,7 +726,9 @@ def data_from_sample_file(sample_file: str) -> \
             'There is only %d relevant entities in sample data `%s`, trimming amount of examples', len(relevant), sample_file)
 
     # select random examples from relevant entities
-    if random_examples:
+    if rng is not None:
+        rng.shuffle(relevant)
+    elif random_examples:
         shuffle(relevant)
 
     # prepare entities
@@ -268,13 +739,63 @@ def data_from_sample_file(sample_file: str) -> \
     return sample_data['topic'], examples, entities_to_rank, relevant
 
 
-def statistical_stats(retrived: List[bool]) -> Dict[str, D]:
-    """Compute various evaluation measures."""
+def data_from_dict(query: Dict[str, Any]) -> Tuple[str, List[URIRef], List[URIRef]]:
+    """Parses query provided as a dictionary (f.e. decoded JSON).
+
+    Dictionary must have keys: `topic` (plain text), `examples` and `candidates`
+    (lists of URIs).
+
+    Returns:
+        topic, examples, entities to rank
+    """
+    if not isinstance(query, dict):
+        raise SyntaxError('Query must be dictionary')
+
+    for required_key in ['topic', 'examples', 'candidates']:
+        if required_key not in query:
+            raise SyntaxError(f'`{required_key}` key not found in query')
+
+    if not isinstance(query['topic'], str):
+        raise SyntaxError('`topic` must be a string')
+
+    for list_key in ['examples', 'candidates']:
+        if not isinstance(query[list_key], list) or \
+                not all([isinstance(uri, str) for uri in query[list_key]]):
+            raise SyntaxError(f'`{list_key}` must be a list of URIs')
+
+    examples = list(map(URIRef, query['examples']))
+    entities_to_rank = list(map(URIRef, query['candidates']))
+
+    if len(examples) == 0:
+        raise SyntaxError('No examples specified in the query')
+    if len(entities_to_rank) == 0:
+        raise SyntaxError('No candidates specified in the query')
+
+    return query['topic'], examples, entities_to_rank
+
+
+def ranking_to_dict(ranking: Tuple[D, List[Tuple[D, URIRef]]]) -> Dict[str, Any]:
+    """Converts ranking to JSON-serializable dictionary."""
+    ap, ranking_data = ranking
+    return {
+        'ap': float(ap),
+        'ranking': [{'entity': str(entity), 'score': float(ranking_score)}
+                    for ranking_score, entity in ranking_data]
+    }
+
+
+def statistical_stats(retrived: Sequence[int]) -> Dict[str, D]:
+    """Compute various evaluation measures.
+
+    Args:
+        retrived: relevance of top entities, bools or a mask of bytes (see columnar.relevance)
+    """
     # A measure of the ability of a system to present only relevant items
-    r_precision = D(sum(retrived)) / len(retrived)
+    r_precision = D(0)
     avg_prec = D(0)
 
     if len(retrived) != 0:
+        r_precision = D(sum(retrived)) / len(retrived)
         relevant_so_far = D(0)
         for i, is_relevant in enumerate(retrived, 1):
             if is_relevant:
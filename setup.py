@@ -19,7 +19,9 @@ setup(
     entry_points={
         'console_scripts': [
             'ebes-data = example_based_entity_search.dump_data:main',
-            'ebes-rank = example_based_entity_search.entity_search_tool:main'
+            'ebes-rank = example_based_entity_search.entity_search_tool:main',
+            'ebes-serve = example_based_entity_search.entity_search_server:main',
+            'ebes-shard = example_based_entity_search.sharding:main'
         ]
     }
 )
\ No newline at end of file